@@ -0,0 +1,192 @@
+"""
+近似最近邻索引
+
+精确的 IndexFlatL2 查询耗时和内存都随文本块数量线性增长，知识库很大时可以换成：
+    flat        精确检索，默认
+    hnsw        HNSW 图索引，查询快，内存略大于 flat，不支持删除
+    ivf_flat    倒排索引，每次只扫描 nprobe 个聚类
+    ivf_sq8     倒排索引 + 8 位标量量化，内存约为 flat 的 1/4
+    ivf_pq      倒排索引 + 乘积量化，内存约为 flat 的 1/50
+倒排和量化索引需要先在样本上训练，样本从全部向量中随机抽取。
+查询精度与速度由 nprobe（倒排）和 efSearch（HNSW）调节。
+
+recall_report 在同一批向量上构建各种索引，与精确检索对比 recall@k 和查询延迟，
+用于为每个部署选择速度、内存与召回率的平衡点：
+    python ann_index.py testDemo/index --k 10 --queries 200
+"""
+import argparse
+import json
+import math
+import os
+import time
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ('flat', 'hnsw', 'ivf_flat', 'ivf_sq8', 'ivf_pq')
+# 重建时可以从索引中无损取回原始向量的类型
+LOSSLESS_TYPES = ('flat', 'hnsw', 'ivf_flat')
+
+
+def default_nlist(ntotal):
+    """聚类数约为 4·√n，并保证每个聚类至少有 39 个训练样本"""
+    return max(1, min(int(4 * math.sqrt(ntotal)), ntotal // 39))
+
+
+def factory_string(index_type, ntotal, nlist=None, hnsw_m=32, pq_m=64):
+    if index_type == 'flat':
+        return "Flat"
+    if index_type == 'hnsw':
+        return f"HNSW{hnsw_m}"
+    nlist = nlist or default_nlist(ntotal)
+    if index_type == 'ivf_flat':
+        return f"IVF{nlist},Flat"
+    if index_type == 'ivf_sq8':
+        return f"IVF{nlist},SQ8"
+    if index_type == 'ivf_pq':
+        return f"IVF{nlist},PQ{pq_m}x8"
+    raise ValueError(f"Unknown index type: {index_type}")
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """设置查询参数，索引类型不支持的参数忽略"""
+    params = faiss.ParameterSpace()
+    for name, value in (('nprobe', nprobe), ('efSearch', ef_search)):
+        if value:
+            try:
+                params.set_index_parameter(index, name, value)
+            except RuntimeError:
+                pass
+
+
+def build_index(vectors, index_type='flat', nlist=None, hnsw_m=32, pq_m=64, train_size=None,
+                nprobe=None, ef_search=None, seed=0):
+    """
+    用给定向量构建索引：需要训练的类型先在随机抽取的样本上训练，再加入全部向量
+    向量在索引中的顺序与输入一致，与 LangChain FAISS 的 index_to_docstore_id 对应
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    ntotal, dim = vectors.shape
+    index = faiss.index_factory(dim, factory_string(index_type, ntotal, nlist, hnsw_m, pq_m), faiss.METRIC_L2)
+    if not index.is_trained:
+        # 每个聚类约 256 个训练样本
+        size = min(ntotal, train_size or max(10000, faiss.extract_index_ivf(index).nlist * 256))
+        sample = vectors[np.random.default_rng(seed).choice(ntotal, size, replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    set_search_params(index, nprobe, ef_search)
+    return index
+
+
+def index_type_of(index):
+    """从 faiss 索引对象反推 INDEX_TYPES 中的类型名"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexFlat):
+        return 'flat'
+    if isinstance(index, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(index, faiss.IndexIVFFlat):
+        return 'ivf_flat'
+    if isinstance(index, faiss.IndexIVFScalarQuantizer):
+        return 'ivf_sq8'
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    return type(index).__name__
+
+
+def reconstruct_all(index):
+    """取回索引中的全部向量，按加入顺序排列"""
+    try:
+        faiss.extract_index_ivf(index).make_direct_map()
+    except RuntimeError:
+        pass
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def index_bytes(index):
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def recall_report(vectors, queries, configs, k=10):
+    """
+    对每组配置构建索引，按各自的查询参数检索 queries，与精确检索结果对比
+    configs 为 [{'index_type': ..., 'nprobe': [...], 'ef_search': [...], 其余 build_index 参数}]
+    返回每个索引与参数组合一行的统计列表
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    k = min(k, len(vectors))
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for config in configs:
+        config = dict(config)
+        nprobes = config.pop('nprobe', None) or [None]
+        ef_searches = config.pop('ef_search', None) or [None]
+        started = time.perf_counter()
+        try:
+            index = build_index(vectors, **config)
+        except RuntimeError as e:
+            # 向量太少时量化索引无法训练
+            rows.append({'index_type': config['index_type'], 'error': str(e)})
+            continue
+        build_seconds = time.perf_counter() - started
+        memory = index_bytes(index)
+        for nprobe in nprobes:
+            for ef_search in ef_searches:
+                set_search_params(index, nprobe, ef_search)
+                started = time.perf_counter()
+                _, found = index.search(queries, k)
+                elapsed = time.perf_counter() - started
+                hits = sum(len(set(found[i]) & set(truth[i])) for i in range(len(queries)))
+                rows.append({
+                    'index_type': config['index_type'],
+                    'nprobe': nprobe,
+                    'ef_search': ef_search,
+                    f'recall@{k}': round(hits / (len(queries) * k), 4),
+                    'latency_ms': round(elapsed * 1000 / len(queries), 4),
+                    'qps': round(len(queries) / elapsed, 1) if elapsed else None,
+                    'memory_mb': round(memory / (1 << 20), 2),
+                    'build_s': round(build_seconds, 2),
+                })
+    return rows
+
+
+DEFAULT_CONFIGS = [
+    {'index_type': 'flat'},
+    {'index_type': 'hnsw', 'ef_search': [16, 64, 128]},
+    {'index_type': 'ivf_flat', 'nprobe': [1, 8, 32]},
+    {'index_type': 'ivf_sq8', 'nprobe': [1, 8, 32]},
+    {'index_type': 'ivf_pq', 'nprobe': [1, 8, 32]},
+]
+
+
+def split_queries(vectors, count, seed=0):
+    """从向量中留出一部分作为查询，其余作为被检索的库"""
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    count = min(count, len(vectors) // 10 or 1)
+    return vectors[order[count:]], vectors[order[:count]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比各种 ANN 索引与精确检索的 recall@k 和延迟")
+    parser.add_argument('index_dir', help="VectorIndex 的持久化目录，使用其中当前快照的向量")
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    with open(os.path.join(args.index_dir, 'CURRENT'), 'r', encoding='utf-8') as f:
+        snapshot_dir = os.path.join(args.index_dir, f.read().strip())
+    index = faiss.read_index(os.path.join(snapshot_dir, 'index.faiss'))
+    if index_type_of(index) not in LOSSLESS_TYPES:
+        parser.error("snapshot index is quantized; build it with INDEX_TYPE=flat to get exact vectors")
+    base, queries = split_queries(reconstruct_all(index), args.queries)
+    for row in recall_report(base, queries, DEFAULT_CONFIGS, k=args.k):
+        print(json.dumps(row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+LLM 回答的语义缓存
+
+按 (模型, 系统提示, 检索上下文) 的哈希分桶，桶内先按规范化后的问题文本精确匹配，
+再按问题向量的余弦相似度匹配近似问题。条目总数有上限，超出后淘汰最久未使用的条目。
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def content_hash(*parts):
+    """对任意可 JSON 序列化的内容计算稳定哈希"""
+    data = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def replay_chunks(text, size=32):
+    """把缓存的完整回答切成小段，按原有的流式帧逐段发送"""
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+class AnswerCache:
+    def __init__(self, maxsize=1000, threshold=0.95, ttl=None):
+        """threshold 为判定近似问题的余弦相似度下限，ttl 为过期秒数"""
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        # 桶键 -> OrderedDict(条目 id -> (规范化问题, 单位化问题向量, 回答, 过期时间))
+        self._buckets = {}
+        # 条目 id -> 桶键，按最近使用排序，用于全局淘汰
+        self._lru = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def bucket_key(model, system_prompt, context):
+        return content_hash(model, system_prompt, context)
+
+    def get(self, bucket_key, question, vector):
+        """返回缓存的回答，未命中返回 None"""
+        query = self._unit(vector)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(bucket_key)
+            best_id, best_score = None, self.threshold
+            for entry_id, (text, entry_vector, _, expires_at) in list((bucket or {}).items()):
+                if expires_at is not None and expires_at <= now:
+                    self._remove(entry_id)
+                    continue
+                if text == question:
+                    best_id, best_score = entry_id, 1.0
+                    break
+                score = float(np.dot(query, entry_vector))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                return None
+            if best_score < 1.0:
+                self.near_hits += 1
+            self.hits += 1
+            self._lru.move_to_end(best_id)
+            return self._buckets[bucket_key][best_id][2]
+
+    def put(self, bucket_key, question, vector, answer):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._buckets.setdefault(bucket_key, OrderedDict())[entry_id] = (
+                question, self._unit(vector), answer, expires_at)
+            self._lru[entry_id] = bucket_key
+            while len(self._lru) > self.maxsize:
+                self._remove(next(iter(self._lru)))
+                self.evictions += 1
+
+    def _remove(self, entry_id):
+        bucket_key = self._lru.pop(entry_id)
+        bucket = self._buckets[bucket_key]
+        del bucket[entry_id]
+        if not bucket:
+            del self._buckets[bucket_key]
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._lru),
+                'maxsize': self.maxsize,
+                'buckets': len(self._buckets),
+                'hits': self.hits,
+                'near_hits': self.near_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
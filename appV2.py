@@ -1,28 +1,32 @@
-from flask import Flask, request, jsonify, send_file, Response, stream_with_context, make_response
-from langchain_community.chat_models import ChatZhipuAI
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
-from langchain.text_splitter import CharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
+from flask import Flask, request, jsonify, send_file, Response, make_response
+import logging
 import os
+import threading
+import time
 from flask_cors import CORS
 from dotenv import load_dotenv
-import sqlite3
-import json
-import time
-import zhipuai
-import random
 from search_utils import search_web
+from search_service import SearchService, format_results
+from context_packer import ContextPacker
 from email_service import EmailRequest, send_email
-import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-import base64
-from PIL import Image
-import io
 from utils.math_formatter import MathFormatter
 from werkzeug.utils import secure_filename
-from openai import OpenAI
+from provider_clients import ProviderBusy, build_providers
+from provider_router import ProviderRouter
+from vector_index import VectorIndex, normalize_question
+from embedding_service import LazyEmbeddings, QueryBatcher
+from answer_cache import AnswerCache, content_hash, replay_chunks
+from image_utils import ImagePreprocessor
+from db_utils import Database
+from email_queue import EmailQueue, EmailQueueFull
+from index_queue import IndexJobQueue, IndexQueueFull
+from chat_sessions import ConversationStore, HistoryCompactor
+import metrics
+from log_utils import setup_logging
+from sse_stream import SSEStream, START_FRAME, DONE_FRAME, content_frame, error_frame
+from stream_buffer import FramesEvicted, StreamRegistry
 
 # 定义一组有趣的 emoji
 EMOJIS = [
@@ -35,15 +39,19 @@ EMOJIS = [
 # 加载环境变量
 load_dotenv()
 
+# 日志经队列交给后台线程输出，请求线程不等待终端 I/O
+setup_logging(os.getenv('LOG_LEVEL', 'INFO').upper())
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 # 初始化 CORS
 CORS(app, resources={
     r"/*": {
         "origins": ["http://localhost:5173", "http://127.0.0.1:5173"],
-        "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"],
+        "methods": ["GET", "POST", "DELETE", "OPTIONS"],
+        "allow_headers": ["Content-Type", "Authorization", "Last-Event-ID"],
         "supports_credentials": True,
-        "expose_headers": ["Content-Type", "Authorization"],
+        "expose_headers": ["Content-Type", "Authorization", "X-Conversation-Id", "X-Stream-Id"],
         "max_age": 3600
     }
 }, supports_credentials=True)
@@ -53,56 +61,432 @@ api_key = os.getenv("ZHIPUAI_API_KEY")
 deepseek_api_key = os.getenv("DEEPSEEK_API_KEY", "sk-5f5b3406be884ec5be623d95049c5b2f")
 openai_api_key = os.getenv("OPENAI_API_KEY", "")
 
-# 初始化客户端
-client = zhipuai.ZhipuAI(api_key=api_key) if api_key else None
-deepseek_client = OpenAI(
-    api_key=deepseek_api_key,
-    base_url="https://api.deepseek.com"
-) if deepseek_api_key else None
-openai_client = OpenAI(api_key=openai_api_key) if openai_api_key else None
+# 初始化客户端：每个服务商共用带连接池的客户端，并有并发上限、限流和重试
+providers = build_providers(zhipu_api_key=api_key, deepseek_api_key=deepseek_api_key,
+                            openai_api_key=openai_api_key)
+
+# model=auto 时按首字延迟在已配置的服务商之间选择，超时未出首字则对冲到下一个服务商
+AUTO_MODEL = 'auto'
+router = ProviderRouter(
+    providers,
+    first_token_deadline=float(os.getenv('ROUTER_FIRST_TOKEN_DEADLINE', '2.0')),
+    window=int(os.getenv('ROUTER_WINDOW', '50')),
+)
+
+def get_provider(model):
+    provider = providers.get(model)
+    if provider is None:
+        raise ValueError(f"{model} API key not configured")
+    return provider
+
+def provider_busy_response(error):
+    """服务商繁忙时快速拒绝，返回 429/503 并提示重试时间"""
+    response = jsonify({'error': str(error)})
+    response.headers['Retry-After'] = str(error.retry_after)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response, error.status_code
 
 # 初始化 Deepseek 客户端
 if deepseek_api_key is None:
     raise ValueError("Deepseek API key not found. Please set the DEEPSEEK_API_KEY environment variable.")
 
-# 初始化向量存储
-embeddings = HuggingFaceEmbeddings(model_name="shibing624/text2vec-base-chinese")
-vector_store = None
+# 初始化向量存储，嵌入模型在第一次使用或启动预热时才加载
+EMBEDDING_MODEL = "shibing624/text2vec-base-chinese"
+# 推理后端：torch、int8 或 onnx；线程数为 0 时使用默认值
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+EMBEDDING_INTRA_OP_THREADS = int(os.getenv('EMBEDDING_INTRA_OP_THREADS', '0')) or None
+EMBEDDING_INTER_OP_THREADS = int(os.getenv('EMBEDDING_INTER_OP_THREADS', '0')) or None
+embeddings = LazyEmbeddings(EMBEDDING_MODEL, backend=EMBEDDING_BACKEND,
+                            intra_op_threads=EMBEDDING_INTRA_OP_THREADS,
+                            inter_op_threads=EMBEDDING_INTER_OP_THREADS)
+
+# 查询向量的批处理：并发请求在 EMBED_BATCH_WAIT_MS 毫秒内合并为一批，每批最多 EMBED_MAX_BATCH 条
+EMBED_BATCHING = os.getenv('EMBED_BATCHING', 'true').lower() in ('1', 'true', 'yes')
+query_batcher = QueryBatcher(embeddings.embed_documents,
+                             max_batch_size=int(os.getenv('EMBED_MAX_BATCH', '32')),
+                             max_wait_ms=float(os.getenv('EMBED_BATCH_WAIT_MS', '5')),
+                             load=embeddings.load)
+
+# 图片预处理：工作线程数及按内容哈希缓存的条目数
+image_preprocessor = ImagePreprocessor(
+    workers=int(os.getenv('IMAGE_WORKERS', '2')),
+    cache_size=int(os.getenv('IMAGE_CACHE_SIZE', '128')),
+)
 
 # 创建格式化器实例
 math_formatter = MathFormatter()
 
 # 设置文档保存路径
-DOCS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testDemo', 'docs')
+DOCS_DIR = os.getenv('DOCS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testDemo', 'docs'))
+# 向量索引的持久化目录
+INDEX_DIR = os.getenv('INDEX_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testDemo', 'index'))
+
+# 入库流水线：切分进程数和每批嵌入的文本块数
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '0')) or None
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '256'))
+# 查询向量和检索结果缓存的条目数与过期秒数
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '4096'))
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', '3600'))
+# 索引类型：flat、hnsw、ivf_flat、ivf_sq8、ivf_pq，向量数达到 ANN_MIN_VECTORS 后才使用近似索引
+# 可先用 python ann_index.py <INDEX_DIR> 对比各类型的召回率和延迟再选择
+INDEX_TYPE = os.getenv('INDEX_TYPE', 'flat')
+ANN_MIN_VECTORS = int(os.getenv('ANN_MIN_VECTORS', '10000'))
+ANN_NLIST = int(os.getenv('ANN_NLIST', '0')) or None
+ANN_PQ_M = int(os.getenv('ANN_PQ_M', '64'))
+ANN_NPROBE = int(os.getenv('ANN_NPROBE', '16'))
+ANN_EF_SEARCH = int(os.getenv('ANN_EF_SEARCH', '64'))
+# 多个进程共用 INDEX_DIR 时检查新快照的间隔秒数（0 为不检查），以及保留的快照数
+INDEX_POLL_INTERVAL = float(os.getenv('INDEX_POLL_INTERVAL', '1'))
+INDEX_KEEP_SNAPSHOTS = int(os.getenv('INDEX_KEEP_SNAPSHOTS', '3'))
+
+# 增量维护的向量索引，查询时读取 vector_index.store
+vector_index = VectorIndex(DOCS_DIR, embeddings, chunk_size=1000, chunk_overlap=200,
+                           index_dir=INDEX_DIR,
+                           # 不同后端的向量略有差异，持久化的索引按后端区分
+                           embedding_model=(EMBEDDING_MODEL if EMBEDDING_BACKEND == 'torch'
+                                            else f"{EMBEDDING_MODEL}:{EMBEDDING_BACKEND}"),
+                           batch_size=INGEST_BATCH_SIZE, workers=INGEST_WORKERS,
+                           query_cache_size=QUERY_CACHE_SIZE, query_cache_ttl=QUERY_CACHE_TTL,
+                           index_type=INDEX_TYPE, ann_min_vectors=ANN_MIN_VECTORS, nlist=ANN_NLIST,
+                           pq_m=ANN_PQ_M, nprobe=ANN_NPROBE, ef_search=ANN_EF_SEARCH,
+                           query_embedder=query_batcher.embed if EMBED_BATCHING else None,
+                           keep_snapshots=INDEX_KEEP_SNAPSHOTS)
 
 def initialize_vector_store():
-    global vector_store
-    # 创建文档目录
-    if not os.path.exists(DOCS_DIR):
-        os.makedirs(DOCS_DIR)
-    
-    # 加载文档
-    documents = []
-    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    
-    # 遍历文档目录中的所有文件
-    for filename in os.listdir(DOCS_DIR):
-        if filename.endswith('.txt'):
+    """把文档目录的变化增量同步到向量索引"""
+    try:
+        stats = vector_index.refresh()
+        logger.info("Vector store updated: %s", stats)
+    except Exception as e:
+        logger.error("Error initializing vector store: %s", e)
+
+def index_uploads(progress):
+    """后台索引任务：把上传后文档目录的变化同步到向量索引，失败时抛出异常由队列记录"""
+    with metrics.UPLOAD_INDEX_SECONDS.time('background'):
+        stats = vector_index.refresh(progress)
+    logger.info("Vector store updated: %s", stats)
+    return stats
+
+# 上传后的后台索引：排队任务数上限，以及合并上传的等待时间（毫秒）和最长等待秒数
+index_queue = IndexJobQueue(
+    index_uploads,
+    maxsize=int(os.getenv('INDEX_QUEUE_SIZE', '100')),
+    debounce=float(os.getenv('INDEX_DEBOUNCE_MS', '500')) / 1000,
+    max_delay=float(os.getenv('INDEX_MAX_DELAY', '5')),
+)
+
+def index_job_response(filename, message):
+    """文件已保存，入队后台索引并返回 202；队列已满时返回 503"""
+    try:
+        job_id = index_queue.submit(filename)
+    except IndexQueueFull as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = '5'
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 503
+    response = jsonify({'message': message, 'filename': filename, 'job_id': job_id, 'status': 'queued',
+                        'status_url': f"/api/index/jobs/{job_id}"})
+    response.headers['Location'] = f"/api/index/jobs/{job_id}"
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
+    return response, 202
+
+# 带检索上下文的系统提示，参考资料拼接在末尾
+RAG_SYSTEM_PROMPT = """你是一个智能助手。请基于以下参考资料回答问题。如果问题与参考资料无关，你可以基于自己的知识回答。
+
+在回答涉及数学内容时，请遵循以下规则：
+1. 使用简单直观的符号表示数学公式，避免复杂的LaTeX格式
+2. 对于简单的数学符号，直接使用Unicode字符（如：×, ÷, ±, ≤, ≥, α, β, λ等）
+3. 对于上下标，使用简单的形式（如：x₁, x², aᵢ等）
+4. 分数使用斜杠表示（如：a/b）
+5. 避免使用复杂的LaTeX环境和命令
+
+参考资料：
+"""
+
+# 没有检索结果时使用的系统提示
+DEFAULT_SYSTEM_PROMPT = """你是一个智能助手，可以帮助用户解答问题。
+
+在回答涉及数学内容时，请遵循以下规则：
+1. 使用简单直观的符号表示数学公式，避免复杂的LaTeX格式
+2. 对于简单的数学符号，直接使用Unicode字符（如：×, ÷, ±, ≤, ≥, α, β, λ等）
+3. 对于上下标，使用简单的形式（如：x₁, x², aᵢ等）
+4. 分数使用斜杠表示（如：a/b）
+5. 避免使用复杂的LaTeX环境和命令"""
+
+# 语义回答缓存，默认关闭；开启后相同或近似的问题在相同上下文下直接回放缓存的回答
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+answer_cache = AnswerCache(
+    maxsize=int(os.getenv('ANSWER_CACHE_SIZE', '1000')),
+    threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95')),
+    ttl=int(os.getenv('ANSWER_CACHE_TTL', '86400')),
+)
+
+def use_answer_cache(cache_param='1'):
+    """全局开启且请求没有通过 cache=0 跳过时使用回答缓存"""
+    return ANSWER_CACHE_ENABLED and cache_param != '0'
+
+def lookup_answer(model_name, system_prompt, context, question):
+    """
+    查找回答缓存，返回 (缓存的回答或 None, 写回缓存的函数)
+    """
+    key = answer_cache.bucket_key(model_name, system_prompt, content_hash(context))
+    question_key = normalize_question(question)
+    question_vector = vector_index.embed_query(question)
+
+    def store(answer):
+        if answer:
+            answer_cache.put(key, question_key, question_vector, answer)
+
+    return answer_cache.get(key, question_key, question_vector), store
+
+# /index 与 /api/chat 使用的上游模型
+INDEX_MODELS = {'zhipu': "glm-4v-flash", 'deepseek': "deepseek-chat"}
+CHAT_MODELS = {'zhipu': "glm-4", 'deepseek': "deepseek-chat"}
+
+# 各模型的请求参数
+INDEX_REQUEST_OPTIONS = {
+    'zhipu': {'temperature': 0.7},
+    'deepseek': {'temperature': 0.7, 'max_tokens': 1024},
+}
+CHAT_REQUEST_OPTIONS = {
+    'zhipu': {'temperature': 0.7},
+    'deepseek': {'temperature': 0.7, 'max_tokens': 1024},
+}
+
+# RAG 上下文：检索的候选数、最多使用的文本块数和上下文的 token 预算
+RAG_FETCH_K = int(os.getenv('RAG_FETCH_K', '8'))
+RAG_MAX_K = int(os.getenv('RAG_MAX_K', '6'))
+RAG_CONTEXT_BUDGET = int(os.getenv('RAG_CONTEXT_BUDGET', '1500'))
+
+context_packer = ContextPacker(budget=RAG_CONTEXT_BUDGET, max_k=RAG_MAX_K,
+                               max_overlap=vector_index.chunk_overlap)
+
+# 网络搜索：结果缓存、单次搜索超时（秒）和 /index 是否默认附带网络搜索结果
+WEB_SEARCH_CACHE_SIZE = int(os.getenv('WEB_SEARCH_CACHE_SIZE', '512'))
+WEB_SEARCH_CACHE_TTL = int(os.getenv('WEB_SEARCH_CACHE_TTL', '600'))
+WEB_SEARCH_TIMEOUT = float(os.getenv('WEB_SEARCH_TIMEOUT', '5'))
+RAG_WEB_SEARCH = os.getenv('RAG_WEB_SEARCH', 'false').lower() in ('1', 'true', 'yes')
+
+search_service = SearchService(search_web, cache_size=WEB_SEARCH_CACHE_SIZE,
+                               cache_ttl=WEB_SEARCH_CACHE_TTL, timeout=WEB_SEARCH_TIMEOUT)
+
+def use_web_search(web_param=None):
+    """请求用 web=1/0 指定是否附带网络搜索结果，未指定时按 RAG_WEB_SEARCH"""
+    if web_param is None:
+        return RAG_WEB_SEARCH
+    return web_param.lower() in ('1', 'true', 'yes')
+
+# /api/chat 服务端会话：发给模型的历史 token 上限、会话数量上限和过期秒数，以及生成摘要的服务商
+CHAT_HISTORY_BUDGET = int(os.getenv('CHAT_HISTORY_BUDGET', '3000'))
+CHAT_SESSION_MAX = int(os.getenv('CHAT_SESSION_MAX', '10000'))
+CHAT_SESSION_TTL = int(os.getenv('CHAT_SESSION_TTL', '86400'))
+CHAT_SUMMARY_PROVIDER = os.getenv('CHAT_SUMMARY_PROVIDER', 'zhipu')
+
+SUMMARY_PROMPT = """请把下面的对话并入已有摘要，输出一段新的摘要。
+保留用户的目标、已经给出的结论、关键的数字和公式，以及尚未解决的问题，省略寒暄和重复内容。
+只输出摘要本身。"""
+
+def summarize_history(summary, messages):
+    """调用模型把较早的对话折叠进滚动摘要"""
+    name = CHAT_SUMMARY_PROVIDER if CHAT_SUMMARY_PROVIDER in providers else next(
+        (name for name in CHAT_MODELS if name in providers), None)
+    if name is None:
+        raise ValueError("No provider configured for summarization")
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    response = providers[name].complete(
+        model=CHAT_MODELS[name],
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"已有摘要：\n{summary or '无'}\n\n对话：\n{transcript}"}
+        ],
+        max_tokens=512,
+        temperature=0.3
+    )
+    return response.choices[0].message.content
+
+conversations = ConversationStore(maxsize=CHAT_SESSION_MAX, ttl=CHAT_SESSION_TTL)
+history_compactor = HistoryCompactor(summarize_history, budget=CHAT_HISTORY_BUDGET)
+
+class ConversationNotFound(Exception):
+    pass
+
+def prepare_chat_messages(data, model):
+    """
+    解析 /api/chat 的请求体，返回 (发给模型的消息, 会话, 本轮新消息)
+    带 conversation_id 或 message 时使用服务端会话，客户端只发送本轮的消息；
+    否则沿用客户端发送的完整 messages，会话为 None
+    """
+    conversation_id = data.get('conversation_id')
+    if not conversation_id and 'message' not in data:
+        return [{"role": msg["role"], "content": msg["content"]} for msg in data['messages']], None, None
+
+    if conversation_id:
+        conversation = conversations.get(conversation_id)
+        if conversation is None:
+            raise ConversationNotFound(conversation_id)
+    else:
+        conversation = conversations.create(model)
+
+    if 'message' in data:
+        message = data['message']
+        new_turn = [message if isinstance(message, dict) else {"role": "user", "content": message}]
+    else:
+        new_turn = data.get('messages') or []
+    new_turn = [{"role": msg["role"], "content": msg["content"]} for msg in new_turn]
+    return history_compactor.compact(conversation, new_turn), conversation, new_turn
+
+def finish_chat_turn(conversation, new_turn, answer):
+    """把本轮消息和回答写入会话，并在后台提前折叠较早的历史"""
+    if conversation is None or not answer:
+        return
+    conversation.append(*new_turn, {"role": "assistant", "content": answer})
+    history_compactor.schedule(conversation)
+
+def build_rag_messages(question, web=False, model=''):
+    """
+    检索相关文档并构建提示，返回 (messages, 系统提示模板, 检索上下文)
+    web 为 True 时网络搜索与向量检索同时进行，结果追加到上下文末尾
+    """
+    web_future = search_service.submit(question) if web else None
+
+    # 使用向量存储检索候选文本块，重复的问题直接命中缓存
+    web_results = []
+    with metrics.RETRIEVAL_SECONDS.time('/index', model):
+        docs = vector_index.search_with_scores(question, k=RAG_FETCH_K)
+        if web_future is not None:
             try:
-                with open(os.path.join(DOCS_DIR, filename), 'r', encoding='utf-8') as f:
-                    text = f.read()
-                    documents.extend(text_splitter.split_text(text))
+                web_results = web_future.result(WEB_SEARCH_TIMEOUT)
             except Exception as e:
-                print(f"Error processing file {filename}: {str(e)}")
-    
-    if documents:
+                logger.warning("Web search skipped: %s", e)
+
+    # 合并相邻块、去掉重复内容，按 token 预算装入上下文
+    with metrics.PROMPT_BUILD_SECONDS.time('/index', model):
+        context = "\n".join(context_packer.pack(docs))
+        if web_results:
+            context = "\n".join(filter(None, [context, "网络搜索结果：\n" + format_results(web_results)]))
+        if context:
+            system_prompt = RAG_SYSTEM_PROMPT
+        else:
+            # 如果没有向量存储，使用普通对话
+            system_prompt = DEFAULT_SYSTEM_PROMPT
+        messages = [
+            {"role": "system", "content": system_prompt + context},
+            {"role": "user", "content": question}
+        ]
+    return messages, system_prompt, context
+
+def open_stream(model, slot, messages, model_names, options):
+    """
+    打开上游流式响应；model=auto 时交给路由器选择服务商，此时 slot 为 None
+    """
+    if model == AUTO_MODEL:
+        response, _ = router.stream({
+            name: dict(model=model_names[name], messages=messages, **options[name])
+            for name in model_names if name in providers
+        })
+        return response
+    return providers[model].stream(slot, model=model_names[model], messages=messages, **options[model])
+
+# 流式响应的公共响应头
+SSE_HEADERS = {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'Access-Control-Allow-Origin': 'http://localhost:5173',
+    'Access-Control-Allow-Credentials': 'true',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, Accept-Encoding, Accept, Origin, Last-Event-ID',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Expose-Headers': 'X-Stream-Id',
+    'X-Accel-Buffering': 'no'
+}
+
+# /index 流式输出的刷新策略：immediate、interval 或 bytes，bytes 策略下待发送的文本滞留超过 SSE_FLUSH_INTERVAL_MS 时也会成帧
+SSE_FLUSH_POLICY = os.getenv('SSE_FLUSH_POLICY', 'interval')
+SSE_FLUSH_INTERVAL = float(os.getenv('SSE_FLUSH_INTERVAL_MS', '50')) / 1000
+SSE_FLUSH_BYTES = int(os.getenv('SSE_FLUSH_BYTES', '256'))
+
+# 可续传的流：保存的流数量、过期秒数和每个流保留的帧数
+stream_registry = StreamRegistry(
+    maxsize=int(os.getenv('SSE_RESUME_STREAMS', '1000')),
+    ttl=int(os.getenv('SSE_RESUME_TTL', '600')),
+    max_frames=int(os.getenv('SSE_RESUME_MAX_FRAMES', '4096')),
+)
+
+# 相同的进行中问题合并为一次上游调用，默认开启；请求带 cache=0 时不合并
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+def flight_key(endpoint, model, system_prompt, context, question, cache_param='1'):
+    """
+    合并请求的键：接口、模型、问题和检索上下文都相同的请求共用一次生成，
+    不合并时返回 None
+    """
+    if not SINGLE_FLIGHT_ENABLED or cache_param == '0':
+        return None
+    return content_hash(endpoint, model, system_prompt, content_hash(context), normalize_question(question))
+
+def join_stream(key, headers, endpoint, model):
+    """
+    键为 key 的流正在生成时返回 (该流的缓冲, False)，调用方用 follow_response 订阅；
+    否则返回 (新缓冲, True)，调用方作为 leader 调用上游后用 produce_response 写入，失败时 abandon
+    headers 为同一个流的所有响应共用的响应头
+    """
+    return stream_registry.lead(key, endpoint=endpoint, model=model,
+                                headers={'Content-Type': 'text/event-stream', **headers})
+
+def buffer_response(buffer, after=0, headers=None):
+    """订阅缓冲中序号 after 之后的帧，headers 为本次请求特有的响应头"""
+    events = metrics.track_disconnects(buffer.events(after), buffer.info['endpoint'], buffer.info['model'])
+    return Response(events, headers={**buffer.info['headers'], **(headers or {}), 'X-Stream-Id': buffer.stream_id})
+
+def produce_response(buffer, frames, headers=None):
+    """
+    在后台线程中生成 frames 并写入帧缓冲，响应只订阅缓冲：客户端断开后生成继续，
+    之后可凭 Last-Event-ID 续传
+    """
+    stream_registry.produce(buffer, frames)
+    return buffer_response(buffer, headers=headers)
+
+def follow_response(buffer, headers=None):
+    """合并到进行中的流：先补发已生成的帧，再随 leader 实时输出"""
+    metrics.REQUESTS_TOTAL.inc(buffer.info['endpoint'], buffer.info['model'], 'coalesced')
+    return buffer_response(buffer, headers=headers)
+
+def stream_response(frames, headers, endpoint, model):
+    """不参与合并的流"""
+    buffer, _ = join_stream(None, headers, endpoint, model)
+    return produce_response(buffer, frames)
+
+def resume_stream(last_event_id, endpoint):
+    """
+    带 Last-Event-ID 的请求续传原来的流：重放之后的帧并继续实时输出，不重新检索也不调用上游
+    不是续传请求时返回 None，流已过期时返回 410
+    """
+    try:
+        resumed = stream_registry.resume(last_event_id)
+    except FramesEvicted:
+        return jsonify({'error': 'Stream expired, please ask again'}), 410
+    if resumed is None:
+        return None
+    buffer, after = resumed
+    if buffer.info['endpoint'] != endpoint:
+        return jsonify({'error': 'Stream belongs to another endpoint'}), 400
+    metrics.REQUESTS_TOTAL.inc(endpoint, buffer.info['model'], 'resumed')
+    return buffer_response(buffer, after)
+
+def new_sse_stream():
+    return SSEStream(policy=SSE_FLUSH_POLICY, interval=SSE_FLUSH_INTERVAL,
+                     max_bytes=SSE_FLUSH_BYTES, emojis=EMOJIS)
+
+def iter_deltas(response):
+    """从上游流式响应中取出非空的增量文本，单个分片出错时跳过"""
+    for chunk in response:
         try:
-            # 创建向量存储
-            vector_store = FAISS.from_texts(documents, embeddings)
-            print("Vector store initialized successfully")
-        except Exception as e:
-            print(f"Error initializing vector store: {str(e)}")
-            vector_store = None
+            content = getattr(chunk.choices[0].delta, 'content', None)
+            if content:
+                yield content
+        except Exception as chunk_error:
+            logger.warning("Error processing chunk: %s", chunk_error)
 
 def preprocess_text(text):
     """
@@ -147,9 +531,14 @@ def chat_api():
         response.headers['Access-Control-Allow-Origin'] = 'http://localhost:5173'
         response.headers['Access-Control-Allow-Credentials'] = 'true'
         response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Accept-Encoding, Accept, Origin'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Accept-Encoding, Accept, Origin, Last-Event-ID'
         return response
 
+    # 断线重连时从缓冲续传
+    resumed = resume_stream(request.headers.get('Last-Event-ID'), '/index')
+    if resumed is not None:
+        return resumed
+
     if request.method == 'GET':
         question = request.args.get('question')
     elif request.is_json:
@@ -165,127 +554,126 @@ def chat_api():
     if not question:
         return jsonify({'error': 'Question is required'}), 400
 
-    def generate():
-        try:
-            print("Starting stream generation...")
-            
-            if vector_store is not None:
-                # 使用向量存储检索相关文档
-                docs = vector_store.similarity_search(question, k=3)
-                context = "\n".join([doc.page_content for doc in docs])
-                
-                # 构建带有上下文的提示
-                messages = [
-                    {"role": "system", "content": """你是一个智能助手。请基于以下参考资料回答问题。如果问题与参考资料无关，你可以基于自己的知识回答。
+    model = request.args.get('model', 'zhipu')  # 默认使用智谱AI模型
+    use_cache = use_answer_cache(request.args.get('cache', '1'))
+    web = use_web_search(request.args.get('web'))
 
-在回答涉及数学内容时，请遵循以下规则：
-1. 使用简单直观的符号表示数学公式，避免复杂的LaTeX格式
-2. 对于简单的数学符号，直接使用Unicode字符（如：×, ÷, ±, ≤, ≥, α, β, λ等）
-3. 对于上下标，使用简单的形式（如：x₁, x², aᵢ等）
-4. 分数使用斜杠表示（如：a/b）
-5. 避免使用复杂的LaTeX环境和命令
+    # 根据选择的模型调用不同的API
+    if model == AUTO_MODEL:
+        model_name = AUTO_MODEL
+        provider = None
+    else:
+        model_name = INDEX_MODELS.get(model)
+        if model_name is None:
+            return jsonify({'error': 'Invalid model selection'}), 400
+        provider = get_provider(model)
 
-参考资料：
-""" + context},
-                    {"role": "user", "content": question}
-                ]
-            else:
-                # 如果没有向量存储，使用普通对话
-                messages = [
-                    {"role": "system", "content": """你是一个智能助手，可以帮助用户解答问题。
+    # 先检索并查找回答缓存，命中时不占用服务商名额；
+    # 问题和检索上下文都相同的进行中请求合并为一次上游调用
+    store_answer = None
+    try:
+        messages, system_prompt, context = build_rag_messages(question, web, model)
+        if use_cache:
+            cached, store_answer = lookup_answer(model_name, system_prompt, context, question)
+            if cached is not None:
+                metrics.REQUESTS_TOTAL.inc('/index', model, 'cache_hit')
+                def replay():
+                    yield START_FRAME
+                    for piece in replay_chunks(cached):
+                        yield content_frame(piece)
+                    yield DONE_FRAME
+                return stream_response(replay(), SSE_HEADERS, '/index', model)
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+        metrics.REQUESTS_TOTAL.inc('/index', model, 'error')
+        buffer, _ = join_stream(None, SSE_HEADERS, '/index', model)
+        stream_registry.abandon(buffer, [error_frame(str(e)), DONE_FRAME])
+        return buffer_response(buffer)
 
-在回答涉及数学内容时，请遵循以下规则：
-1. 使用简单直观的符号表示数学公式，避免复杂的LaTeX格式
-2. 对于简单的数学符号，直接使用Unicode字符（如：×, ÷, ±, ≤, ≥, α, β, λ等）
-3. 对于上下标，使用简单的形式（如：x₁, x², aᵢ等）
-4. 分数使用斜杠表示（如：a/b）
-5. 避免使用复杂的LaTeX环境和命令"""},
-                    {"role": "user", "content": question}
-                ]
-            
-            model = request.args.get('model', 'zhipu')  # 默认使用智谱AI模型
-            
-            # 根据选择的模型调用不同的API
-            if model == 'zhipu':
-                # 智谱AI的处理逻辑
-                response = client.chat.completions.create(
-                    model="glm-4v-flash",
-                    messages=messages,
-                    stream=True,
-                    temperature=0.7,
-                )
-            elif model == 'deepseek':
-                # Deepseek的处理逻辑
-                response = deepseek_client.chat.completions.create(
-                    model="deepseek-chat",
-                    messages=messages,
-                    max_tokens=1024,
-                    temperature=0.7,
-                    stream=True
-                )
-            else:
-                return jsonify({'error': 'Invalid model selection'}), 400
+    key = flight_key('/index', model, system_prompt, context, question, request.args.get('cache', '1'))
+    buffer, leader = join_stream(key, SSE_HEADERS, '/index', model)
+    if not leader:
+        return follow_response(buffer)
 
-            initial_data = 'data: {"content": "", "done": false}\n\n'
-            yield initial_data
-            
-            full_response = ""
-            chunk_count = 0
+    # 在开始流式响应前申请名额，服务商繁忙时直接返回 429/503
+    try:
+        slot = provider.admit() if provider is not None else None
+    except ProviderBusy as e:
+        stream_registry.abandon(buffer, [error_frame(str(e)), DONE_FRAME])
+        return provider_busy_response(e)
+
+    def generate():
+        timer = None
+        try:
+            timer = metrics.StreamTimer('/index', model)
+            response = open_stream(model, slot, messages, INDEX_MODELS, INDEX_REQUEST_OPTIONS)
+
+            yield START_FRAME
             
-            for chunk in response:
-                try:
-                    chunk_count += 1
-                    if hasattr(chunk.choices[0].delta, 'content'):
-                        content = chunk.choices[0].delta.content
-                        if content:
-                            try:
-                                content_stripped = content.rstrip()
-                                if content_stripped:
-                                    is_sentence_end = content_stripped[-1] in ["。", "！", "？"]
-                                    if is_sentence_end and random.random() < 0.2:
-                                        content += random.choice(EMOJIS)
-                            except IndexError as e:
-                                print(f"Error processing content for emoji: {e}")
-                            
-                            full_response += content
-                            data = json.dumps({
-                                'content': content,
-                                'done': False
-                            }, ensure_ascii=False)
-                            yield f"data: {data}\n\n"
-                            time.sleep(0.05)
-                except Exception as chunk_error:
-                    print(f"Error processing chunk: {chunk_error}")
-                    continue
+            # 输出阶段负责追加 emoji 和按策略合并帧
+            stream = new_sse_stream()
+            yield from stream.frames(timer.track(iter_deltas(response)))
                 
-            print(f"Stream completed. Total chunks: {chunk_count}")
+            logger.debug("Stream completed. Total frames: %d", stream.frames_sent)
+            if store_answer is not None:
+                store_answer(stream.text)
                 
         except Exception as e:
-            print(f"Error occurred: {str(e)}")
-            error_data = json.dumps({'error': str(e)}, ensure_ascii=False)
-            yield f"data: {error_data}\n\n"
+            logger.error("Error occurred: %s", e)
+            if timer is not None:
+                timer.finish('error')
+            else:
+                metrics.REQUESTS_TOTAL.inc('/index', model, 'error')
+            yield error_frame(str(e))
         finally:
+            if slot is not None:
+                slot.release()
             try:
-                final_data = json.dumps({"content": "", "done": True}, ensure_ascii=False)
-                yield f'data: {final_data}\n\n'
+                yield DONE_FRAME
             except Exception as final_error:
-                print(f"Error sending final data: {final_error}")
-
-    headers = {
-        'Content-Type': 'text/event-stream',
-        'Cache-Control': 'no-cache',
-        'Connection': 'keep-alive',
-        'Access-Control-Allow-Origin': 'http://localhost:5173',
-        'Access-Control-Allow-Credentials': 'true',
-        'Access-Control-Allow-Headers': 'Content-Type, Authorization, Accept-Encoding, Accept, Origin',
-        'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-        'X-Accel-Buffering': 'no'
-    }
-    
-    return Response(
-        stream_with_context(generate()),
-        headers=headers
-    )
+                logger.error("Error sending final data: %s", final_error)
+
+    # 生成在后台进行，客户端断开不会中止上游请求
+    return produce_response(buffer, generate())
+
+@app.route('/api/index/stats', methods=['GET'])
+def index_stats():
+    """向量索引、检索缓存、查询向量批处理、上下文组装及上传索引队列的统计信息"""
+    return jsonify({**vector_index.stats(), 'context_packer': context_packer.stats(),
+                    'query_batcher': query_batcher.stats() if EMBED_BATCHING else None,
+                    'index_queue': index_queue.stats()})
+
+@app.route('/api/index/jobs/<job_id>', methods=['GET'])
+def index_job_status(job_id):
+    """上传后索引任务的状态：queued、indexing（附进度）、done 或 failed"""
+    job = index_queue.job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """回答缓存、图片缓存、网络搜索缓存和可续传流缓冲的统计信息"""
+    return jsonify({
+        'enabled': ANSWER_CACHE_ENABLED,
+        'answer_cache': answer_cache.stats(),
+        'image_cache': image_preprocessor.cache.stats(),
+        'web_search': search_service.stats(),
+        'streams': stream_registry.stats(),
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 文本格式的请求延迟指标"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/providers/stats', methods=['GET'])
+def providers_stats():
+    """各服务商的并发与准入统计，以及自动路由的延迟统计"""
+    return jsonify({
+        'providers': {name: provider.gate.stats() for name, provider in providers.items()},
+        'router': router.stats(),
+    })
 
 @app.route('/upload', methods=['POST', 'OPTIONS'])
 def upload_document():
@@ -293,46 +681,35 @@ def upload_document():
         return '', 204
 
     try:
-        print("Received upload request")
-        
         if 'file' not in request.files:
-            print("No file part in request")
+            logger.info("Upload rejected: no file part in request")
             return jsonify({'error': 'No file part'}), 400
         
         file = request.files['file']
-        print(f"Received file: {file.filename}")
         
         if file.filename == '':
-            print("No selected file")
+            logger.info("Upload rejected: no selected file")
             return jsonify({'error': 'No selected file'}), 400
         
         if not file.filename.endswith('.txt'):
-            print("Invalid file type")
+            logger.info("Upload rejected: invalid file type %s", file.filename)
             return jsonify({'error': 'Only .txt files are supported'}), 400
         
         # 确保docs目录存在
         if not os.path.exists(DOCS_DIR):
-            print(f"Creating docs directory: {DOCS_DIR}")
+            logger.info("Creating docs directory: %s", DOCS_DIR)
             os.makedirs(DOCS_DIR)
         
         # 保存文件
         file_path = os.path.join(DOCS_DIR, file.filename)
-        print(f"Saving file to: {file_path}")
         file.save(file_path)
-        print(f"File saved successfully: {file_path}")
+        logger.info("File saved: %s", file_path)
         
-        # 重新初始化向量存储
-        print("Initializing vector store...")
-        initialize_vector_store()
-        print("Vector store initialization completed")
-        
-        response = jsonify({'message': 'File uploaded and processed successfully'})
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-        return response, 200
+        # 向量索引由后台任务增量更新，连续上传的文件合并到同一次更新
+        return index_job_response(file.filename, 'File uploaded, indexing queued')
         
     except Exception as e:
-        print(f"Upload error: {str(e)}")
+        logger.error("Upload error: %s", e)
         error_response = jsonify({'error': str(e)})
         error_response.headers.add('Access-Control-Allow-Origin', '*')
         error_response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
@@ -369,15 +746,16 @@ def upload_knowledge():
                 # 保存到docs目录
                 file_path = os.path.join(DOCS_DIR, filename)
                 file.save(file_path)
-                print(f"文件已保存到: {file_path}")  # 添加日志
-                return jsonify({'message': '文件上传成功', 'filename': filename}), 200
+                logger.info("文件已保存到: %s", file_path)
+                # 提取文本和更新向量存储由后台任务完成
+                return index_job_response(filename, '文件上传成功，正在建立索引')
             except Exception as e:
-                print(f"保存文件时出错: {str(e)}")  # 添加错误日志
+                logger.error("保存文件时出错: %s", e)
                 return jsonify({'error': f'保存文件时出错: {str(e)}'}), 500
         
         return jsonify({'error': '不支持的文件类型'}), 400
     except Exception as e:
-        print(f"上传处理时出错: {str(e)}")  # 添加错误日志
+        logger.error("上传处理时出错: %s", e)
         return jsonify({'error': f'服务器错误: {str(e)}'}), 500
 
 @app.route('/chat')
@@ -392,40 +770,58 @@ def search():
         if not query:
             return jsonify({'error': 'No query provided'}), 400
         
-        results = search_web(query)
+        # 可以传入多个查询或要求自动改写，并发搜索后合并去重
+        queries = data.get('queries') or []
+        if data.get('rewrite'):
+            results = search_service.submit(query).result()
+        elif queries:
+            results = search_service.search_many([query] + [q for q in queries if q != query])
+        else:
+            results = search_service.search(query)
         return jsonify({'results': results})
+    except TimeoutError:
+        return jsonify({'error': 'Search timed out'}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# SMTP 配置，本地调试时可指向替身服务器并关闭 TLS
+SMTP_SERVER = os.getenv('SMTP_SERVER', 'localhost')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '25'))
+SMTP_USERNAME = os.getenv('SMTP_USERNAME', '')
+SMTP_PASSWORD = os.getenv('SMTP_PASSWORD', '')
+SMTP_USE_TLS = os.getenv('SMTP_USE_TLS', 'true').lower() in ('1', 'true', 'yes')
+
+# 后台发送队列，复用同一个已登录的 SMTP 连接
+email_queue = EmailQueue(
+    SMTP_SERVER, SMTP_PORT,
+    username=SMTP_USERNAME, password=SMTP_PASSWORD, use_tls=SMTP_USE_TLS,
+    maxsize=int(os.getenv('EMAIL_QUEUE_SIZE', '1000')),
+    batch_size=int(os.getenv('EMAIL_BATCH_SIZE', '50')),
+)
+
 @app.route('/api/send-email', methods=['POST'])
 def handle_send_email():
-    """处理邮件发送请求"""
+    """处理邮件发送请求：入队后立即返回，由后台线程发送"""
     try:
         data = request.get_json()
         email_request = EmailRequest(**data)
         
-        # 同步方式调用邮件发送函数
-        send_email_sync(email_request)
-        return jsonify({"status": "success", "message": "邮件发送成功"})
+        job_id = email_queue.submit(create_email_message(email_request))
+        return jsonify({"status": "queued", "message": "邮件已加入发送队列", "id": job_id}), 202
+    except EmailQueueFull as e:
+        return jsonify({"status": "error", "message": str(e)}), 503
     except Exception as e:
-        print(f"Error sending email: {str(e)}")
+        logger.error("Error sending email: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
-def send_email_sync(email_request: EmailRequest):
-    """同步方式发送邮件"""
-    try:
-        msg = create_email_message(email_request)
-        
-        # 连接SMTP服务器
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()  # 启用TLS加密
-            server.login(SMTP_USERNAME, SMTP_PASSWORD)
-            server.send_message(msg)
-        
-        return True
-    except Exception as e:
-        print(f"发送邮件时出错: {str(e)}")
-        raise e
+@app.route('/api/email/status', methods=['GET'])
+def email_status():
+    """发送队列的状态；带 id 参数时同时返回该邮件的发送状态"""
+    result = email_queue.stats()
+    job_id = request.args.get('id')
+    if job_id:
+        result['job'] = {'id': job_id, 'status': email_queue.jobs.get(job_id, 'unknown')}
+    return jsonify(result)
 
 def create_email_message(email_request: EmailRequest):
     """创建邮件消息"""
@@ -441,54 +837,113 @@ def chat():
     if request.method == 'OPTIONS':
         response = make_response()
         response.headers.add('Access-Control-Allow-Origin', request.headers.get('Origin', ''))
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Last-Event-ID')
         response.headers.add('Access-Control-Allow-Methods', 'POST')
         response.headers.add('Access-Control-Allow-Credentials', 'true')
         return response
 
+    # 断线重连时从缓冲续传
+    resumed = resume_stream(request.headers.get('Last-Event-ID'), '/api/chat')
+    if resumed is not None:
+        return resumed
+
     try:
         data = request.json
-        if not data or 'messages' not in data:
+        if not data or ('messages' not in data and 'message' not in data):
             return jsonify({'error': 'Messages are required'}), 400
 
-        messages = data['messages']
         model = data.get('model', 'zhipu')  # 默认使用 zhipu 模型
 
         # 检查客户端是否已初始化
-        if model == 'zhipu' and not client:
-            return jsonify({'error': 'Zhipu API key not configured'}), 500
-        elif model == 'deepseek' and not deepseek_client:
-            return jsonify({'error': 'Deepseek API key not configured'}), 500
+        if model != AUTO_MODEL:
+            if model not in CHAT_MODELS:
+                return jsonify({'error': 'Invalid model selection'}), 400
+            get_provider(model)
+
+        # 服务端会话只接收本轮消息，历史按 token 预算压缩后再发给模型
+        try:
+            with metrics.PROMPT_BUILD_SECONDS.time('/api/chat', model):
+                messages, conversation, new_turn = prepare_chat_messages(data, model)
+        except ConversationNotFound:
+            return jsonify({'error': 'Conversation not found'}), 404
+        model_name = CHAT_MODELS.get(model, model)
+        headers = {'X-Conversation-Id': conversation.id} if conversation is not None else {}
+
+        # 以最后一条用户消息为问题、之前的对话为上下文查找回答缓存
+        store_answer = None
+        if use_answer_cache(request.args.get('cache', '1')) and messages and messages[-1]["role"] == "user":
+            cached, store_answer = lookup_answer(model_name, "", messages[:-1], messages[-1]["content"])
+            if cached is not None:
+                metrics.REQUESTS_TOTAL.inc('/api/chat', model, 'cache_hit')
+                finish_chat_turn(conversation, new_turn, cached)
+                def replay():
+                    for piece in replay_chunks(cached):
+                        yield f"data: {piece}\n\n"
+                    yield "data: [DONE]\n\n"
+                return stream_response(replay(), headers, '/api/chat', model)
+
+        # 之前的对话和最后一条用户消息都相同的进行中请求合并，各自的回答在流结束后写入各自的会话
+        key = None
+        if messages and messages[-1]["role"] == "user":
+            key = flight_key('/api/chat', model, "", messages[:-1], messages[-1]["content"],
+                             request.args.get('cache', '1'))
+        buffer, leader = join_stream(key, {}, '/api/chat', model)
+        if not leader:
+            buffer.add_done_callback(lambda done: finish_chat_turn(conversation, new_turn, done.result))
+            return follow_response(buffer, headers)
 
         # 根据选择的模型使用不同的 API
-        if model == 'zhipu':
-            response = client.chat.completions.create(
-                model="glm-4",
-                messages=[{"role": msg["role"], "content": msg["content"]} for msg in messages],
-                temperature=0.7,
-                stream=True
-            )
-        elif model == 'deepseek':
-            response = deepseek_client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[{"role": msg["role"], "content": msg["content"]} for msg in messages],
-                temperature=0.7,
-                stream=True,
-                max_tokens=1024
-            )
+        timer = None
+        try:
+            slot = providers[model].admit() if model != AUTO_MODEL else None
+            timer = metrics.StreamTimer('/api/chat', model)
+            response = open_stream(model, slot, messages, CHAT_MODELS, CHAT_REQUEST_OPTIONS)
+        except Exception as e:
+            if timer is not None:
+                timer.finish('error')
+            # 合并到本请求的跟随者收到错误帧和结束标记，不会被当成空回答
+            stream_registry.abandon(buffer, [error_frame(str(e)), "data: [DONE]\n\n"])
+            raise
             
         def generate():
-            for chunk in response:
-                if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content is not None:
-                    yield f"data: {chunk.choices[0].delta.content}\n\n"
+            full_response = ""
+            for content in timer.track(iter_deltas(response)):
+                full_response += content
+                yield f"data: {content}\n\n"
+            if store_answer is not None:
+                store_answer(full_response)
+            finish_chat_turn(conversation, new_turn, full_response)
+            buffer.result = full_response
             yield "data: [DONE]\n\n"
 
-        return Response(generate(), mimetype='text/event-stream')
+        return produce_response(buffer, generate(), headers)
 
+    except ProviderBusy as e:
+        return provider_busy_response(e)
     except Exception as e:
-        print(f"Error in chat endpoint: {str(e)}")
+        logger.error("Error in chat endpoint: %s", e)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/chat/sessions/<conversation_id>', methods=['GET', 'DELETE'])
+def chat_session(conversation_id):
+    """查看或删除服务端保存的对话"""
+    if request.method == 'DELETE':
+        if not conversations.delete(conversation_id):
+            return jsonify({'error': 'Conversation not found'}), 404
+        return jsonify({'message': 'Conversation deleted'})
+    conversation = conversations.get(conversation_id)
+    if conversation is None:
+        return jsonify({'error': 'Conversation not found'}), 404
+    return jsonify(conversation.as_dict())
+
+@app.route('/api/chat/stats', methods=['GET'])
+def chat_stats():
+    """服务端会话数量和历史压缩的统计信息"""
+    return jsonify({
+        'sessions': conversations.stats(),
+        'compactor': history_compactor.stats(),
+    })
+
 @app.route('/chat_with_image', methods=['POST', 'OPTIONS'])
 def chat_with_image():
     if request.method == 'OPTIONS':
@@ -500,56 +955,34 @@ def chat_with_image():
         return response
 
     try:
-        print("Received chat_with_image request")
-        print("Files:", request.files)
-        print("Form:", request.form)
-        
         if 'image' not in request.files:
-            print("No image file in request")
+            logger.info("chat_with_image rejected: no image file in request")
             return jsonify({'error': '请提供图片'}), 400
             
         if 'question' not in request.form:
-            print("No question in request")
+            logger.info("chat_with_image rejected: no question in request")
             return jsonify({'error': '请提供问题'}), 400
 
         image_file = request.files['image']
         question = request.form['question']
         
         if not image_file:
-            print("Empty image file")
+            logger.info("chat_with_image rejected: empty image file")
             return jsonify({'error': '图片文件为空'}), 400
-        
-        print(f"Processing image: {image_file.filename}")
-        print(f"Question: {question}")
 
         # 读取图片并转换为base64
         try:
-            image = Image.open(image_file)
-            print(f"Image mode: {image.mode}, size: {image.size}")
-            
-            # 统一转换为RGB模式
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-                print("Converted image to RGB mode")
-            
-            # 调整图片大小以适应API限制
-            max_size = (1024, 1024)
-            image.thumbnail(max_size, Image.Resampling.LANCZOS)
-            print(f"Resized image to: {image.size}")
-            
-            # 将图片转换为base64
-            buffered = io.BytesIO()
-            image.save(buffered, format="JPEG", quality=85)
-            img_str = base64.b64encode(buffered.getvalue()).decode()
-            print("Successfully converted image to base64")
-            print(f"Base64 string length: {len(img_str)}")
+            # 解码缩放在线程池中执行，相同图片直接命中缓存
+            with metrics.IMAGE_PREP_SECONDS.time('zhipu'):
+                img_str = image_preprocessor.prepare(image_file.read())
+            logger.debug("Image %s converted, base64 length %d", image_file.filename, len(img_str))
             
         except Exception as e:
-            print(f"Error processing image: {str(e)}")
+            logger.error("Error processing image: %s", e)
+            metrics.REQUESTS_TOTAL.inc('/chat_with_image', 'zhipu', 'error')
             return jsonify({'error': f'图片处理失败: {str(e)}'}), 500
 
         try:
-            print("Preparing request to ZhipuAI")
             # 准备发送给智谱AI的消息
             messages = [
                 {
@@ -569,53 +1002,55 @@ def chat_with_image():
                 }
             ]
             
-            print("Sending request to ZhipuAI")
             # 调用智谱AI的API
-            response = client.chat.completions.create(
-                model="glm-4v-flash",  # 使用支持图像的模型
-                messages=messages,
-                max_tokens=1024,
-                temperature=0.7
-            )
-            print("Received response from ZhipuAI")
+            with metrics.UPSTREAM_REQUEST_SECONDS.time('/chat_with_image', 'zhipu'):
+                response = get_provider('zhipu').complete(
+                    model="glm-4v-flash",  # 使用支持图像的模型
+                    messages=messages,
+                    max_tokens=1024,
+                    temperature=0.7
+                )
 
             # 获取AI的回复
             ai_response = response.choices[0].message.content
-            print(f"AI Response: {ai_response}")
+            metrics.REQUESTS_TOTAL.inc('/chat_with_image', 'zhipu', 'ok')
 
             return jsonify({
                 'response': preprocess_text(ai_response)
             })
 
+        except ProviderBusy as e:
+            return provider_busy_response(e)
         except Exception as e:
-            print(f"Error calling ZhipuAI API: {str(e)}")
+            logger.error("Error calling ZhipuAI API: %s", e)
+            metrics.REQUESTS_TOTAL.inc('/chat_with_image', 'zhipu', 'error')
             error_message = str(e)
             if "API key" in error_message:
                 error_message = "API密钥无效或未设置"
             return jsonify({'error': f'调用AI服务失败: {error_message}'}), 500
 
     except Exception as e:
-        print(f"Unexpected error in chat_with_image: {str(e)}")
+        logger.error("Unexpected error in chat_with_image: %s", e)
         return jsonify({'error': f'服务器错误: {str(e)}'}), 500
 
-# 数据库相关代码
+# 数据库相关代码：连接池 + WAL，已验证的凭据和会话令牌缓存在内存中
+# 没有修改用户的接口，直接改库后旧口令最多在 DB_CREDENTIAL_TTL 秒内仍可登录
+db = Database(
+    os.getenv('DB_PATH', 'compusers.db'),
+    pool_size=int(os.getenv('DB_POOL_SIZE', '8')),
+    credential_cache_ttl=int(os.getenv('DB_CREDENTIAL_TTL', '60')),
+    session_ttl=int(os.getenv('SESSION_TTL', '86400')),
+)
+
 def init_db():
-    conn = sqlite3.connect('compusers.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS compusers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL
-        )
-    ''')
-    try:
-        c.execute("INSERT INTO compusers (username, password) VALUES (?, ?)", ("test", "test123"))
-        c.execute("INSERT INTO compusers (username, password) VALUES (?, ?)", ("admin", "admin123"))
-    except sqlite3.IntegrityError:
-        pass
-    conn.commit()
-    conn.close()
+    db.init_schema()
+
+def current_session():
+    """从 Authorization: Bearer <token> 中取出会话，无效时返回 None"""
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        return db.get_session(auth[len('Bearer '):].strip())
+    return None
 
 @app.route('/api/login', methods=['POST', 'OPTIONS'])
 def login():
@@ -630,14 +1065,12 @@ def login():
         if not username or not password:
             return jsonify({'error': 'Missing username or password'}), 400
         
-        conn = sqlite3.connect('compusers.db')
-        c = conn.cursor()
-        c.execute("SELECT * FROM compusers WHERE username = ? AND password = ?", (username, password))
-        user = c.fetchone()
-        conn.close()
+        user_id = db.verify_credentials(username, password)
         
-        if user:
-            response = jsonify({'message': 'Login successful'})
+        if user_id is not None:
+            # 签发会话令牌，后续请求凭令牌鉴权
+            token = db.create_session(user_id, username)
+            response = jsonify({'message': 'Login successful', 'token': token})
             return response
         else:
             response = jsonify({'error': 'Invalid username or password'})
@@ -649,14 +1082,89 @@ def login():
         response.headers.add('Access-Control-Allow-Origin', '*')
         return response, 500
 
+@app.route('/api/session', methods=['GET', 'DELETE'])
+def session_info():
+    """查询或注销当前会话，只访问内存"""
+    session = current_session()
+    if session is None:
+        return jsonify({'error': 'Invalid or expired session'}), 401
+    if request.method == 'DELETE':
+        db.revoke_session(request.headers['Authorization'][len('Bearer '):].strip())
+        return jsonify({'message': 'Logged out'})
+    return jsonify({'username': session['username']})
+
+@app.errorhandler(ProviderBusy)
+def handle_provider_busy(error):
+    return provider_busy_response(error)
+
 @app.errorhandler(Exception)
 def handle_error(error):
-    print(f"Global error handler: {error}")
+    logger.error("Global error handler: %s", error, exc_info=error)
     response = jsonify({'error': str(error)})
     response.headers.add('Access-Control-Allow-Origin', '*')
     return response, 500
 
-if __name__ == '__main__':
-    initialize_vector_store()
+# 启动预热在后台线程中进行，设为 false 时在启动过程中同步完成
+WARMUP_IN_BACKGROUND = os.getenv('WARMUP_IN_BACKGROUND', 'true').lower() in ('1', 'true', 'yes')
+
+# 预热状态，供 /api/ready 查询
+readiness = {'ready': False, 'error': None, 'warmup_seconds': None}
+
+def warm_up():
+    """加载向量索引和嵌入模型并创建上游客户端，完成后标记为就绪"""
+    started = time.monotonic()
+    try:
+        # 先加载磁盘上的索引，清单与文档目录一致时无需重新嵌入
+        if vector_index.load():
+            logger.info("Loaded persisted vector store version %s", vector_index.version)
+        initialize_vector_store()
+        # 其他进程上传文档后发布的新快照由后台线程发现并切换
+        vector_index.start_watcher(INDEX_POLL_INTERVAL)
+        # 执行一次嵌入，让第一个真实请求不必承担模型初始化的开销
+        embeddings.embed_query("warm up")
+        for provider in providers.values():
+            provider.warm()
+        readiness['ready'] = True
+    except Exception as e:
+        readiness['error'] = str(e)
+        logger.error("Warm-up failed: %s", e)
+    readiness['warmup_seconds'] = round(time.monotonic() - started, 3)
+    logger.info("Warm-up finished in %ss", readiness['warmup_seconds'])
+
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    """就绪检查：预热完成前返回 503，不需要 RAG 的接口在此之前即可正常使用"""
+    status = dict(readiness, embedding_model_loaded=embeddings.loaded,
+                  embedding_load_seconds=embeddings.load_seconds, vector_store_version=vector_index.version)
+    return jsonify(status), 200 if readiness['ready'] else 503
+
+def preload():
+    """
+    gunicorn 以 preload_app 启动时在主进程中调用：先加载嵌入模型权重和已发布的索引快照，
+    fork 出的 worker 以写时复制的方式共享这些内存，不必各自加载
+    ONNX Runtime 创建会话时即启动线程池，fork 后无法使用，onnx 后端仍由各 worker 自行加载
+    """
+    if EMBEDDING_BACKEND != 'onnx':
+        embeddings.load()
+    if vector_index.load():
+        logger.info("Preloaded vector store version %s", vector_index.version)
+
+_startup_lock = threading.Lock()
+_started = False
+
+def startup():
+    """进程启动时初始化数据库并开始预热，Flask 与 ASGI 入口共用，重复调用时只执行一次"""
+    global _started
+    with _startup_lock:
+        if _started:
+            return
+        _started = True
     init_db()
+    if WARMUP_IN_BACKGROUND:
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+    else:
+        warm_up()
+
+if __name__ == '__main__':
+    startup()
     app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,305 @@
+"""
+异步 ASGI 服务入口
+
+/index 和 /api/chat 由异步路由处理：上游调用使用异步客户端，回答由独立的协程任务写入帧缓冲，
+SSE 响应订阅缓冲，等待模型输出期间不占用线程，单个进程可以同时维持大量流式连接；
+断线后可凭 Last-Event-ID 续传，相同的进行中问题合并为一次上游调用（见 stream_buffer）。
+上游客户端和准入控制与 Flask 路由共用 appV2.providers，检索、嵌入等 CPU 计算放到线程池执行。
+其余路由挂载原有的 Flask 应用，行为不变。
+
+运行方式：
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+"""
+import json
+import logging
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+import appV2
+import metrics
+from answer_cache import replay_chunks
+from provider_clients import ProviderBusy
+from sse_stream import START_FRAME, DONE_FRAME, content_frame, error_frame
+from stream_buffer import FramesEvicted
+
+logger = logging.getLogger(__name__)
+
+PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': 'http://localhost:5173',
+    'Access-Control-Allow-Credentials': 'true',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, Accept-Encoding, Accept, Origin, Last-Event-ID',
+}
+
+
+def provider_busy_response(error):
+    return JSONResponse({'error': str(error)}, status_code=error.status_code,
+                        headers={'Retry-After': str(error.retry_after), 'Access-Control-Allow-Origin': '*'})
+
+
+def buffer_response(buffer, after=0, headers=None):
+    """appV2.buffer_response 的异步版本"""
+    events = metrics.atrack_disconnects(buffer.aevents(after), buffer.info['endpoint'], buffer.info['model'])
+    return StreamingResponse(events, headers={**buffer.info['headers'], **(headers or {}), 'X-Stream-Id': buffer.stream_id})
+
+
+def produce_response(buffer, frames, headers=None):
+    """appV2.produce_response 的异步版本，生产者为当前事件循环中的独立任务"""
+    appV2.stream_registry.aproduce(buffer, frames)
+    return buffer_response(buffer, headers=headers)
+
+
+def follow_response(buffer, headers=None):
+    """appV2.follow_response 的异步版本"""
+    metrics.REQUESTS_TOTAL.inc(buffer.info['endpoint'], buffer.info['model'], 'coalesced')
+    return buffer_response(buffer, headers=headers)
+
+
+def stream_response(frames, headers, endpoint, model):
+    """appV2.stream_response 的异步版本"""
+    buffer, _ = appV2.join_stream(None, headers, endpoint, model)
+    return produce_response(buffer, frames)
+
+
+def resume_stream(last_event_id, endpoint):
+    """appV2.resume_stream 的异步版本，也能续传由 Flask 路由创建的流"""
+    try:
+        resumed = appV2.stream_registry.resume(last_event_id)
+    except FramesEvicted:
+        return JSONResponse({'error': 'Stream expired, please ask again'}, status_code=410)
+    if resumed is None:
+        return None
+    buffer, after = resumed
+    if buffer.info['endpoint'] != endpoint:
+        return JSONResponse({'error': 'Stream belongs to another endpoint'}, status_code=400)
+    metrics.REQUESTS_TOTAL.inc(endpoint, buffer.info['model'], 'resumed')
+    return buffer_response(buffer, after)
+
+
+async def aopen_stream(model, slot, messages, model_names, options):
+    """appV2.open_stream 的异步版本"""
+    if model == appV2.AUTO_MODEL:
+        response, _ = appV2.router.astream({
+            name: dict(model=model_names[name], messages=messages, **options[name])
+            for name in model_names if name in appV2.providers
+        })
+        return response
+    return await appV2.providers[model].astream(
+        slot, model=model_names[model], messages=messages, **options[model])
+
+
+async def aiter_deltas(response):
+    """从异步流式响应中取出非空的增量文本，单个分片出错时跳过"""
+    async for chunk in response:
+        try:
+            content = getattr(chunk.choices[0].delta, 'content', None)
+            if content:
+                yield content
+        except Exception as chunk_error:
+            logger.warning("Error processing chunk: %s", chunk_error)
+
+
+async def index(request):
+    if request.method == 'OPTIONS':
+        return Response(headers=PREFLIGHT_HEADERS)
+
+    resumed = resume_stream(request.headers.get('last-event-id'), '/index')
+    if resumed is not None:
+        return resumed
+
+    if request.method == 'GET':
+        question = request.query_params.get('question')
+    else:
+        body = await request.body()
+        try:
+            if request.headers.get('content-type', '').startswith('application/json'):
+                question = json.loads(body).get('question')
+            else:
+                question = body.decode('utf-8')
+        except Exception:
+            return JSONResponse({'error': 'Invalid request data'}, status_code=400)
+
+    if not question:
+        return JSONResponse({'error': 'Question is required'}, status_code=400)
+
+    model = request.query_params.get('model', 'zhipu')
+    use_cache = appV2.use_answer_cache(request.query_params.get('cache', '1'))
+    web = appV2.use_web_search(request.query_params.get('web'))
+
+    if model == appV2.AUTO_MODEL:
+        model_name = appV2.AUTO_MODEL
+        provider = None
+    else:
+        model_name = appV2.INDEX_MODELS.get(model)
+        if model_name is None:
+            return JSONResponse({'error': 'Invalid model selection'}, status_code=400)
+        provider = appV2.providers.get(model)
+        if provider is None:
+            return JSONResponse({'error': f'{model} API key not configured'}, status_code=500)
+
+    store_answer = None
+    try:
+        messages, system_prompt, context = await run_in_threadpool(appV2.build_rag_messages, question, web, model)
+        if use_cache:
+            cached, store_answer = await run_in_threadpool(
+                appV2.lookup_answer, model_name, system_prompt, context, question)
+            if cached is not None:
+                metrics.REQUESTS_TOTAL.inc('/index', model, 'cache_hit')
+                async def replay():
+                    yield START_FRAME
+                    for piece in replay_chunks(cached):
+                        yield content_frame(piece)
+                    yield DONE_FRAME
+                return stream_response(replay(), appV2.SSE_HEADERS, '/index', model)
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+        metrics.REQUESTS_TOTAL.inc('/index', model, 'error')
+        buffer, _ = appV2.join_stream(None, appV2.SSE_HEADERS, '/index', model)
+        appV2.stream_registry.abandon(buffer, [error_frame(str(e)), DONE_FRAME])
+        return buffer_response(buffer)
+
+    key = appV2.flight_key('/index', model, system_prompt, context, question, request.query_params.get('cache', '1'))
+    buffer, leader = appV2.join_stream(key, appV2.SSE_HEADERS, '/index', model)
+    if not leader:
+        return follow_response(buffer)
+
+    try:
+        slot = await provider.admit_async() if provider is not None else None
+    except ProviderBusy as e:
+        appV2.stream_registry.abandon(buffer, [error_frame(str(e)), DONE_FRAME])
+        return provider_busy_response(e)
+
+    async def generate():
+        timer = None
+        try:
+            timer = metrics.StreamTimer('/index', model)
+            response = await aopen_stream(model, slot, messages, appV2.INDEX_MODELS, appV2.INDEX_REQUEST_OPTIONS)
+            yield START_FRAME
+
+            stream = appV2.new_sse_stream()
+            async for frame in stream.aframes(timer.atrack(aiter_deltas(response))):
+                yield frame
+
+            if store_answer is not None:
+                store_answer(stream.text)
+        except Exception as e:
+            logger.error("Error occurred: %s", e)
+            if timer is not None:
+                timer.finish('error')
+            else:
+                metrics.REQUESTS_TOTAL.inc('/index', model, 'error')
+            yield error_frame(str(e))
+        finally:
+            if slot is not None:
+                slot.release()
+            yield DONE_FRAME
+
+    return produce_response(buffer, generate())
+
+
+async def chat(request):
+    if request.method == 'OPTIONS':
+        return Response(headers={
+            'Access-Control-Allow-Origin': request.headers.get('origin', ''),
+            'Access-Control-Allow-Headers': 'Content-Type, Last-Event-ID',
+            'Access-Control-Allow-Methods': 'POST',
+            'Access-Control-Allow-Credentials': 'true',
+        })
+
+    resumed = resume_stream(request.headers.get('last-event-id'), '/api/chat')
+    if resumed is not None:
+        return resumed
+
+    try:
+        data = await request.json()
+        if not data or ('messages' not in data and 'message' not in data):
+            return JSONResponse({'error': 'Messages are required'}, status_code=400)
+
+        model = data.get('model', 'zhipu')
+        model_name = appV2.CHAT_MODELS.get(model, model)
+        # 状态码与 Flask 路由一致：未知模型 400，未配置密钥 500
+        if model != appV2.AUTO_MODEL:
+            if model not in appV2.CHAT_MODELS:
+                return JSONResponse({'error': 'Invalid model selection'}, status_code=400)
+            if model not in appV2.providers:
+                return JSONResponse({'error': f'{model} API key not configured'}, status_code=500)
+
+        try:
+            with metrics.PROMPT_BUILD_SECONDS.time('/api/chat', model):
+                messages, conversation, new_turn = await run_in_threadpool(appV2.prepare_chat_messages, data, model)
+        except appV2.ConversationNotFound:
+            return JSONResponse({'error': 'Conversation not found'}, status_code=404)
+        headers = {'X-Conversation-Id': conversation.id} if conversation is not None else {}
+
+        store_answer = None
+        if (appV2.use_answer_cache(request.query_params.get('cache', '1'))
+                and messages and messages[-1]["role"] == "user"):
+            cached, store_answer = await run_in_threadpool(
+                appV2.lookup_answer, model_name, "", messages[:-1], messages[-1]["content"])
+            if cached is not None:
+                metrics.REQUESTS_TOTAL.inc('/api/chat', model, 'cache_hit')
+                appV2.finish_chat_turn(conversation, new_turn, cached)
+                async def replay():
+                    for piece in replay_chunks(cached):
+                        yield f"data: {piece}\n\n"
+                    yield "data: [DONE]\n\n"
+                return stream_response(replay(), headers, '/api/chat', model)
+
+        key = None
+        if messages and messages[-1]["role"] == "user":
+            key = appV2.flight_key('/api/chat', model, "", messages[:-1], messages[-1]["content"],
+                                   request.query_params.get('cache', '1'))
+        buffer, leader = appV2.join_stream(key, {}, '/api/chat', model)
+        if not leader:
+            buffer.add_done_callback(lambda done: appV2.finish_chat_turn(conversation, new_turn, done.result))
+            return follow_response(buffer, headers)
+
+        timer = None
+        try:
+            slot = await appV2.providers[model].admit_async() if model != appV2.AUTO_MODEL else None
+            timer = metrics.StreamTimer('/api/chat', model)
+            response = await aopen_stream(model, slot, messages, appV2.CHAT_MODELS, appV2.CHAT_REQUEST_OPTIONS)
+        except Exception as e:
+            if timer is not None:
+                timer.finish('error')
+            # 合并到本请求的跟随者收到错误帧和结束标记，不会被当成空回答
+            appV2.stream_registry.abandon(buffer, [error_frame(str(e)), "data: [DONE]\n\n"])
+            raise
+
+        async def generate():
+            full_response = ""
+            async for content in timer.atrack(aiter_deltas(response)):
+                full_response += content
+                yield f"data: {content}\n\n"
+            if store_answer is not None:
+                store_answer(full_response)
+            appV2.finish_chat_turn(conversation, new_turn, full_response)
+            buffer.result = full_response
+            yield "data: [DONE]\n\n"
+
+        return produce_response(buffer, generate(), headers)
+
+    except ProviderBusy as e:
+        return provider_busy_response(e)
+    except Exception as e:
+        logger.error("Error in chat endpoint: %s", e)
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def on_startup():
+    await run_in_threadpool(appV2.startup)
+
+
+app = Starlette(
+    routes=[
+        Route('/index', index, methods=['GET', 'POST', 'OPTIONS']),
+        Route('/api/chat', chat, methods=['POST', 'OPTIONS']),
+        # 其余路由交给原有的 Flask 应用
+        Mount('/', app=WSGIMiddleware(appV2.app)),
+    ],
+    on_startup=[on_startup],
+)
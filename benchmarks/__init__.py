@@ -0,0 +1,3 @@
+"""
+离线压测工具：本地的 OpenAI 兼容替身服务、合成数据集和负载生成器
+"""
@@ -0,0 +1,189 @@
+"""
+本地的 OpenAI 兼容替身服务
+
+实现 POST .../chat/completions 的流式与非流式响应，压测时代替智谱、Deepseek 和 OpenAI，不消耗真实额度：
+    --tokens-per-s     每个流的输出速度
+    --first-token-ms   收到请求到输出首个分片的延迟
+    --answer-tokens    回答长度，请求带 max_tokens 时取较小值
+    --jitter           首字延迟和非流式响应耗时的随机波动比例
+    --error-rate       请求直接返回 --error-status 的比例
+    --drop-rate        流输出到一半时断开连接的比例
+回答由单个汉字组成，每个分片一个 token，与 chat_sessions.estimate_tokens 的估算一致。
+GET /stats 返回累计的请求数、流数、注入的错误数和当前活跃的流数，压测时据此统计上游调用次数。
+
+运行方式（智谱 SDK 要求密钥形如 id.secret，任意取值即可）：
+    python -m benchmarks.fake_llm --port 9000 --tokens-per-s 50 --first-token-ms 300
+    ZHIPUAI_BASE_URL=http://127.0.0.1:9000/v4/ DEEPSEEK_BASE_URL=http://127.0.0.1:9000/v1 \\
+    OPENAI_BASE_URL=http://127.0.0.1:9000/v1 ZHIPUAI_API_KEY=bench.bench python appV2.py
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+ANSWER_TEXT = "根据参考资料可以得出结论这个问题需要分步骤计算首先确定已知条件然后代入公式最后检查结果是否合理。"
+
+
+class InjectedDisconnect(Exception):
+    """流输出中途抛出，使服务器直接断开连接"""
+
+
+def completion_chunk(completion_id, model, created, delta, finish_reason=None):
+    return {
+        'id': completion_id,
+        'object': 'chat.completion.chunk',
+        'created': created,
+        'model': model,
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+    }
+
+
+def completion(completion_id, model, created, content, prompt_tokens):
+    completion_tokens = len(content)
+    return {
+        'id': completion_id,
+        'object': 'chat.completion',
+        'created': created,
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_tokens + completion_tokens},
+    }
+
+
+class FakeLLM:
+    def __init__(self, tokens_per_s=50.0, first_token_ms=300.0, answer_tokens=200, jitter=0.1,
+                 error_rate=0.0, error_status=500, drop_rate=0.0, seed=None):
+        self.tokens_per_s = tokens_per_s
+        self.first_token = first_token_ms / 1000
+        self.answer_tokens = answer_tokens
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.streams = 0
+        self.active = 0
+        self.errors = 0
+        self.drops = 0
+        self.tokens = 0
+
+    def _jittered(self, seconds):
+        return max(0.0, seconds * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def _answer(self, body):
+        count = self.answer_tokens
+        if body.get('max_tokens'):
+            count = min(count, int(body['max_tokens']))
+        return ''.join(ANSWER_TEXT[i % len(ANSWER_TEXT)] for i in range(max(1, count)))
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        self.requests += 1
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return JSONResponse({'error': {'message': 'Injected error', 'type': 'fake_llm',
+                                           'code': str(self.error_status)}}, status_code=self.error_status)
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get('model', 'fake')
+        created = int(time.time())
+        answer = self._answer(body)
+        if not body.get('stream'):
+            await asyncio.sleep(self._jittered(self.first_token + len(answer) / self.tokens_per_s))
+            self.tokens += len(answer)
+            prompt_tokens = len(json.dumps(body.get('messages', []), ensure_ascii=False)) // 4
+            return JSONResponse(completion(completion_id, model, created, answer, prompt_tokens))
+
+        drop_at = None
+        if len(answer) > 1 and self.random.random() < self.drop_rate:
+            drop_at = self.random.randrange(1, len(answer))
+        self.streams += 1
+        return StreamingResponse(self._stream(completion_id, model, created, answer, drop_at),
+                                 media_type='text/event-stream')
+
+    async def _stream(self, completion_id, model, created, answer, drop_at):
+        loop = asyncio.get_running_loop()
+        self.active += 1
+        try:
+            first_at = loop.time() + self._jittered(self.first_token)
+            interval = 1 / self.tokens_per_s
+            yield self._frame(completion_chunk(completion_id, model, created, {'role': 'assistant', 'content': ''}))
+            for i, token in enumerate(answer):
+                # 按绝对时间排期，输出速度不随事件循环的调度误差漂移
+                delay = first_at + i * interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if i == drop_at:
+                    self.drops += 1
+                    raise InjectedDisconnect(completion_id)
+                self.tokens += 1
+                yield self._frame(completion_chunk(completion_id, model, created, {'content': token}))
+            yield self._frame(completion_chunk(completion_id, model, created, {}, 'stop'))
+            yield "data: [DONE]\n\n"
+        finally:
+            self.active -= 1
+
+    @staticmethod
+    def _frame(payload):
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    async def stats(self, request):
+        return JSONResponse({
+            'requests': self.requests,
+            'streams': self.streams,
+            'active_streams': self.active,
+            'errors_injected': self.errors,
+            'drops_injected': self.drops,
+            'tokens': self.tokens,
+            'config': {
+                'tokens_per_s': self.tokens_per_s,
+                'first_token_ms': self.first_token * 1000,
+                'answer_tokens': self.answer_tokens,
+                'jitter': self.jitter,
+                'error_rate': self.error_rate,
+                'error_status': self.error_status,
+                'drop_rate': self.drop_rate,
+            },
+        })
+
+    def app(self):
+        return Starlette(routes=[
+            Route('/stats', self.stats, methods=['GET']),
+            # base_url 可以带任意前缀，如 /v1、/api/paas/v4
+            Route('/chat/completions', self.chat_completions, methods=['POST']),
+            Route('/{prefix:path}/chat/completions', self.chat_completions, methods=['POST']),
+        ])
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="本地的 OpenAI 兼容替身服务，用于离线压测")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--tokens-per-s', type=float, default=50.0)
+    parser.add_argument('--first-token-ms', type=float, default=300.0)
+    parser.add_argument('--answer-tokens', type=int, default=200)
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    fake = FakeLLM(tokens_per_s=args.tokens_per_s, first_token_ms=args.first_token_ms,
+                   answer_tokens=args.answer_tokens, jitter=args.jitter, error_rate=args.error_rate,
+                   error_status=args.error_status, drop_rate=args.drop_rate, seed=args.seed)
+    uvicorn.run(fake.app(), host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
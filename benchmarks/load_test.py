@@ -0,0 +1,414 @@
+"""
+离线压测
+
+按若干并发度依次压测运行中的服务（appV2 或 asgi_app），上游指向 benchmarks.fake_llm：
+    index     POST /index，流式 RAG 问答
+    chat      POST /api/chat，流式对话
+    image     POST /chat_with_image，图片问答
+    upload    POST /upload，上传文档，向量索引在后台更新（文件写入服务端的 DOCS_DIR）；
+              文件名为 upload_<run_id>_<序号>.txt，不会覆盖语料，指定 --docs-dir 时压测结束后删除
+    login     POST /api/login
+每个接口与并发度输出一行统计：请求数、错误率、requests/s 和延迟的 p50/p95/p99；
+流式接口另有首字时间（TTFT）和首字之后的 tokens/s；指定 --llm-url 时记录期间的上游请求数。
+结果写成 JSON 基线，compare 对比两份基线并在指标变差超过阈值时以非零状态退出：
+    python -m benchmarks.synthetic_data bench_data
+    python -m benchmarks.fake_llm --port 9000 &
+    DOCS_DIR=bench_data/docs INDEX_DIR=bench_data/index ZHIPUAI_BASE_URL=http://127.0.0.1:9000/v4/ \\
+        DEEPSEEK_BASE_URL=http://127.0.0.1:9000/v1 ZHIPUAI_API_KEY=bench.bench python appV2.py &
+    python -m benchmarks.load_test run --url http://127.0.0.1:5000 --llm-url http://127.0.0.1:9000 \\
+        --docs-dir bench_data/docs --concurrency 1,8,32 --duration 20 --output baseline.json
+    python -m benchmarks.load_test compare baseline.json current.json --threshold 0.1
+"""
+import argparse
+import asyncio
+import datetime
+import glob
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+
+import httpx
+
+from benchmarks.synthetic_data import generate_documents, generate_images, generate_questions
+from chat_sessions import estimate_tokens
+
+SCENARIOS = ('index', 'chat', 'image', 'upload', 'login')
+# 上传时轮流覆盖的文件数，文档目录不会随压测无限增长
+UPLOAD_FILES = 8
+
+
+class Sample:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_at = None
+        self.finished = None
+        self.first_tokens = 0
+        self.tokens = 0
+        self.error = None
+
+    @property
+    def latency(self):
+        return self.finished - self.started
+
+    @property
+    def ttft(self):
+        return self.first_at - self.started if self.first_at is not None else None
+
+    @property
+    def tokens_per_s(self):
+        """首字之后的输出速度，与 metrics.StreamTimer 的口径一致"""
+        if self.first_at is None or self.tokens <= self.first_tokens or self.finished <= self.first_at:
+            return None
+        return (self.tokens - self.first_tokens) / (self.finished - self.first_at)
+
+
+def parse_index_frame(payload):
+    """/index 的帧为 {"content": ..., "done": ...} 或 {"error": ...}，返回 (文本, 是否结束, 错误)"""
+    frame = json.loads(payload)
+    return frame.get('content', ''), frame.get('done', False), frame.get('error')
+
+
+def parse_chat_frame(payload):
+    """/api/chat 的帧为原始文本，以 [DONE] 结束"""
+    if payload == '[DONE]':
+        return '', True, None
+    return payload, False, None
+
+
+async def stream_request(client, parse_frame, url, **kwargs):
+    sample = Sample()
+    done = False
+    try:
+        async with client.stream('POST', url, **kwargs) as response:
+            if response.status_code != 200:
+                await response.aread()
+                sample.error = f"HTTP {response.status_code}"
+            else:
+                async for line in response.aiter_lines():
+                    if not line.startswith('data: '):
+                        continue
+                    text, done, error = parse_frame(line[len('data: '):])
+                    if error:
+                        sample.error = error
+                        break
+                    if text:
+                        tokens = estimate_tokens(text)
+                        if sample.first_at is None:
+                            sample.first_at = time.perf_counter()
+                            sample.first_tokens = tokens
+                        sample.tokens += tokens
+                    if done:
+                        break
+                if not done and sample.error is None:
+                    sample.error = "Stream ended without a done frame"
+    except httpx.HTTPError as e:
+        sample.error = type(e).__name__
+    sample.finished = time.perf_counter()
+    return sample
+
+
+async def request(client, url, **kwargs):
+    sample = Sample()
+    try:
+        response = await client.post(url, **kwargs)
+        if response.status_code >= 400:
+            sample.error = f"HTTP {response.status_code}"
+    except httpx.HTTPError as e:
+        sample.error = type(e).__name__
+    sample.finished = time.perf_counter()
+    return sample
+
+
+class Workload:
+    def __init__(self, args):
+        self.model = args.model
+        self.cache = '1' if args.answer_cache else '0'
+        self.username = args.username
+        self.password = args.password
+        self.unique_images = not args.reuse_images
+        self.questions = generate_questions(args.questions, seed=args.seed)
+        self.documents = generate_documents(UPLOAD_FILES, seed=args.seed + 1)
+        # 上传文件名带上本次压测的 id，与语料的 bench_*.txt 区分
+        self.run_id = uuid.uuid4().hex[:8]
+        self.images = generate_images(args.images, seed=args.seed) if 'image' in args.scenarios else []
+
+    def question(self, i):
+        return self.questions[i % len(self.questions)]
+
+    async def index(self, client, i):
+        return await stream_request(client, parse_index_frame, '/index',
+                                    params={'model': self.model, 'cache': self.cache},
+                                    json={'question': self.question(i)})
+
+    async def chat(self, client, i):
+        return await stream_request(client, parse_chat_frame, '/api/chat', params={'cache': self.cache},
+                                    json={'model': self.model,
+                                          'messages': [{'role': 'user', 'content': self.question(i)}]})
+
+    async def image(self, client, i):
+        filename, data = self.images[i % len(self.images)]
+        if self.unique_images:
+            # JPEG 结束标记之后的字节不影响解码，只让服务端的图片缓存不命中
+            data += f"bench-{i}".encode()
+        return await request(client, '/chat_with_image', data={'question': self.question(i)},
+                             files={'image': (filename, data, 'image/jpeg')})
+
+    def upload_name(self, i):
+        return f"upload_{self.run_id}_{i % UPLOAD_FILES}.txt"
+
+    async def upload(self, client, i):
+        _, text = self.documents[i % UPLOAD_FILES]
+        # 每次内容都不同，服务端需要重新切分和嵌入该文件
+        content = f"{text}\n第 {i} 次上传\n".encode('utf-8')
+        return await request(client, '/upload', files={'file': (self.upload_name(i), content, 'text/plain')})
+
+    def cleanup(self, docs_dir):
+        """删除本次压测上传到 docs_dir 的文件，返回删除的文件数；索引在下一次更新时移除对应的向量"""
+        removed = 0
+        for path in glob.glob(os.path.join(docs_dir, f"upload_{self.run_id}_*.txt")):
+            os.remove(path)
+            removed += 1
+        return removed
+
+    async def login(self, client, i):
+        return await request(client, '/api/login', json={'username': self.username, 'password': self.password})
+
+
+def summary(values, scale=1.0):
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def percentile(q):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * scale, 2)
+
+    return {
+        'mean': round(statistics.fmean(ordered) * scale, 2),
+        'p50': percentile(0.5),
+        'p95': percentile(0.95),
+        'p99': percentile(0.99),
+        'max': round(ordered[-1] * scale, 2),
+    }
+
+
+async def llm_requests(client, llm_url):
+    if not llm_url:
+        return None
+    try:
+        response = await client.get(f"{llm_url.rstrip('/')}/stats")
+        return response.json()['requests']
+    except (httpx.HTTPError, ValueError, KeyError):
+        return None
+
+
+async def run_level(client, scenario, concurrency, duration, max_requests, llm_url):
+    """concurrency 个协程循环发送请求，直到达到 duration 秒或 max_requests 个请求"""
+    counter = itertools.count()
+    samples = []
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        while True:
+            i = next(counter)
+            if (max_requests and i >= max_requests) or (not max_requests and time.perf_counter() >= deadline):
+                return
+            samples.append(await scenario(client, i))
+
+    upstream_before = await llm_requests(client, llm_url)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    upstream_after = await llm_requests(client, llm_url)
+
+    ok = [sample for sample in samples if sample.error is None]
+    errors = Counter(sample.error for sample in samples if sample.error is not None)
+    return {
+        'requests': len(samples),
+        'errors': sum(errors.values()),
+        'error_rate': round(sum(errors.values()) / len(samples), 4) if samples else None,
+        'duration_s': round(elapsed, 2),
+        'requests_per_s': round(len(ok) / elapsed, 2) if elapsed else None,
+        'latency_ms': summary([sample.latency for sample in ok], 1000),
+        'ttft_ms': summary([sample.ttft for sample in ok if sample.ttft is not None], 1000),
+        'tokens_per_s': summary([rate for rate in (sample.tokens_per_s for sample in ok) if rate is not None]),
+        'upstream_requests': (upstream_after - upstream_before
+                              if upstream_before is not None and upstream_after is not None else None),
+        'top_errors': dict(errors.most_common(3)),
+    }
+
+
+async def wait_ready(client, timeout):
+    """等待 /api/ready 返回 200，即向量索引和嵌入模型已完成预热"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get('/api/ready')).status_code == 200:
+                return True
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(1)
+    return False
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    workload = Workload(args)
+    limits = httpx.Limits(max_connections=max(args.concurrency) + 4)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        if not await wait_ready(client, args.ready_timeout):
+            raise SystemExit(f"{args.url} is not ready after {args.ready_timeout}s")
+        fake_llm = None
+        if args.llm_url:
+            try:
+                fake_llm = (await client.get(f"{args.llm_url.rstrip('/')}/stats")).json().get('config')
+            except (httpx.HTTPError, ValueError):
+                pass
+
+        results = []
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                row = {'scenario': scenario, 'concurrency': concurrency}
+                row.update(await run_level(client, getattr(workload, scenario), concurrency,
+                                           args.duration, args.requests, args.llm_url))
+                print(json.dumps(row, ensure_ascii=False), file=sys.stderr)
+                results.append(row)
+
+    if 'upload' in args.scenarios:
+        if args.docs_dir:
+            print(f"Removed {workload.cleanup(args.docs_dir)} uploaded files", file=sys.stderr)
+        else:
+            print(f"Uploaded files are left in the server's DOCS_DIR as upload_{workload.run_id}_*.txt",
+                  file=sys.stderr)
+
+    return {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'url': args.url,
+            'run_id': workload.run_id,
+            'model': args.model,
+            'duration_s': args.duration,
+            'requests': args.requests,
+            'answer_cache': args.answer_cache,
+            'unique_images': workload.unique_images,
+            'fake_llm': fake_llm,
+        },
+        'results': results,
+    }
+
+
+# 参与对比的指标：(字段, 分位数, 数值越大越好)
+COMPARED_METRICS = (
+    ('requests_per_s', None, True),
+    ('error_rate', None, False),
+    ('latency_ms', 'p50', False),
+    ('latency_ms', 'p95', False),
+    ('latency_ms', 'p99', False),
+    ('ttft_ms', 'p50', False),
+    ('ttft_ms', 'p95', False),
+    ('tokens_per_s', 'p50', True),
+)
+
+
+def compare(old, new, threshold):
+    """逐行对比两份基线，返回 (对比结果列表, 是否有指标变差超过 threshold)"""
+    baseline = {(row['scenario'], row['concurrency']): row for row in old['results']}
+    rows = []
+    regressed = False
+    for row in new['results']:
+        before = baseline.get((row['scenario'], row['concurrency']))
+        if before is None:
+            continue
+        for field, quantile, higher_is_better in COMPARED_METRICS:
+            old_value, new_value = before.get(field), row.get(field)
+            if quantile is not None:
+                old_value = old_value.get(quantile) if old_value else None
+                new_value = new_value.get(quantile) if new_value else None
+            if old_value is None or new_value is None:
+                continue
+            if old_value:
+                change = (new_value - old_value) / old_value
+            else:
+                # 从 0 变为非 0（如错误率）时没有相对变化可言，按无穷大计
+                change = 0.0 if not new_value else float('inf')
+            worse = change < -threshold if higher_is_better else change > threshold
+            regressed = regressed or worse
+            rows.append({
+                'scenario': row['scenario'],
+                'concurrency': row['concurrency'],
+                'metric': f"{field}.{quantile}" if quantile else field,
+                'old': old_value,
+                'new': new_value,
+                'change': round(change, 4) if change != float('inf') else None,
+                'regressed': worse,
+            })
+    return rows, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线压测各接口并生成可对比的 JSON 基线")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="压测并输出基线")
+    run_parser.add_argument('--url', default='http://127.0.0.1:5000')
+    run_parser.add_argument('--llm-url', help="benchmarks.fake_llm 的地址，用于统计上游请求数")
+    run_parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            type=lambda value: [name for name in value.split(',') if name])
+    run_parser.add_argument('--concurrency', default='1,8,32',
+                            type=lambda value: [int(level) for level in value.split(',') if level])
+    run_parser.add_argument('--duration', type=float, default=20.0, help="每个并发度的压测秒数")
+    run_parser.add_argument('--requests', type=int, default=0, help="每个并发度的请求数，非 0 时代替 --duration")
+    run_parser.add_argument('--model', default='deepseek')
+    run_parser.add_argument('--answer-cache', action='store_true', help="允许命中回答缓存，默认带 cache=0")
+    run_parser.add_argument('--reuse-images', action='store_true', help="重复发送相同图片，测量图片缓存命中时的表现")
+    run_parser.add_argument('--questions', type=int, default=200)
+    run_parser.add_argument('--images', type=int, default=6)
+    run_parser.add_argument('--username', default='test')
+    run_parser.add_argument('--password', default='test123')
+    run_parser.add_argument('--timeout', type=float, default=120.0)
+    run_parser.add_argument('--ready-timeout', type=float, default=300.0)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help="基线写入的文件，默认输出到标准输出")
+    run_parser.add_argument('--docs-dir', help="服务端的 DOCS_DIR，压测结束后删除本次上传的文件")
+
+    compare_parser = commands.add_parser('compare', help="对比两份基线")
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help="相对变化超过该比例视为变差")
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.old, 'r', encoding='utf-8') as f:
+            old = json.load(f)
+        with open(args.new, 'r', encoding='utf-8') as f:
+            new = json.load(f)
+        rows, regressed = compare(old, new, args.threshold)
+        for row in rows:
+            print(json.dumps(row, ensure_ascii=False))
+        sys.exit(1 if regressed else 0)
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    baseline = json.dumps(asyncio.run(run(args)), ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(baseline + "\n")
+    else:
+        print(baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+压测用的合成数据
+
+generate_documents 生成围绕若干学科主题的中文文档，generate_questions 生成与之对应的问题，
+generate_images 生成不同尺寸的 JPEG（既有无需缩放的，也有需要缩放的手机照片尺寸）。
+同一 seed 生成的数据完全相同，不同提交的压测结果可以直接对比。
+
+写到目录中供服务端使用（DOCS_DIR 指向其中的 docs 目录）：
+    python -m benchmarks.synthetic_data bench_data --docs 200 --images 16
+"""
+import argparse
+import io
+import os
+import random
+
+TOPICS = {
+    '线性代数': ['矩阵乘法', '特征值', '行列式', '向量空间', '线性变换', '矩阵的秩'],
+    '微积分': ['导数', '定积分', '极限', '泰勒展开', '微分方程', '幂级数'],
+    '概率论': ['随机变量', '数学期望', '方差', '贝叶斯公式', '正态分布', '大数定律'],
+    '力学': ['牛顿第二定律', '动量守恒', '角动量', '简谐振动', '万有引力', '动能定理'],
+    '电磁学': ['电场强度', '磁感应强度', '电磁感应', '麦克斯韦方程组', '电容', '欧姆定律'],
+    '数据结构': ['链表', '哈希表', '二叉搜索树', '堆', '图的遍历', '动态规划'],
+}
+
+SENTENCES = [
+    "{concept}是{topic}中的基本概念，理解它之前需要先掌握{other}。",
+    "在{topic}的习题中，{concept}常常与{other}一起出现。",
+    "计算{concept}时，第{n}步最容易出错，应当仔细检查{other}的条件。",
+    "教材第{n}章用{m}个例题说明了{concept}的性质。",
+    "{concept}的一个重要应用是求解与{other}有关的问题。",
+    "把{concept}推广到{n}维的情形时，大部分结论依然成立。",
+    "考试中关于{concept}的题目约占{topic}部分分数的{m}%。",
+    "很多同学把{concept}和{other}混淆，区别在于前者强调结构，后者强调计算。",
+]
+
+QUESTIONS = [
+    "什么是{concept}？",
+    "{concept}和{other}有什么关系？",
+    "如何计算{concept}？请给出步骤。",
+    "请举例说明{topic}中的{concept}。",
+    "学习{concept}之前需要掌握哪些知识？",
+]
+
+# 宽 × 高：无需缩放、略超上限和手机照片三种尺寸
+IMAGE_SIZES = ((800, 600), (1280, 960), (3024, 4032))
+
+
+def _fill(template, rng, topic):
+    concepts = TOPICS[topic]
+    concept, other = rng.sample(concepts, 2)
+    return template.format(topic=topic, concept=concept, other=other, n=rng.randint(2, 12), m=rng.randint(3, 40))
+
+
+def generate_documents(count=50, paragraphs=8, sentences=6, seed=0):
+    """返回 [(文件名, 文本)]，每个文档围绕一个主题，段落之间用空行分隔"""
+    rng = random.Random(seed)
+    topics = sorted(TOPICS)
+    documents = []
+    for i in range(count):
+        topic = topics[i % len(topics)]
+        body = "\n\n".join(
+            ''.join(_fill(rng.choice(SENTENCES), rng, topic) for _ in range(sentences))
+            for _ in range(paragraphs)
+        )
+        documents.append((f"bench_{i:04d}.txt", f"{topic}笔记 {i}\n\n{body}\n"))
+    return documents
+
+
+def generate_questions(count=200, seed=0):
+    rng = random.Random(seed)
+    topics = sorted(TOPICS)
+    return [_fill(rng.choice(QUESTIONS), rng, rng.choice(topics)) for _ in range(count)]
+
+
+def generate_images(count=8, sizes=IMAGE_SIZES, seed=0, quality=90):
+    """返回 [(文件名, JPEG 字节)]，内容为随机色块，各种尺寸轮流出现"""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    images = []
+    for i in range(count):
+        width, height = sizes[i % len(sizes)]
+        image = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(24):
+            x0, y0 = rng.randrange(width), rng.randrange(height)
+            x1, y1 = x0 + rng.randrange(width // 8, width // 2), y0 + rng.randrange(height // 8, height // 2)
+            shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+            shape((x0, y0, x1, y1), fill=tuple(rng.randrange(256) for _ in range(3)))
+        buffered = io.BytesIO()
+        image.save(buffered, format='JPEG', quality=quality)
+        images.append((f"bench_{i:04d}_{width}x{height}.jpg", buffered.getvalue()))
+    return images
+
+
+def write_dataset(out_dir, documents, images):
+    """文档写到 out_dir/docs，图片写到 out_dir/images"""
+    docs_dir = os.path.join(out_dir, 'docs')
+    images_dir = os.path.join(out_dir, 'images')
+    os.makedirs(docs_dir, exist_ok=True)
+    os.makedirs(images_dir, exist_ok=True)
+    for filename, text in documents:
+        with open(os.path.join(docs_dir, filename), 'w', encoding='utf-8') as f:
+            f.write(text)
+    for filename, data in images:
+        with open(os.path.join(images_dir, filename), 'wb') as f:
+            f.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成压测用的合成文档和图片")
+    parser.add_argument('out_dir')
+    parser.add_argument('--docs', type=int, default=50)
+    parser.add_argument('--paragraphs', type=int, default=8)
+    parser.add_argument('--images', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_dataset(args.out_dir, generate_documents(args.docs, args.paragraphs, seed=args.seed),
+                  generate_images(args.images, seed=args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+/api/chat 的服务端会话
+
+对话历史按会话 id 保存在服务端，客户端每轮只需发送新的一条消息。
+发给模型的历史受 token 预算约束：最近的若干轮原样保留，更早的消息折叠进滚动摘要。
+摘要缓存在会话上，每轮回答结束后由后台线程提前折叠，请求路径上通常直接使用已有摘要；
+只有未折叠的历史超出预算时才在请求中同步生成摘要。
+"""
+import logging
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from answer_cache import content_hash
+from cache_utils import TTLCache
+
+logger = logging.getLogger(__name__)
+
+_CJK = re.compile(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中日韩字符按每字 1 个，其余按每 4 个字符 1 个"""
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message):
+    # 每条消息另计角色等格式开销
+    return estimate_tokens(message['content']) + 4
+
+
+class Conversation:
+    def __init__(self, conversation_id, model=None):
+        self.id = conversation_id
+        self.model = model
+        self.messages = []
+        # messages[:summarized_upto] 已折叠进 summary
+        self.summary = ""
+        self.summarized_upto = 0
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.messages), self.summary, self.summarized_upto
+
+    def append(self, *messages):
+        with self.lock:
+            self.messages.extend(messages)
+
+    def as_dict(self):
+        messages, summary, summarized_upto = self.snapshot()
+        return {
+            'conversation_id': self.id,
+            'model': self.model,
+            'messages': messages,
+            'summary': summary,
+            'summarized_upto': summarized_upto,
+        }
+
+
+class HistoryCompactor:
+    def __init__(self, summarize_fn, budget=3000, target_ratio=0.5, summary_cache_size=1024):
+        """
+        summarize_fn(summary, messages) 返回把 messages 并入已有 summary 后的新摘要；
+        budget 为发送给模型的历史 token 上限，后台折叠时把原样保留的部分压到 budget * target_ratio
+        """
+        self.summarize_fn = summarize_fn
+        self.budget = budget
+        self.target = int(budget * target_ratio)
+        self.cache = TTLCache(maxsize=summary_cache_size)
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-summary')
+        self.sync_folds = 0
+        self.background_folds = 0
+
+    def _summarize(self, summary, messages):
+        key = content_hash(summary, messages)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.summarize_fn(summary, messages)
+            self.cache.put(key, result)
+        return result
+
+    def _cut(self, messages, start, budget):
+        """从末尾向前保留不超过 budget 的消息，返回第一条保留消息的下标；最后一条消息总是保留"""
+        total = 0
+        cut = len(messages)
+        while cut > start:
+            total += message_tokens(messages[cut - 1])
+            if total > budget and cut < len(messages):
+                break
+            cut -= 1
+        return cut
+
+    def _fold(self, conversation, budget):
+        messages, summary, start = conversation.snapshot()
+        cut = self._cut(messages, start, budget)
+        if cut <= start:
+            return False
+        summary = self._summarize(summary, messages[start:cut])
+        with conversation.lock:
+            # 并发折叠时只接受更靠后的结果
+            if cut > conversation.summarized_upto:
+                conversation.summary = summary
+                conversation.summarized_upto = cut
+        return True
+
+    def compact(self, conversation, new_messages=()):
+        """返回发给模型的消息：滚动摘要 + 未折叠的历史 + 本轮新消息"""
+        messages, summary, start = conversation.snapshot()
+        pending = messages[start:] + list(new_messages)
+        if sum(message_tokens(m) for m in pending) > self.budget:
+            # 后台折叠还没跟上，同步把超出预算的部分并入摘要
+            self.sync_folds += 1
+            cut = self._cut(pending, 0, self.budget)
+            try:
+                summary = self._summarize(summary, pending[:cut])
+                folded = True
+            except Exception as e:
+                # 摘要失败时本轮只丢弃超出预算的旧消息，不影响回答
+                logger.error("Error summarizing conversation %s: %s", conversation.id, e)
+                folded = False
+            pending = pending[cut:]
+            if folded and cut <= len(messages) - start:
+                with conversation.lock:
+                    if start + cut > conversation.summarized_upto:
+                        conversation.summary = summary
+                        conversation.summarized_upto = start + cut
+        if summary:
+            pending = [{"role": "system", "content": f"此前对话的摘要：\n{summary}"}] + pending
+        return pending
+
+    def schedule(self, conversation):
+        """回答结束后在后台折叠较早的历史，使下一轮请求直接使用缓存的摘要"""
+        def run():
+            try:
+                messages, _, start = conversation.snapshot()
+                if sum(message_tokens(m) for m in messages[start:]) > self.target:
+                    if self._fold(conversation, self.target):
+                        self.background_folds += 1
+            except Exception as e:
+                logger.error("Error summarizing conversation %s: %s", conversation.id, e)
+        self._pool.submit(run)
+
+    def stats(self):
+        return {
+            'budget': self.budget,
+            'sync_folds': self.sync_folds,
+            'background_folds': self.background_folds,
+            'summary_cache': self.cache.stats(),
+        }
+
+
+class ConversationStore:
+    def __init__(self, maxsize=10000, ttl=86400):
+        self._conversations = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def create(self, model=None):
+        conversation = Conversation(uuid.uuid4().hex, model)
+        self._conversations.put(conversation.id, conversation)
+        return conversation
+
+    def get(self, conversation_id):
+        conversation = self._conversations.get(conversation_id) if conversation_id else None
+        if conversation is not None:
+            # 访问时刷新过期时间
+            self._conversations.put(conversation_id, conversation)
+        return conversation
+
+    def delete(self, conversation_id):
+        return self._conversations.pop(conversation_id) is not None
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def stats(self):
+        return self._conversations.stats()
@@ -0,0 +1,143 @@
+"""
+RAG 上下文组装
+
+位于向量检索和提示构建之间：
+    - 按相关度阈值动态决定使用几个候选文本块，而不是固定取前 k 个
+    - 去掉内容几乎相同的文本块（如同一文档的重复版本）
+    - 同一来源中相邻的文本块合并成一段，切分时重叠的部分只保留一份
+    - 在 token 预算内按相关度装入段落
+"""
+import threading
+
+from chat_sessions import estimate_tokens
+
+# 合并相邻文本块时未找到重叠部分使用的分隔符，与 CharacterTextSplitter 默认的分隔符一致
+PARAGRAPH_SEPARATOR = "\n\n"
+
+
+def shingles(text, size=5):
+    text = ''.join(text.split())
+    return {text[i:i + size] for i in range(max(1, len(text) - size + 1))}
+
+
+def overlap_length(head, tail, max_overlap, min_overlap=20):
+    """head 的结尾与 tail 的开头相同部分的长度，找不到返回 0"""
+    limit = min(max_overlap, len(head), len(tail))
+    for length in range(limit, min_overlap - 1, -1):
+        if head.endswith(tail[:length]):
+            return length
+    return 0
+
+
+class Passage:
+    def __init__(self, source, chunk, text, score):
+        self.source = source
+        self.first = chunk
+        self.last = chunk
+        self.text = text
+        # 距离越小越相关，合并后取其中最好的分数
+        self.score = score
+
+    def extend(self, text, chunk, score, max_overlap):
+        length = overlap_length(self.text, text, max_overlap)
+        self.text = self.text + text[length:] if length else self.text + PARAGRAPH_SEPARATOR + text
+        self.last = chunk
+        self.score = min(self.score, score)
+        return length
+
+
+class ContextPacker:
+    def __init__(self, budget=1500, max_k=6, distance_ratio=1.5, duplicate_threshold=0.9, max_overlap=200):
+        """
+        budget 为上下文的 token 上限；候选按距离升序，距离超过最佳候选 distance_ratio 倍的不再使用，
+        最多使用 max_k 个；两段文本的 5 字片段重合比例达到 duplicate_threshold 视为重复
+        """
+        self.budget = budget
+        self.max_k = max_k
+        self.distance_ratio = distance_ratio
+        self.duplicate_threshold = duplicate_threshold
+        self.max_overlap = max_overlap
+        # 多个请求线程共用一个实例，统计计数在锁内累加
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.candidate_tokens = 0
+        self.packed_tokens = 0
+        self.duplicates = 0
+        self.merged = 0
+
+    def _select(self, scored_docs):
+        """按相关度阈值动态选出候选，并去掉近似重复的文本块"""
+        scored_docs = sorted(scored_docs, key=lambda item: item[1])
+        if not scored_docs:
+            return []
+        best = scored_docs[0][1]
+        cutoff = best * self.distance_ratio if best > 0 else float('inf')
+        selected = []
+        duplicates = 0
+        for doc, score in scored_docs:
+            if len(selected) >= self.max_k or (score > cutoff and selected):
+                break
+            fingerprint = shingles(doc.page_content)
+            if any(len(fingerprint & other) / max(1, min(len(fingerprint), len(other))) >= self.duplicate_threshold
+                   for _, _, other in selected):
+                duplicates += 1
+                continue
+            selected.append((doc, score, fingerprint))
+        if duplicates:
+            with self._lock:
+                self.duplicates += duplicates
+        return [(doc, score) for doc, score, _ in selected]
+
+    def _merge(self, scored_docs):
+        """同一来源中编号相邻的文本块合并成一段"""
+        keyed = sorted(scored_docs, key=lambda item: (str(item[0].metadata.get('source')),
+                                                       item[0].metadata.get('chunk', -1)))
+        passages = []
+        merged = 0
+        for doc, score in keyed:
+            source = doc.metadata.get('source')
+            chunk = doc.metadata.get('chunk')
+            previous = passages[-1] if passages else None
+            if (previous is not None and chunk is not None and previous.source == source
+                    and previous.last is not None and chunk == previous.last + 1):
+                previous.extend(doc.page_content, chunk, score, self.max_overlap)
+                merged += 1
+            else:
+                passages.append(Passage(source, chunk, doc.page_content, score))
+        if merged:
+            with self._lock:
+                self.merged += merged
+        return sorted(passages, key=lambda passage: passage.score)
+
+    def pack(self, scored_docs):
+        """
+        scored_docs 为 [(Document, 距离)]，返回装入预算的段落文本列表，按相关度排序
+        """
+        candidate_tokens = sum(estimate_tokens(doc.page_content) for doc, _ in scored_docs)
+        packed, used = [], 0
+        for passage in self._merge(self._select(scored_docs)):
+            tokens = estimate_tokens(passage.text)
+            if used + tokens <= self.budget:
+                packed.append(passage.text)
+                used += tokens
+            elif not packed:
+                # 最相关的一段本身超出预算时按比例截断
+                packed.append(passage.text[:max(1, len(passage.text) * self.budget // tokens)])
+                used = self.budget
+                break
+        with self._lock:
+            self.requests += 1
+            self.candidate_tokens += candidate_tokens
+            self.packed_tokens += used
+        return packed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'budget': self.budget,
+                'requests': self.requests,
+                'candidate_tokens': self.candidate_tokens,
+                'packed_tokens': self.packed_tokens,
+                'duplicates_dropped': self.duplicates,
+                'chunks_merged': self.merged,
+            }
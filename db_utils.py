@@ -0,0 +1,138 @@
+"""
+SQLite 访问层
+
+连接从固定大小的连接池中借用，不再每次请求都 connect/close。每个连接开启 WAL 模式，
+读写互不阻塞，并依靠 sqlite3 的语句缓存复用已编译的语句。
+已验证的凭据在内存中缓存，经 write 写入用户数据时失效；应用本身没有修改用户的接口，
+直接改库（如修改口令）只能等凭据缓存过期，因此缓存时间较短。登录成功后签发会话令牌，
+后续请求凭令牌鉴权，不再访问数据库。
+"""
+import hashlib
+import hmac
+import queue
+import secrets
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from cache_utils import TTLCache
+
+
+def password_digest(username, password):
+    return hashlib.sha256(f"{username}\0{password}".encode('utf-8')).hexdigest()
+
+
+class Database:
+    def __init__(self, path, pool_size=8, credential_cache_size=1024, credential_cache_ttl=60,
+                 session_ttl=86400, max_sessions=100000):
+        self.path = path
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._created = 0
+        self._pool_size = pool_size
+        self._pool_lock = threading.Lock()
+        # 用户名 -> (口令摘要, 用户 id)
+        self.credentials = TTLCache(maxsize=credential_cache_size, ttl=credential_cache_ttl)
+        # 令牌 -> {'user_id', 'username'}
+        self.sessions = TTLCache(maxsize=max_sessions, ttl=session_ttl)
+        # 用户名 -> 令牌集合，用于吊销；与会话同样的容量和过期时间，登录时清理已失效的令牌
+        self._user_sessions = TTLCache(maxsize=max_sessions, ttl=session_ttl)
+        self._session_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """从连接池借用一个连接，用完归还；池未满时按需创建"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                create = self._created < self._pool_size
+                if create:
+                    self._created += 1
+            conn = self._connect() if create else self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def query_one(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def write(self, sql, params=(), username=None):
+        """
+        执行写操作并提交；指定 username 时只让该用户的凭据缓存和会话失效，否则全部失效
+        """
+        with self.connection() as conn:
+            try:
+                cursor = conn.execute(sql, params)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        if username is None:
+            self.credentials.clear()
+        else:
+            self.invalidate_user(username)
+        return cursor.rowcount
+
+    def init_schema(self):
+        with self.connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS compusers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    password TEXT NOT NULL
+                )
+            ''')
+            conn.execute("INSERT OR IGNORE INTO compusers (username, password) VALUES (?, ?)", ("test", "test123"))
+            conn.execute("INSERT OR IGNORE INTO compusers (username, password) VALUES (?, ?)", ("admin", "admin123"))
+            conn.commit()
+        self.credentials.clear()
+
+    def verify_credentials(self, username, password):
+        """校验用户名和密码，返回用户 id，失败返回 None；验证成功的凭据会被缓存"""
+        digest = password_digest(username, password)
+        cached = self.credentials.get(username)
+        if cached is not None and hmac.compare_digest(cached[0], digest):
+            return cached[1]
+
+        row = self.query_one("SELECT id FROM compusers WHERE username = ? AND password = ?", (username, password))
+        if row is None:
+            return None
+        self.credentials.put(username, (digest, row[0]))
+        return row[0]
+
+    def invalidate_user(self, username):
+        """用户数据变化后清除其凭据缓存并吊销其会话"""
+        self.credentials.pop(username)
+        with self._session_lock:
+            tokens = self._user_sessions.pop(username) or set()
+        for token in tokens:
+            self.sessions.pop(token)
+
+    def create_session(self, user_id, username):
+        token = secrets.token_urlsafe(32)
+        self.sessions.put(token, {'user_id': user_id, 'username': username})
+        with self._session_lock:
+            tokens = {t for t in self._user_sessions.get(username) or () if t in self.sessions}
+            tokens.add(token)
+            # 重新写入使过期时间晚于其中最新的令牌
+            self._user_sessions.put(username, tokens)
+        return token
+
+    def get_session(self, token):
+        """按令牌查找会话，只访问内存"""
+        return self.sessions.get(token) if token else None
+
+    def revoke_session(self, token):
+        session = self.sessions.pop(token)
+        if session is not None:
+            with self._session_lock:
+                (self._user_sessions.get(session['username']) or set()).discard(token)
@@ -0,0 +1,144 @@
+"""
+后台邮件发送队列
+
+/api/send-email 只负责入队并立即返回，后台线程持有一个长连接的 SMTP 会话，
+每次取出一批排队的邮件在同一连接上发送。连接断开或发送失败时重连并按退避重试，
+连接空闲超过 idle_timeout 秒后主动关闭。
+
+本地调试时可以用 aiosmtpd 作为替身服务器，并关闭 TLS 和登录：
+    python -m aiosmtpd -n -l localhost:1025
+    SMTP_SERVER=localhost SMTP_PORT=1025 SMTP_USE_TLS=false
+"""
+import logging
+import queue
+import smtplib
+import threading
+import time
+import uuid
+from collections import deque
+
+from cache_utils import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class EmailQueueFull(Exception):
+    pass
+
+
+class EmailQueue:
+    def __init__(self, host, port, username=None, password=None, use_tls=True, maxsize=1000,
+                 batch_size=50, max_retries=3, idle_timeout=60, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._server = None
+        self._last_used = 0.0
+        self._thread = None
+        self._start_lock = threading.Lock()
+        # 任务 id -> 状态，供查询接口使用
+        self.jobs = TTLCache(maxsize=10000, ttl=3600)
+        self._sent_at = deque(maxlen=10000)
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.connects = 0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='email-sender', daemon=True)
+                self._thread.start()
+
+    def submit(self, message):
+        """邮件入队，返回任务 id；队列已满时抛出 EmailQueueFull"""
+        self.start()
+        job_id = uuid.uuid4().hex
+        # 先记录状态，避免后台线程发送完成后被覆盖
+        self.jobs.put(job_id, 'queued')
+        try:
+            self._queue.put_nowait((job_id, message))
+        except queue.Full:
+            self.jobs.pop(job_id)
+            raise EmailQueueFull("Email queue is full")
+        self.enqueued += 1
+        return job_id
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=1)]
+            except queue.Empty:
+                if self._server is not None and time.monotonic() - self._last_used > self.idle_timeout:
+                    self._close()
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for job_id, message in batch:
+                self._send(job_id, message)
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            server.starttls()  # 启用TLS加密
+        if self.username:
+            server.login(self.username, self.password)
+        self.connects += 1
+        return server
+
+    def _close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def _send(self, job_id, message):
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self._server is None:
+                    self._server = self._connect()
+                self._server.send_message(message)
+                self._last_used = time.monotonic()
+                self._sent_at.append(self._last_used)
+                self.sent += 1
+                self.jobs.put(job_id, 'sent')
+                return
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused) as e:
+                # 地址被拒绝，重试也不会成功
+                logger.error("发送邮件时出错: %s", e)
+                break
+            except (smtplib.SMTPException, OSError) as e:
+                logger.error("发送邮件时出错: %s", e)
+                self._close()
+                if attempt < self.max_retries:
+                    self.retries += 1
+                    time.sleep(min(30, 2 ** attempt))
+        self.failed += 1
+        self.jobs.put(job_id, 'failed')
+
+    def stats(self, window=60):
+        now = time.monotonic()
+        recent = sum(1 for sent_at in list(self._sent_at) if now - sent_at <= window)
+        return {
+            'queue_depth': self._queue.qsize(),
+            'enqueued': self.enqueued,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'connects': self.connects,
+            'connected': self._server is not None,
+            'send_rate_per_s': round(recent / window, 3),
+        }
@@ -0,0 +1,332 @@
+"""
+嵌入模型的延迟加载
+
+HuggingFaceEmbeddings 构造时会导入 torch/transformers 并加载整个模型，耗时数秒。
+LazyEmbeddings 在第一次嵌入时才加载模型，多个线程同时触发时只加载一次；
+也可以在启动后由预热线程调用 load() 提前加载。
+
+QueryBatcher 把并发请求的查询向量合并成一次批量前向计算，CPU 上批量计算的吞吐远高于逐条计算。
+
+这里的嵌入类只按鸭子类型实现 embed_documents/embed_query，不继承 LangChain 的 Embeddings，
+导入本模块不会加载 langchain_core；交给 LangChain 的向量库前由 register_embeddings 登记为其虚拟子类。
+
+可选的 CPU 推理后端（EMBEDDING_BACKENDS）：
+    torch    原始的 float32 PyTorch 模型，作为参照
+    int8     对 Linear 层做动态 int8 量化的 PyTorch 模型
+    onnx     经 optimum 导出并做图优化的 ONNX Runtime 模型，导出结果按模型名保存在 ONNX_CACHE_DIR，
+             之后启动直接加载，不再重新导出
+intra_op_threads / inter_op_threads 显式设置算子内与算子间的线程数。
+更换后端前先用下面的命令对比吞吐量和与参照模型的余弦偏差：
+    python embedding_service.py --backend int8 --backend onnx --docs testDemo/docs
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import shutil
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+EMBEDDING_BACKENDS = ('torch', 'int8', 'onnx')
+
+# 导出的 ONNX 模型和分词器的保存目录，每个模型一个子目录
+ONNX_CACHE_DIR = os.getenv('ONNX_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'onnx_embeddings'))
+
+
+def register_embeddings(embeddings):
+    """把嵌入对象的类登记为 LangChain Embeddings 的虚拟子类，使其通过 FAISS 等的类型检查"""
+    from langchain_core.embeddings import Embeddings
+
+    if not isinstance(embeddings, Embeddings):
+        Embeddings.register(type(embeddings))
+    return embeddings
+
+
+def configure_torch_threads(intra_op_threads=None, inter_op_threads=None):
+    import torch
+
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # 已经执行过并行计算后不能再修改
+            logger.warning("Inter-op thread count can only be set before the first parallel work")
+
+
+class OnnxEmbeddings:
+    """ONNX Runtime 推理的句向量模型，按 attention mask 做平均池化"""
+
+    def __init__(self, model_name, intra_op_threads=None, inter_op_threads=None, batch_size=32, max_length=128,
+                 cache_dir=None):
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads:
+            options.inter_op_num_threads = inter_op_threads
+        export_dir = os.path.join(cache_dir or ONNX_CACHE_DIR, model_name.replace('/', '--'))
+        if not os.path.exists(os.path.join(export_dir, 'model.onnx')):
+            self.export(model_name, export_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(export_dir, session_options=options)
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    @staticmethod
+    def export(model_name, export_dir):
+        """把模型导出为 ONNX 并连同分词器保存到 export_dir；先写临时目录再改名，多个进程同时导出时只保留一份"""
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        started = time.monotonic()
+        tmp_dir = f"{export_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(tmp_dir)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(tmp_dir)
+        try:
+            os.rename(tmp_dir, export_dir)
+        except OSError:
+            # 其他进程已先完成导出
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        logger.info("Exported %s to ONNX at %s in %.1fs", model_name, export_dir, time.monotonic() - started)
+
+    def embed_documents(self, texts):
+        import numpy as np
+
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(texts[i:i + self.batch_size], padding=True, truncation=True,
+                                    max_length=self.max_length, return_tensors='np')
+            hidden = self.model(**inputs).last_hidden_state
+            mask = inputs['attention_mask'][..., None].astype(hidden.dtype)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            vectors.extend(pooled.tolist())
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def load_embeddings(model_name, backend='torch', intra_op_threads=None, inter_op_threads=None, **kwargs):
+    """按后端加载嵌入模型，返回 LangChain Embeddings"""
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    if backend == 'onnx':
+        return OnnxEmbeddings(model_name, intra_op_threads, inter_op_threads)
+
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    configure_torch_threads(intra_op_threads, inter_op_threads)
+    model = HuggingFaceEmbeddings(model_name=model_name, **kwargs)
+    if backend == 'int8':
+        import torch
+        torch.ao.quantization.quantize_dynamic(model.client, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+class LazyEmbeddings:
+    def __init__(self, model_name, backend='torch', intra_op_threads=None, inter_op_threads=None, **kwargs):
+        self.model_name = model_name
+        self.backend = backend
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.kwargs = kwargs
+        self._model = None
+        self._lock = threading.Lock()
+        self.load_seconds = None
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def load(self):
+        """加载模型并返回，已加载时直接返回"""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    started = time.monotonic()
+                    self._model = load_embeddings(self.model_name, self.backend, self.intra_op_threads,
+                                                  self.inter_op_threads, **self.kwargs)
+                    self.load_seconds = round(time.monotonic() - started, 3)
+                    logger.info("Loaded embedding model %s (%s) in %ss",
+                                self.model_name, self.backend, self.load_seconds)
+        return self._model
+
+    def embed_documents(self, texts):
+        return self.load().embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.load().embed_query(text)
+
+
+class QueryBatcher:
+    def __init__(self, embed_documents, max_batch_size=32, max_wait_ms=5, window=1000, load=None):
+        """
+        并发到达的查询向量请求由一个工作线程汇总：取到第一个请求后最多再等 max_wait_ms 毫秒
+        或凑满 max_batch_size 个，用一次 embed_documents 计算整批向量后分发给各个调用方
+        load 为加载模型的函数，调用方在排队前先等模型加载完成，冷启动下载模型的时间不计入等待超时
+        """
+        self.embed_documents = embed_documents
+        self.load = load
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        # 最近 window 批的批大小、排队等待和前向计算耗时（秒）
+        self._batch_sizes = deque(maxlen=window)
+        self._waits = deque(maxlen=window)
+        self._compute = deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='query-embedder', daemon=True)
+                self._thread.start()
+
+    def embed(self, text, timeout=30):
+        """返回 text 的查询向量，调用方阻塞到所在批次计算完成，timeout 不含模型加载时间"""
+        if self.load is not None:
+            self.load()
+        self.start()
+        future = Future()
+        self._queue.put((text, time.monotonic(), future))
+        return future.result(timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            # 同一批中的相同问题只计算一次
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            try:
+                vectors = dict(zip(texts, self.embed_documents(texts)))
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.monotonic()
+            for text, _, future in batch:
+                future.set_result(vectors[text])
+            with self._stats_lock:
+                self.requests += len(batch)
+                self.batches += 1
+                self._batch_sizes.append(len(batch))
+                self._waits.extend(started - enqueued for _, enqueued, _ in batch)
+                self._compute.append(finished - started)
+
+    def stats(self):
+        def summary(values, scale=1):
+            if not values:
+                return None
+            ordered = sorted(values)
+            return {
+                'mean': round(statistics.fmean(ordered) * scale, 3),
+                'p50': round(ordered[len(ordered) // 2] * scale, 3),
+                'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * scale, 3),
+                'max': round(ordered[-1] * scale, 3),
+            }
+
+        with self._stats_lock:
+            return {
+                'requests': self.requests,
+                'batches': self.batches,
+                'queue_depth': self._queue.qsize(),
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'batch_size': summary(self._batch_sizes),
+                'queue_wait_ms': summary(self._waits, 1000),
+                'compute_ms': summary(self._compute, 1000),
+            }
+
+
+def sample_texts(docs_dir, count, size=200):
+    """从文档目录的 .txt 文件中截取 count 段文本作为测试样本"""
+    texts = []
+    if docs_dir and os.path.isdir(docs_dir):
+        for filename in sorted(os.listdir(docs_dir)):
+            if filename.endswith('.txt'):
+                with open(os.path.join(docs_dir, filename), 'r', encoding='utf-8', errors='ignore') as f:
+                    content = f.read()
+                texts.extend(content[i:i + size] for i in range(0, len(content), size) if content[i:i + size].strip())
+            if len(texts) >= count:
+                break
+    if not texts:
+        texts = ["向量检索把文本映射为稠密向量", "矩阵的特征值与特征向量", "如何计算函数的导数",
+                 "今天天气很好，适合出去散步", "牛顿第二定律描述了力与加速度的关系"]
+    return [texts[i % len(texts)] for i in range(count)]
+
+
+def measure(model, texts, batch_size):
+    model.embed_documents(texts[:batch_size])  # 预热
+    started = time.perf_counter()
+    vectors = []
+    for i in range(0, len(texts), batch_size):
+        vectors.extend(model.embed_documents(texts[i:i + batch_size]))
+    return vectors, len(texts) / (time.perf_counter() - started)
+
+
+def cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = (sum(x * x for x in a) * sum(y * y for y in b)) ** 0.5
+    return dot / norm if norm else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比嵌入后端与参照模型的吞吐量和余弦偏差")
+    parser.add_argument('--model', default="shibing624/text2vec-base-chinese")
+    parser.add_argument('--backend', action='append', choices=EMBEDDING_BACKENDS[1:], help="可重复指定")
+    parser.add_argument('--docs', help="从该目录的 .txt 文件取样本")
+    parser.add_argument('--samples', type=int, default=256)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--intra-op-threads', type=int)
+    parser.add_argument('--inter-op-threads', type=int)
+    args = parser.parse_args()
+
+    texts = sample_texts(args.docs, args.samples)
+    threads = dict(intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads)
+    reference, reference_rate = measure(load_embeddings(args.model, 'torch', **threads), texts, args.batch_size)
+    print(json.dumps({'backend': 'torch', 'texts_per_s': round(reference_rate, 1)}))
+    for backend in args.backend or ['int8', 'onnx']:
+        vectors, rate = measure(load_embeddings(args.model, backend, **threads), texts, args.batch_size)
+        similarities = sorted(cosine(a, b) for a, b in zip(reference, vectors))
+        print(json.dumps({
+            'backend': backend,
+            'texts_per_s': round(rate, 1),
+            'speedup': round(rate / reference_rate, 2),
+            'cosine_mean': round(statistics.fmean(similarities), 5),
+            'cosine_p5': round(similarities[int(len(similarities) * 0.05)], 5),
+            'cosine_min': round(similarities[0], 5),
+        }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+gunicorn 多进程部署配置
+
+    gunicorn -c gunicorn.conf.py appV2:app
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi_app:app
+
+主进程预先导入应用并加载嵌入模型和索引快照，worker 在 fork 后共享这些内存。
+所有 worker 共用 INDEX_DIR：上传到任一 worker 的文档只在持有构建锁的进程中嵌入一次，
+发布为新快照后其余 worker 在 INDEX_POLL_INTERVAL 秒内切换过去（见 vector_index）。
+登录令牌、/api/chat 的服务端会话、上传索引任务的状态、回答缓存和可续传流的帧缓冲等其余状态仍在各 worker 内存中，需要前端代理按客户端保持粘性；
+相同问题的合并也只在同一 worker 内进行。
+"""
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', '4'))
+# Flask 入口用多线程 worker，每个流式响应占用一个线程
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+# 流式回答可能持续较长时间
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = 30
+preload_app = True
+
+
+def when_ready(server):
+    # 在 fork 出 worker 之前于主进程中执行
+    import appV2
+    appV2.preload()
+
+
+def post_fork(server, worker):
+    # 数据库连接、上游客户端和后台线程都要在 worker 中创建
+    import appV2
+    appV2.startup()
@@ -0,0 +1,55 @@
+"""
+/chat_with_image 的图片预处理
+
+把上传的图片转换为不超过 max_size 的 RGB JPEG 并编码为 base64：
+    - JPEG 先用 draft 模式按 1/2、1/4、1/8 缩小解码，再做 LANCZOS 缩放
+    - 已经是尺寸合规的 RGB JPEG 时直接编码原始字节，不再解码重压缩
+解码和缩放在有界线程池中执行，结果按图片内容的 sha256 缓存，重复上传的图片不再处理。
+"""
+import base64
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+from cache_utils import TTLCache
+
+MAX_SIZE = (1024, 1024)
+JPEG_QUALITY = 85
+
+
+def prepare_image(data, max_size=MAX_SIZE, quality=JPEG_QUALITY):
+    """把图片字节转换为 JPEG 的 base64 字符串"""
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    fits = image.width <= max_size[0] and image.height <= max_size[1]
+    if image.format == 'JPEG' and image.mode == 'RGB' and fits:
+        return base64.b64encode(data).decode()
+
+    if image.format == 'JPEG' and not fits:
+        # 解码时直接缩小到不小于目标尺寸的最小比例，省去大部分解码和缩放开销
+        image.draft('RGB', max_size)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail(max_size, Image.Resampling.LANCZOS)
+
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=quality)
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+class ImagePreprocessor:
+    def __init__(self, workers=2, cache_size=128, cache_ttl=3600, max_size=MAX_SIZE, quality=JPEG_QUALITY):
+        self.max_size = max_size
+        self.quality = quality
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-prep')
+
+    def prepare(self, data, timeout=30):
+        """返回图片的 base64，相同内容的图片直接命中缓存"""
+        key = hashlib.sha256(data).hexdigest()
+        img_str = self.cache.get(key)
+        if img_str is None:
+            img_str = self._pool.submit(prepare_image, data, self.max_size, self.quality).result(timeout)
+            self.cache.put(key, img_str)
+        return img_str
@@ -0,0 +1,136 @@
+"""
+上传文档的后台索引队列
+
+/upload 只保存文件并入队，立即返回 202 和任务 id；唯一的后台线程负责更新向量索引。
+取到第一个任务后继续等待 debounce 秒，期间陆续到达的上传合并到同一次更新，
+最早的任务最多等待 max_delay 秒；更新进行中到达的上传在下一次更新中一起处理。
+更新本身是增量的（见 VectorIndex.refresh），连续上传十个文件只需一到两次更新，
+索引的计算量只与新增内容有关，与上传次数无关。
+更新成功但某个上传的文件本身处理失败（如缺少解析 pdf 的依赖）时，该文件的任务标记为 failed 并附带错误。
+排队的任务数有上限，队列已满时抛出 IndexQueueFull。
+"""
+import logging
+import queue
+import threading
+import time
+import uuid
+
+from cache_utils import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class IndexQueueFull(Exception):
+    pass
+
+
+class IndexJobQueue:
+    def __init__(self, refresh_fn, maxsize=100, debounce=0.5, max_delay=5.0, job_ttl=3600):
+        """
+        refresh_fn(progress) 把文档目录的变化同步到索引并返回统计信息，统计信息的 errors 为处理失败的文件名 -> 错误信息，
+        更新过程中调用 progress(files_done, files_total, chunks_embedded) 报告进度
+        """
+        self.refresh_fn = refresh_fn
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        # 任务 id -> 任务状态，供查询接口使用
+        self.jobs = TTLCache(maxsize=10000, ttl=job_ttl)
+        # 正在进行的更新
+        self._current = None
+        self.enqueued = 0
+        self.updates = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.last_update_seconds = None
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='indexer', daemon=True)
+                self._thread.start()
+
+    def submit(self, filename):
+        """上传的文件入队，返回任务 id；队列已满时抛出 IndexQueueFull"""
+        self.start()
+        job_id = uuid.uuid4().hex
+        job = {'id': job_id, 'filename': filename, 'status': 'queued', 'queued_at': time.time(),
+               'started_at': None, 'finished_at': None, 'update': None, 'error': None, 'result': None}
+        # 先记录状态，避免后台线程处理完成后被覆盖
+        self.jobs.put(job_id, job)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self.jobs.pop(job_id)
+            raise IndexQueueFull("Indexing queue is full")
+        self.enqueued += 1
+        return job_id
+
+    def job(self, job_id):
+        """返回任务状态的副本，索引中的任务附带本次更新的进度；任务不存在时返回 None"""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        job = dict(job)
+        current = self._current
+        if job['status'] == 'indexing' and current is not None and current['update'] == job['update']:
+            job['progress'] = dict(current)
+        return job
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while True:
+            timeout = min(self.debounce, deadline - time.monotonic())
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self.updates += 1
+            self.coalesced += len(batch) - 1
+            update = {'update': self.updates, 'jobs': len(batch), 'files_done': 0, 'files_total': 0,
+                      'chunks_embedded': 0}
+            started = time.time()
+            for job in batch:
+                job.update(status='indexing', started_at=started, update=self.updates)
+            self._current = update
+
+            def progress(files_done, files_total, chunks_embedded):
+                update.update(files_done=files_done, files_total=files_total, chunks_embedded=chunks_embedded)
+
+            status, result, error = 'done', None, None
+            try:
+                result = self.refresh_fn(progress)
+            except Exception as e:
+                logger.error("Error updating vector index for %d uploads: %s", len(batch), e)
+                status, error = 'failed', str(e)
+                self.failed += 1
+            finished = time.time()
+            self.last_update_seconds = round(finished - started, 3)
+            self._current = None
+            file_errors = (result or {}).get('errors') or {}
+            for job in batch:
+                file_error = file_errors.get(job['filename'])
+                if file_error is not None:
+                    job.update(status='failed', finished_at=finished, result=result, error=file_error)
+                else:
+                    job.update(status=status, finished_at=finished, result=result, error=error)
+
+    def stats(self):
+        current = self._current
+        return {
+            'queue_depth': self._queue.qsize(),
+            'max_depth': self._queue.maxsize,
+            'enqueued': self.enqueued,
+            'updates': self.updates,
+            'coalesced': self.coalesced,
+            'failed_updates': self.failed,
+            'indexing': dict(current) if current is not None else None,
+            'last_update_seconds': self.last_update_seconds,
+        }
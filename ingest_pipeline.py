@@ -0,0 +1,214 @@
+"""
+文档入库流水线
+
+文本提取和切分在进程池中并行执行，切分结果经有界队列流向嵌入阶段，
+按固定大小凑批后调用一次 embed_documents。进程池的在途任务数和队列长度都有上限，
+批量导入大量文件时内存占用保持平稳。结束时汇报 docs/s、chunks/s、embeddings/s。
+服务进程里有日志、SSE 生产者和嵌入等后台线程，直接 fork 的子进程可能卡在 fork 时被持有的锁上，
+进程池因此用 forkserver 启动子进程（不支持时用 spawn）。直接运行的脚本调用入库流水线时
+需要放在 if __name__ == '__main__' 之下，否则子进程导入主模块时会再次执行入库。
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import subprocess
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+# 支持提取文本的文件类型，与上传接口允许的类型一致
+SUPPORTED_EXTENSIONS = ('.txt', '.pdf', '.doc', '.docx')
+
+# 队列结束标记
+_DONE = object()
+
+
+def _pool_context():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def extract_text(path):
+    """按扩展名提取文件中的纯文本"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.txt':
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    if ext == '.pdf':
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            raise RuntimeError("解析 PDF 需要安装 pypdf")
+        reader = PdfReader(path)
+        return "\n".join(page.extract_text() or '' for page in reader.pages)
+    if ext == '.docx':
+        try:
+            import docx
+        except ImportError:
+            raise RuntimeError("解析 DOCX 需要安装 python-docx")
+        document = docx.Document(path)
+        return "\n".join(paragraph.text for paragraph in document.paragraphs)
+    if ext == '.doc':
+        # 旧版 Word 格式没有可靠的纯 Python 解析库，交给 antiword 处理
+        try:
+            result = subprocess.run(['antiword', '-w', '0', path], capture_output=True, check=True, timeout=60)
+        except FileNotFoundError:
+            raise RuntimeError("解析 DOC 需要安装 antiword")
+        return result.stdout.decode('utf-8', errors='replace')
+    raise ValueError(f"不支持的文件类型: {ext}")
+
+
+# 每个工作进程复用一个切分器
+_splitter = None
+
+
+def load_and_split(name, path, sha256, chunk_size, chunk_overlap):
+    """在工作进程中执行：提取文本并切分，返回 (文件名, sha256, 文本块, 错误信息)"""
+    global _splitter
+    from langchain.text_splitter import CharacterTextSplitter
+
+    if _splitter is None or (_splitter._chunk_size, _splitter._chunk_overlap) != (chunk_size, chunk_overlap):
+        _splitter = CharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    try:
+        return name, sha256, _splitter.split_text(extract_text(path)), None
+    except Exception as e:
+        return name, sha256, [], str(e)
+
+
+class IngestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.docs = 0
+        self.failed = 0
+        self.chunks = 0
+        self.embeddings = 0
+        self.batches = 0
+        self.elapsed = 0.0
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+        return self
+
+    def as_dict(self):
+        elapsed = self.elapsed or 1e-9
+        return {
+            'docs': self.docs,
+            'failed': self.failed,
+            'chunks': self.chunks,
+            'embeddings': self.embeddings,
+            'batches': self.batches,
+            'seconds': round(self.elapsed, 3),
+            'docs_per_s': round(self.docs / elapsed, 2),
+            'chunks_per_s': round(self.chunks / elapsed, 2),
+            'embeddings_per_s': round(self.embeddings / elapsed, 2),
+        }
+
+
+class IngestPipeline:
+    def __init__(self, embeddings, chunk_size=1000, chunk_overlap=200,
+                 batch_size=256, workers=None, queue_size=64):
+        self.embeddings = embeddings
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+
+    def run(self, files, on_file, on_batch):
+        """
+        处理文件列表 [(文件名, 路径, sha256), ...]
+
+        on_file(name, sha256, chunks, error) 在每个文件切分完成后调用，返回该文件各文本块的 id
+        on_batch(texts, vectors, metadatas, ids) 在每批嵌入完成后调用
+        返回 IngestStats
+        """
+        stats = IngestStats()
+        results = queue.Queue(maxsize=self.queue_size)
+        args = [(name, path, sha256, self.chunk_size, self.chunk_overlap) for name, path, sha256 in files]
+
+        stop = threading.Event()
+        if len(args) <= 1:
+            # 单个文件不值得启动进程池
+            for item in args:
+                results.put(load_and_split(*item))
+            results.put(_DONE)
+            producer = None
+        else:
+            producer = threading.Thread(target=self._produce, args=(args, results, stop), daemon=True)
+            producer.start()
+
+        texts, metadatas, ids = [], [], []
+        try:
+            while True:
+                item = results.get()
+                if isinstance(item, BaseException):
+                    raise item
+                if item is _DONE:
+                    break
+                name, sha256, chunks, error = item
+                chunk_ids = on_file(name, sha256, chunks, error)
+                if error:
+                    stats.failed += 1
+                    continue
+                stats.docs += 1
+                stats.chunks += len(chunks)
+                for i, chunk in enumerate(chunks):
+                    texts.append(chunk)
+                    metadatas.append({'source': name, 'chunk': i})
+                    ids.append(chunk_ids[i])
+                    if len(texts) >= self.batch_size:
+                        self._embed(texts, metadatas, ids, on_batch, stats)
+                        texts, metadatas, ids = [], [], []
+            if texts:
+                self._embed(texts, metadatas, ids, on_batch, stats)
+        finally:
+            # 嵌入阶段出错时通知生产者停止提交
+            stop.set()
+            if producer is not None:
+                producer.join()
+
+        logger.info("Ingestion finished: %s", stats.finish().as_dict())
+        return stats
+
+    def _produce(self, args, results, stop):
+        """提交切分任务，在途任务数受限，结果按完成顺序放入有界队列"""
+        try:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(args)), mp_context=_pool_context()) as pool:
+                pending = set()
+                items = iter(args)
+                while not stop.is_set():
+                    while len(pending) < self.workers * 2:
+                        item = next(items, None)
+                        if item is None:
+                            break
+                        pending.add(pool.submit(load_and_split, *item))
+                    if not pending:
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._put(results, future.result(), stop)
+                for future in pending:
+                    future.cancel()
+            self._put(results, _DONE, stop)
+        except Exception as e:
+            self._put(results, e, stop)
+
+    @staticmethod
+    def _put(results, item, stop):
+        """队列满时阻塞等待，消费者退出后放弃"""
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _embed(self, texts, metadatas, ids, on_batch, stats):
+        vectors = self.embeddings.embed_documents(texts)
+        stats.embeddings += len(vectors)
+        stats.batches += 1
+        on_batch(texts, vectors, metadatas, ids)
@@ -0,0 +1,59 @@
+"""
+非阻塞日志
+
+请求线程里的日志调用只把记录放入内存队列，由 QueueListener 的后台线程写到 stderr，
+流式响应等热点路径不再同步等待终端 I/O。
+fork 出的子进程（如 gunicorn preload 之后的 worker）中没有这个后台线程，子进程换用新的队列并重新启动监听。
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+_listener = None
+
+
+def setup_logging(level=logging.INFO, maxsize=10000):
+    """为根日志器安装 QueueHandler，重复调用时不会重复安装"""
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.Queue(maxsize=maxsize)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(threadName)s] %(name)s: %(message)s'))
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_stop)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_restart_in_child)
+
+    root = logging.getLogger()
+    root.handlers[:] = [_DroppingQueueHandler(log_queue)]
+    root.setLevel(level)
+
+
+def _stop():
+    if _listener is not None:
+        _listener.stop()
+
+
+def _restart_in_child():
+    global _listener
+    # 父进程的队列可能在 fork 时正被其他线程持有锁，子进程不再使用它
+    log_queue = queue.Queue(maxsize=_listener.queue.maxsize)
+    _listener = logging.handlers.QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, _DroppingQueueHandler):
+            handler.queue = log_queue
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列已满时丢弃日志，不阻塞调用方"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
@@ -0,0 +1,213 @@
+"""
+请求级别的延迟指标
+
+按 Prometheus 文本格式导出直方图和计数器，供 /metrics 抓取：
+    rag_retrieval_seconds       向量检索（含并行的网络搜索）耗时
+    prompt_build_seconds        上下文组装与提示构建耗时
+    upstream_ttft_seconds       发起上游请求到收到首个内容分片的时间
+    stream_tokens_per_second    首字之后的输出速度（按流式分片计数）
+    stream_duration_seconds     整个流式响应的时长
+    image_prep_seconds          图片解码、缩放和编码耗时
+    upstream_request_seconds    非流式上游请求耗时
+    upload_index_seconds        上传后后台更新向量索引的耗时（多次上传合并为一次更新）
+    requests_total              按接口、模型和结果计数的请求数
+    sse_client_disconnects_total  流结束前断开的 SSE 连接数；回答在后台继续生成，不计入 requests_total 的结果
+"""
+import asyncio
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for label_values, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, label_values, ('le', _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.started
+        self.histogram.observe(self.elapsed, *self.label_values)
+        return False
+
+
+RETRIEVAL_SECONDS = Histogram('rag_retrieval_seconds', "Vector search time, including parallel web search",
+                              ('endpoint', 'model'))
+PROMPT_BUILD_SECONDS = Histogram('prompt_build_seconds', "Context assembly and prompt construction time",
+                                 ('endpoint', 'model'))
+UPSTREAM_TTFT_SECONDS = Histogram('upstream_ttft_seconds', "Time from upstream request to first content chunk",
+                                  ('endpoint', 'model'))
+TOKENS_PER_SECOND = Histogram('stream_tokens_per_second', "Streamed chunks per second after the first chunk",
+                              ('endpoint', 'model'), buckets=RATE_BUCKETS)
+STREAM_DURATION_SECONDS = Histogram('stream_duration_seconds', "Total duration of a streamed response",
+                                    ('endpoint', 'model'))
+IMAGE_PREP_SECONDS = Histogram('image_prep_seconds', "Image decode, resize and encode time", ('model',))
+UPSTREAM_REQUEST_SECONDS = Histogram('upstream_request_seconds', "Non-streaming upstream request time",
+                                     ('endpoint', 'model'))
+UPLOAD_INDEX_SECONDS = Histogram('upload_index_seconds', "Vector index sync time after an upload", ('endpoint',))
+REQUESTS_TOTAL = Counter('requests_total', "Requests by endpoint, model and outcome",
+                         ('endpoint', 'model', 'outcome'))
+CLIENT_DISCONNECTS = Counter('sse_client_disconnects_total', "SSE responses closed by the client before the stream ended",
+                             ('endpoint', 'model'))
+
+REGISTRY = (RETRIEVAL_SECONDS, PROMPT_BUILD_SECONDS, UPSTREAM_TTFT_SECONDS, TOKENS_PER_SECOND,
+            STREAM_DURATION_SECONDS, IMAGE_PREP_SECONDS, UPSTREAM_REQUEST_SECONDS, UPLOAD_INDEX_SECONDS,
+            REQUESTS_TOTAL, CLIENT_DISCONNECTS)
+
+
+class StreamTimer:
+    """
+    记录一次流式响应的首字时间、输出速度和总时长；在发起上游请求前创建，
+    用 track 包装增量文本迭代器，迭代结束或出错时写入指标
+    生成在后台进行，与客户端连接无关，客户端断开由 track_disconnects 单独计数
+    """
+
+    def __init__(self, endpoint, model):
+        self.endpoint = endpoint
+        self.model = model
+        self.started = time.perf_counter()
+        self.first_at = None
+        self.chunks = 0
+        self.finished = False
+
+    def _on_chunk(self):
+        if self.first_at is None:
+            self.first_at = time.perf_counter()
+            UPSTREAM_TTFT_SECONDS.observe(self.first_at - self.started, self.endpoint, self.model)
+        self.chunks += 1
+
+    def finish(self, outcome='ok'):
+        if self.finished:
+            return
+        self.finished = True
+        now = time.perf_counter()
+        STREAM_DURATION_SECONDS.observe(now - self.started, self.endpoint, self.model)
+        if self.first_at is not None and self.chunks > 1 and now > self.first_at:
+            TOKENS_PER_SECOND.observe((self.chunks - 1) / (now - self.first_at), self.endpoint, self.model)
+        REQUESTS_TOTAL.inc(self.endpoint, self.model, outcome)
+
+    def track(self, deltas):
+        outcome = 'error'
+        try:
+            for delta in deltas:
+                self._on_chunk()
+                yield delta
+            outcome = 'ok'
+        finally:
+            self.finish(outcome)
+
+    async def atrack(self, deltas):
+        outcome = 'error'
+        try:
+            async for delta in deltas:
+                self._on_chunk()
+                yield delta
+            outcome = 'ok'
+        finally:
+            self.finish(outcome)
+
+
+def track_disconnects(frames, endpoint, model):
+    """包装发给客户端的帧迭代器，客户端在流结束前断开时计数"""
+    try:
+        yield from frames
+    except GeneratorExit:
+        CLIENT_DISCONNECTS.inc(endpoint, model)
+        raise
+
+
+async def atrack_disconnects(frames, endpoint, model):
+    try:
+        async for frame in frames:
+            yield frame
+    except (GeneratorExit, asyncio.CancelledError):
+        CLIENT_DISCONNECTS.inc(endpoint, model)
+        raise
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,423 @@
+"""
+上游模型服务的客户端层
+
+每个服务商共用一组带连接池的同步/异步客户端，并配有准入控制：
+    - 并发上限：同时进行中的请求数不超过 max_concurrency
+    - 令牌桶：每秒发起的请求数不超过 rate（0 表示不限）
+    - 有界等待队列：等待者超过 max_waiting 时立即拒绝，等待超时同样拒绝
+拒绝时抛出 ProviderBusy，由路由转换为 429/503 响应。
+建立请求时遇到网络错误、超时、429 和 5xx 会按带抖动的指数退避重试。
+openai/zhipuai SDK 在服务商第一次发起请求时才导入并创建客户端。
+"""
+import asyncio
+import collections
+import logging
+import os
+import random
+import threading
+import time
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# 可重试的 HTTP 状态码
+TRANSIENT_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+# 异步等待者两次检查并发名额的最长间隔，兜底错过的唤醒
+ASYNC_RECHECK_INTERVAL = 0.1
+
+
+class ProviderBusy(Exception):
+    """服务商繁忙，请求未被放行"""
+
+    def __init__(self, provider, reason, status_code=503, retry_after=1):
+        super().__init__(f"{provider} is busy: {reason}")
+        self.provider = provider
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def is_transient(error):
+    """判断上游错误是否值得重试"""
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None:
+        return status in TRANSIENT_STATUS
+    if isinstance(error, (httpx.TransportError, TimeoutError, ConnectionError)):
+        return True
+    return type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+
+def _set_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Slot:
+    """一次放行的请求名额，release 可重复调用"""
+
+    def __init__(self, gate):
+        self._gate = gate
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._gate._release()
+
+    def __del__(self):
+        # 迭代器未被消费就被丢弃时兜底归还名额
+        self.release()
+
+
+class ProviderGate:
+    def __init__(self, name, max_concurrency=32, max_waiting=64, rate=0.0, burst=None, acquire_timeout=10.0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.acquire_timeout = acquire_timeout
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        # 等待并发名额的协程：(事件循环, future)，名额归还时唤醒一个
+        self._async_waiters = collections.deque()
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self.admitted = 0
+        self.rejected = 0
+
+    def _enter_queue(self):
+        with self._lock:
+            if self._waiting >= self.max_waiting:
+                self.rejected += 1
+                raise ProviderBusy(self.name, 'wait queue is full', 503)
+            self._waiting += 1
+
+    def _leave_queue(self):
+        with self._lock:
+            self._waiting -= 1
+
+    def _release(self):
+        """归还一个并发名额，并唤醒一个异步等待者"""
+        self._semaphore.release()
+        self._wake_one()
+
+    def _wake_one(self):
+        with self._lock:
+            while self._async_waiters:
+                loop, waiter = self._async_waiters.popleft()
+                if not waiter.done():
+                    try:
+                        loop.call_soon_threadsafe(_set_waiter, waiter)
+                        return
+                    except RuntimeError:
+                        # 事件循环已关闭
+                        continue
+
+    async def _acquire_semaphore_async(self, deadline):
+        """在事件循环中等待并发名额：名额归还时被唤醒，另以 ASYNC_RECHECK_INTERVAL 兜底重试"""
+        loop = asyncio.get_running_loop()
+        while not self._semaphore.acquire(blocking=False):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._reject('too many concurrent requests', 503)
+            waiter = loop.create_future()
+            with self._lock:
+                self._async_waiters.append((loop, waiter))
+            # 登记后再试一次，避免登记前刚归还的名额无人唤醒
+            acquired = self._semaphore.acquire(blocking=False)
+            try:
+                if not acquired:
+                    await asyncio.wait({waiter}, timeout=min(remaining, ASYNC_RECHECK_INTERVAL))
+            except BaseException:
+                self._forget_waiter(loop, waiter)
+                raise
+            self._forget_waiter(loop, waiter, handoff=acquired)
+            if acquired:
+                return
+
+    def _forget_waiter(self, loop, waiter, handoff=True):
+        """撤销登记；已被唤醒但不再使用这次唤醒（被取消或已拿到名额）时转交给下一个等待者"""
+        with self._lock:
+            try:
+                self._async_waiters.remove((loop, waiter))
+                return
+            except ValueError:
+                pass
+        if handoff:
+            self._wake_one()
+
+    def _take_token(self):
+        """从令牌桶取一个令牌，返回还需等待的秒数，0 表示已取到"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def _admitted(self):
+        with self._lock:
+            self.admitted += 1
+        return Slot(self)
+
+    def _reject(self, reason, status_code):
+        with self._lock:
+            self.rejected += 1
+        raise ProviderBusy(self.name, reason, status_code)
+
+    def acquire(self):
+        """等待并发名额和令牌，超时或队列已满时抛出 ProviderBusy"""
+        deadline = time.monotonic() + self.acquire_timeout
+        self._enter_queue()
+        try:
+            if not self._semaphore.acquire(timeout=self.acquire_timeout):
+                self._reject('too many concurrent requests', 503)
+            try:
+                while True:
+                    wait = self._take_token()
+                    if not wait:
+                        return self._admitted()
+                    if time.monotonic() + wait > deadline:
+                        self._reject('rate limit exceeded', 429)
+                    time.sleep(wait)
+            except BaseException:
+                self._release()
+                raise
+        finally:
+            self._leave_queue()
+
+    async def acquire_async(self):
+        """acquire 的异步版本，等待期间不阻塞事件循环"""
+        deadline = time.monotonic() + self.acquire_timeout
+        self._enter_queue()
+        try:
+            await self._acquire_semaphore_async(deadline)
+            # 拿到名额后等待令牌期间可能被取消，任何异常都要归还名额
+            try:
+                while True:
+                    wait = self._take_token()
+                    if not wait:
+                        return self._admitted()
+                    if time.monotonic() + wait > deadline:
+                        self._reject('rate limit exceeded', 429)
+                    await asyncio.sleep(wait)
+            except BaseException:
+                self._release()
+                raise
+        finally:
+            self._leave_queue()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_concurrency': self.max_concurrency,
+                'waiting': self._waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+            }
+
+
+class ProviderStream:
+    """上游流式响应的包装，迭代结束或调用 close 时关闭连接并归还名额，close 可从其他线程调用"""
+
+    def __init__(self, response, slot):
+        self.response = response
+        self.slot = slot
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            yield from self.response
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            close = getattr(self.response, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.slot.release()
+
+
+class AsyncProviderStream:
+    def __init__(self, response, slot):
+        self.response = response
+        self.slot = slot
+        self.closed = False
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.response:
+                yield chunk
+        finally:
+            await self.aclose()
+
+    async def aclose(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            await self.response.close()
+        finally:
+            self.slot.release()
+
+
+class Provider:
+    def __init__(self, name, client_factory, gate, max_retries=2, backoff_base=0.5, backoff_max=8.0):
+        """client_factory() 返回 (同步客户端, 异步客户端)，第一次使用时调用"""
+        self.name = name
+        self._client_factory = client_factory
+        self._clients = None
+        self._clients_lock = threading.Lock()
+        self.gate = gate
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def _get_clients(self):
+        if self._clients is None:
+            with self._clients_lock:
+                if self._clients is None:
+                    self._clients = self._client_factory()
+        return self._clients
+
+    def warm(self):
+        """提前导入 SDK 并创建客户端"""
+        self._get_clients()
+
+    @property
+    def client(self):
+        return self._get_clients()[0]
+
+    @property
+    def async_client(self):
+        return self._get_clients()[1]
+
+    def _backoff(self, attempt):
+        """带完全抖动的指数退避"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def admit(self):
+        return self.gate.acquire()
+
+    async def admit_async(self):
+        return await self.gate.acquire_async()
+
+    def _create(self, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.client.chat.completions.create(**kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient(e):
+                    raise
+                logger.warning("%s request failed (%s), retrying", self.name, e)
+                time.sleep(self._backoff(attempt))
+
+    async def _acreate(self, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self.async_client.chat.completions.create(**kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient(e):
+                    raise
+                logger.warning("%s request failed (%s), retrying", self.name, e)
+                await asyncio.sleep(self._backoff(attempt))
+
+    def stream(self, slot, **kwargs):
+        """发起流式请求，返回 ProviderStream；迭代结束、出错或被关闭时归还名额"""
+        try:
+            response = self._create(stream=True, **kwargs)
+        except BaseException:
+            slot.release()
+            raise
+        return ProviderStream(response, slot)
+
+    async def astream(self, slot, **kwargs):
+        """stream 的异步版本，返回 AsyncProviderStream"""
+        try:
+            response = await self._acreate(stream=True, **kwargs)
+        except BaseException:
+            slot.release()
+            raise
+        return AsyncProviderStream(response, slot)
+
+    def complete(self, **kwargs):
+        """非流式请求，名额在请求完成后立即归还"""
+        slot = self.admit()
+        try:
+            return self._create(**kwargs)
+        finally:
+            slot.release()
+
+
+def _env(name, key, default, cast):
+    return cast(os.getenv(f"{name.upper()}_{key}", default))
+
+
+def openai_client(**kwargs):
+    from openai import OpenAI
+    return OpenAI(**kwargs)
+
+
+def zhipuai_client(**kwargs):
+    import zhipuai
+    return zhipuai.ZhipuAI(**kwargs)
+
+
+def build_provider(name, api_key, base_url=None, sync_factory=openai_client):
+    """
+    按环境变量 <NAME>_MAX_CONCURRENCY、<NAME>_MAX_WAITING、<NAME>_RATE、
+    <NAME>_ACQUIRE_TIMEOUT、<NAME>_MAX_RETRIES、<NAME>_TIMEOUT 创建服务商
+    """
+    max_concurrency = _env(name, 'MAX_CONCURRENCY', '32', int)
+    timeout = httpx.Timeout(_env(name, 'TIMEOUT', '60', float), connect=5.0, pool=5.0)
+    limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency,
+                          keepalive_expiry=30.0)
+
+    def client_factory():
+        from openai import AsyncOpenAI
+        # 重试由 Provider 统一处理，客户端自身不再重试
+        client = sync_factory(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0,
+                              http_client=httpx.Client(limits=limits, timeout=timeout))
+        async_client = AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0,
+                                   http_client=httpx.AsyncClient(limits=limits, timeout=timeout))
+        return client, async_client
+
+    gate = ProviderGate(
+        name,
+        max_concurrency=max_concurrency,
+        max_waiting=_env(name, 'MAX_WAITING', '64', int),
+        rate=_env(name, 'RATE', '0', float),
+        acquire_timeout=_env(name, 'ACQUIRE_TIMEOUT', '10', float),
+    )
+    return Provider(name, client_factory, gate, max_retries=_env(name, 'MAX_RETRIES', '2', int))
+
+
+def build_providers(zhipu_api_key=None, deepseek_api_key=None, openai_api_key=None):
+    """创建已配置密钥的服务商，返回 {名称: Provider}"""
+    providers = {}
+    if zhipu_api_key:
+        providers['zhipu'] = build_provider(
+            'zhipu', zhipu_api_key,
+            base_url=os.getenv('ZHIPUAI_BASE_URL', 'https://open.bigmodel.cn/api/paas/v4/'),
+            sync_factory=zhipuai_client)
+    if deepseek_api_key:
+        providers['deepseek'] = build_provider(
+            'deepseek', deepseek_api_key, base_url=os.getenv('DEEPSEEK_BASE_URL', 'https://api.deepseek.com'))
+    if openai_api_key:
+        providers['openai'] = build_provider(
+            'openai', openai_api_key, base_url=os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1'))
+    return providers
@@ -0,0 +1,310 @@
+"""
+按延迟选择服务商的路由器（model=auto）
+
+为每个服务商记录最近若干次请求的首字时间（TTFT），请求优先发给中位 TTFT 最低的健康服务商。
+连续失败达到阈值的服务商在冷却期内排到最后。
+主请求在 first_token_deadline 秒内没有返回首个内容分片时，向排名第二的服务商发起对冲请求，
+哪一路先出首字就采用哪一路，另一路立即取消。首字之前的失败会自动切换到下一个服务商。
+被取消或落败的一路没有首字，按已等待的时间（至少 first_token_deadline）记一个样本，
+变慢的服务商因此会让出首位；本地准入被拒（ProviderBusy）只跳过该服务商，不计为失败。
+"""
+import asyncio
+import logging
+import queue
+import statistics
+import threading
+import time
+from collections import deque
+
+from provider_clients import ProviderBusy
+
+logger = logging.getLogger(__name__)
+
+
+def has_content(chunk):
+    try:
+        return bool(getattr(chunk.choices[0].delta, 'content', None))
+    except (AttributeError, IndexError):
+        return False
+
+
+class ProviderRouter:
+    def __init__(self, providers, first_token_deadline=2.0, window=50, failure_threshold=3, cooldown=30.0):
+        self.providers = providers
+        self.first_token_deadline = first_token_deadline
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._ttft = {name: deque(maxlen=window) for name in providers}
+        self._failures = {name: 0 for name in providers}
+        self._down_until = {name: 0.0 for name in providers}
+        self.hedges = 0
+        self.failovers = 0
+        self.wins = {name: 0 for name in providers}
+
+    def record_ttft(self, name, seconds):
+        with self._lock:
+            self._ttft[name].append(seconds)
+            self._failures[name] = 0
+            self.wins[name] += 1
+
+    def record_cancelled(self, name, seconds):
+        """没有等到首字就被取消的一路，TTFT 至少为已等待的时间，且不短于 first_token_deadline"""
+        with self._lock:
+            self._ttft[name].append(max(seconds, self.first_token_deadline))
+
+    def record_failure(self, name):
+        with self._lock:
+            self._failures[name] += 1
+            if self._failures[name] >= self.failure_threshold:
+                self._down_until[name] = time.monotonic() + self.cooldown
+
+    def ranked(self, names):
+        """健康的服务商按中位 TTFT 升序排在前面，没有样本的按其余服务商中位 TTFT 的中位数排序"""
+        now = time.monotonic()
+        with self._lock:
+            medians = {name: statistics.median(self._ttft[name]) for name in names if self._ttft[name]}
+            prior = statistics.median(medians.values()) if medians else 0.0
+
+            def key(name):
+                return (self._down_until[name] > now, medians.get(name, prior))
+            return sorted(names, key=key)
+
+    def stream(self, requests):
+        """
+        requests 为 {服务商名称: chat.completions.create 参数}
+        返回 (迭代器, 结果)，迭代器产出胜出一路的分片，结果字典在首字到达后写入 provider
+        """
+        result = {'provider': None}
+        return self._stream(requests, result), result
+
+    def _stream(self, requests, result):
+        candidates = self.ranked([name for name in requests if name in self.providers])
+        if not candidates:
+            raise ValueError("No provider available for auto routing")
+
+        events = queue.Queue()
+        attempts = {}
+        started = {}
+        pending = {}
+
+        def launch():
+            name = candidates.pop(0)
+            started[name] = time.monotonic()
+            cancel = threading.Event()
+            holder = {}
+            attempts[name] = (cancel, holder)
+            pending[name] = []
+            threading.Thread(target=self._run, args=(name, requests[name], events, cancel, holder),
+                             daemon=True).start()
+
+        def cancel_attempt(name):
+            cancel, holder = attempts.pop(name)
+            cancel.set()
+            if result['provider'] != name:
+                self.record_cancelled(name, time.monotonic() - started[name])
+            stream = holder.get('stream')
+            if stream is not None:
+                try:
+                    stream.close()
+                except Exception:
+                    logger.warning("Closing cancelled %s stream failed", name, exc_info=True)
+
+        launch()
+        winner = None
+        last_error = None
+        try:
+            while True:
+                hedge_ready = winner is None and candidates and len(attempts) == 1
+                try:
+                    kind, name, payload = events.get(timeout=self.first_token_deadline if hedge_ready else None)
+                except queue.Empty:
+                    # 主请求迟迟没有首字，向下一个服务商发起对冲请求
+                    logger.warning("No first token within %ss, hedging to %s", self.first_token_deadline, candidates[0])
+                    self.hedges += 1
+                    launch()
+                    continue
+
+                if name not in attempts:
+                    # 已取消的一路残留的事件
+                    continue
+                if winner is not None and name != winner:
+                    continue
+
+                if kind == 'chunk':
+                    if winner is None:
+                        if not has_content(payload):
+                            pending[name].append(payload)
+                            continue
+                        winner = name
+                        result['provider'] = name
+                        self.record_ttft(name, time.monotonic() - started[name])
+                        for other in [other for other in attempts if other != name]:
+                            cancel_attempt(other)
+                        yield from pending.pop(name)
+                    yield payload
+                elif kind == 'end':
+                    attempts.pop(name)
+                    if winner is None:
+                        # 没有任何内容就结束，视为成功的空回答
+                        result['provider'] = name
+                        yield from pending.pop(name)
+                    return
+                else:
+                    attempts.pop(name)
+                    if winner is not None:
+                        raise payload
+                    if kind == 'busy':
+                        # 本地准入被拒，服务商本身没有出错
+                        logger.info("Provider %s busy, skipping: %s", name, payload)
+                    else:
+                        self.record_failure(name)
+                        logger.warning("Provider %s failed before first token: %s", name, payload)
+                    last_error = payload
+                    if not attempts:
+                        if not candidates:
+                            raise last_error
+                        self.failovers += 1
+                        launch()
+        finally:
+            for name in list(attempts):
+                cancel_attempt(name)
+
+    def _run(self, name, kwargs, events, cancel, holder):
+        """在工作线程中执行一路请求，把分片和结束/错误事件放入队列"""
+        provider = self.providers[name]
+        try:
+            slot = provider.admit()
+            stream = provider.stream(slot, **kwargs)
+            holder['stream'] = stream
+            if cancel.is_set():
+                stream.close()
+                return
+            for chunk in stream:
+                if cancel.is_set():
+                    return
+                events.put(('chunk', name, chunk))
+            events.put(('end', name, None))
+        except ProviderBusy as e:
+            if not cancel.is_set():
+                events.put(('busy', name, e))
+        except Exception as e:
+            if not cancel.is_set():
+                events.put(('error', name, e))
+
+    def astream(self, requests):
+        """stream 的异步版本，返回 (异步迭代器, 结果)"""
+        result = {'provider': None}
+        return self._astream(requests, result), result
+
+    async def _astream(self, requests, result):
+        candidates = self.ranked([name for name in requests if name in self.providers])
+        if not candidates:
+            raise ValueError("No provider available for auto routing")
+
+        events = asyncio.Queue()
+        tasks = {}
+        started = {}
+        pending = {}
+
+        async def run(name):
+            provider = self.providers[name]
+            try:
+                slot = await provider.admit_async()
+                stream = await provider.astream(slot, **requests[name])
+                async for chunk in stream:
+                    await events.put(('chunk', name, chunk))
+                await events.put(('end', name, None))
+            except asyncio.CancelledError:
+                raise
+            except ProviderBusy as e:
+                await events.put(('busy', name, e))
+            except Exception as e:
+                await events.put(('error', name, e))
+
+        def launch():
+            name = candidates.pop(0)
+            started[name] = time.monotonic()
+            pending[name] = []
+            tasks[name] = asyncio.ensure_future(run(name))
+
+        def cancel_attempt(name):
+            tasks.pop(name).cancel()
+            if result['provider'] != name:
+                self.record_cancelled(name, time.monotonic() - started[name])
+
+        launch()
+        winner = None
+        try:
+            while True:
+                hedge_ready = winner is None and candidates and len(tasks) == 1
+                try:
+                    if hedge_ready:
+                        kind, name, payload = await asyncio.wait_for(events.get(), self.first_token_deadline)
+                    else:
+                        kind, name, payload = await events.get()
+                except asyncio.TimeoutError:
+                    logger.warning("No first token within %ss, hedging to %s", self.first_token_deadline, candidates[0])
+                    self.hedges += 1
+                    launch()
+                    continue
+
+                if name not in tasks or (winner is not None and name != winner):
+                    continue
+
+                if kind == 'chunk':
+                    if winner is None:
+                        if not has_content(payload):
+                            pending[name].append(payload)
+                            continue
+                        winner = name
+                        result['provider'] = name
+                        self.record_ttft(name, time.monotonic() - started[name])
+                        for other in [other for other in tasks if other != name]:
+                            cancel_attempt(other)
+                        for chunk in pending.pop(name):
+                            yield chunk
+                    yield payload
+                elif kind == 'end':
+                    tasks.pop(name)
+                    if winner is None:
+                        result['provider'] = name
+                        for chunk in pending.pop(name):
+                            yield chunk
+                    return
+                else:
+                    tasks.pop(name)
+                    if winner is not None:
+                        raise payload
+                    if kind == 'busy':
+                        logger.info("Provider %s busy, skipping: %s", name, payload)
+                    else:
+                        self.record_failure(name)
+                        logger.warning("Provider %s failed before first token: %s", name, payload)
+                    if not tasks:
+                        if not candidates:
+                            raise payload
+                        self.failovers += 1
+                        launch()
+        finally:
+            for name in list(tasks):
+                cancel_attempt(name)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'first_token_deadline': self.first_token_deadline,
+                'hedges': self.hedges,
+                'failovers': self.failovers,
+                'providers': {
+                    name: {
+                        'median_ttft': round(statistics.median(samples), 4) if samples else None,
+                        'samples': len(samples),
+                        'healthy': self._down_until[name] <= now,
+                        'wins': self.wins[name],
+                    }
+                    for name, samples in self._ttft.items()
+                },
+            }
+
@@ -0,0 +1,120 @@
+"""
+网络搜索服务
+
+在 search_web 外加一层：
+    - 按规范化查询词缓存结果（LRU + TTL）
+    - 每个查询有超时，超时的查询结果按空处理，不拖住请求
+    - 一个问题可改写成多个查询并发执行，结果合并去重
+submit 返回 Future，/index 可以在向量检索的同时进行网络搜索。
+"""
+import json
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from cache_utils import TTLCache
+from vector_index import normalize_question
+
+logger = logging.getLogger(__name__)
+
+# 改写查询时去掉的疑问词和语气词
+_FILLERS = re.compile(r'(请问|请|什么是|是什么|为什么|怎么样|怎么|如何|哪些|吗|呢|吧|呀)')
+_PUNCTUATION = re.compile(r'[？?！!。，,、；;：:\s]+')
+
+
+def rewrite_query(query, max_rewrites=3):
+    """生成若干个查询改写：原问题、去掉疑问词的关键词形式"""
+    rewrites = [query.strip()]
+    keywords = _PUNCTUATION.sub(' ', _FILLERS.sub(' ', query)).strip()
+    if keywords:
+        rewrites.append(keywords)
+    parts = keywords.split()
+    if len(parts) > 2:
+        # 关键词较多时再取最长的两个词组成一个短查询
+        rewrites.append(' '.join(sorted(parts, key=len, reverse=True)[:2]))
+    unique = []
+    for item in rewrites:
+        if item and item not in unique:
+            unique.append(item)
+    return unique[:max_rewrites]
+
+
+def result_key(result):
+    if isinstance(result, dict):
+        return result.get('url') or result.get('link') or json.dumps(result, ensure_ascii=False, sort_keys=True)
+    return str(result)
+
+
+def format_results(results, limit=5):
+    """把搜索结果整理成可以拼进提示的文本"""
+    lines = []
+    for result in results[:limit]:
+        if isinstance(result, dict):
+            title = result.get('title', '')
+            snippet = result.get('snippet') or result.get('content') or result.get('body') or ''
+            lines.append(f"- {title}: {snippet}".strip())
+        else:
+            lines.append(f"- {result}")
+    return "\n".join(lines)
+
+
+class SearchService:
+    def __init__(self, search_fn, cache_size=512, cache_ttl=600, timeout=5.0, workers=8, max_rewrites=3):
+        self.search_fn = search_fn
+        self.timeout = timeout
+        self.max_rewrites = max_rewrites
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='web-search')
+        # submit 的外层任务只等待 _pool 中的查询，单独的线程池保证查询不会排在等待它的任务后面
+        self._dispatch = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='web-search-dispatch')
+        self.timeouts = 0
+        self.errors = 0
+
+    def _search(self, query):
+        key = normalize_question(query)
+        results = self.cache.get(key)
+        if results is None:
+            results = self.search_fn(query) or []
+            self.cache.put(key, results)
+        return results
+
+    def search(self, query, timeout=None):
+        """单个查询，超时抛出 TimeoutError"""
+        try:
+            return self._pool.submit(self._search, query).result(timeout or self.timeout)
+        except FutureTimeout:
+            self.timeouts += 1
+            raise TimeoutError(f"Web search timed out: {query}")
+
+    def search_many(self, queries, timeout=None):
+        """并发执行多个查询，在总超时内合并已完成的结果并去重，超时或出错的查询忽略"""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        futures = [self._pool.submit(self._search, query) for query in queries]
+        done, not_done = wait(futures, timeout=max(0, deadline - time.monotonic()))
+        self.timeouts += len(not_done)
+
+        merged, seen = [], set()
+        for future in futures:
+            if future not in done:
+                continue
+            try:
+                results = future.result()
+            except Exception as e:
+                self.errors += 1
+                logger.warning("Web search failed: %s", e)
+                continue
+            for result in results:
+                key = result_key(result)
+                if key not in seen:
+                    seen.add(key)
+                    merged.append(result)
+        return merged
+
+    def submit(self, question, timeout=None):
+        """在后台对问题的各个改写做并发搜索，返回 Future"""
+        return self._dispatch.submit(self.search_many, rewrite_query(question, self.max_rewrites), timeout)
+
+    def stats(self):
+        return {'cache': self.cache.stats(), 'timeouts': self.timeouts, 'errors': self.errors}
@@ -0,0 +1,111 @@
+"""
+/index 的流式输出阶段
+
+负责给增量文本追加 emoji、按刷新策略把多个增量合并成一帧，并序列化为
+data: {"content": ..., "done": false} 格式的 SSE 帧。帧的前后缀预先拼好，
+每帧只需对文本本身做一次 JSON 转义。
+
+刷新策略：
+    immediate  每个增量立即成帧
+    interval   距上次发送超过 interval 秒时成帧
+    bytes      积累的文本超过 max_bytes 字节时成帧
+合并在生产者循环中随每个增量就地判断，不额外占用读取线程或定时器。bytes 策略下待发送的文本
+滞留超过 interval 秒时也会成帧；上游停顿期间已收到的文本要等下一个增量或流结束才发送。
+"""
+import json
+import random
+import time
+
+POLICIES = ('immediate', 'interval', 'bytes')
+
+# 预序列化的帧片段，与 json.dumps({'content': ..., 'done': ...}, ensure_ascii=False) 输出一致
+FRAME_PREFIX = 'data: {"content": '
+FRAME_SUFFIX = ', "done": false}\n\n'
+START_FRAME = 'data: {"content": "", "done": false}\n\n'
+DONE_FRAME = 'data: {"content": "", "done": true}\n\n'
+
+# 句末标点，命中后按概率追加 emoji
+SENTENCE_ENDS = ("。", "！", "？")
+
+
+def content_frame(text):
+    return FRAME_PREFIX + json.dumps(text, ensure_ascii=False) + FRAME_SUFFIX
+
+
+def error_frame(message):
+    return f"data: {json.dumps({'error': message}, ensure_ascii=False)}\n\n"
+
+
+class SSEStream:
+    def __init__(self, policy='interval', interval=0.05, max_bytes=256, emojis=None, emoji_rate=0.2):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown SSE flush policy: {policy}")
+        self.policy = policy
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.emojis = emojis
+        self.emoji_rate = emoji_rate
+        # 已发送和待发送的完整文本，用于写入回答缓存
+        self.text = ""
+        self.frames_sent = 0
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+        self._last_flush = 0.0
+
+    def decorate(self, content):
+        """句末按概率追加一个 emoji"""
+        if self.emojis and content.rstrip().endswith(SENTENCE_ENDS) and random.random() < self.emoji_rate:
+            content += random.choice(self.emojis)
+        return content
+
+    def feed(self, content):
+        """接收一个增量，需要刷新时返回合并后的帧，否则返回 None"""
+        content = self.decorate(content)
+        self.text += content
+        if not self._pending:
+            self._pending_since = time.monotonic()
+        self._pending.append(content)
+        self._pending_bytes += len(content.encode('utf-8'))
+
+        if self.policy == 'immediate' or not self.frames_sent:
+            # 首帧总是立即发送，不拖慢首字时间
+            return self.flush()
+        if self.policy == 'interval' and time.monotonic() - self._last_flush >= self.interval:
+            return self.flush()
+        if self.policy == 'bytes' and (self._pending_bytes >= self.max_bytes
+                                       or time.monotonic() - self._pending_since >= self.interval):
+            return self.flush()
+        return None
+
+    def flush(self):
+        """把待发送的文本合并成一帧，没有待发送内容时返回 None"""
+        if not self._pending:
+            return None
+        frame = content_frame("".join(self._pending))
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+        self._last_flush = time.monotonic()
+        self.frames_sent += 1
+        return frame
+
+    def frames(self, deltas):
+        """把增量文本序列转换成帧序列，结束时发送剩余内容"""
+        for content in deltas:
+            frame = self.feed(content)
+            if frame is not None:
+                yield frame
+        frame = self.flush()
+        if frame is not None:
+            yield frame
+
+    async def aframes(self, deltas):
+        """frames 的异步版本，deltas 为异步迭代器"""
+        async for content in deltas:
+            frame = self.feed(content)
+            if frame is not None:
+                yield frame
+        frame = self.flush()
+        if frame is not None:
+            yield frame
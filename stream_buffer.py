@@ -0,0 +1,288 @@
+"""
+可续传的 SSE 流
+
+/index 和 /api/chat 的回答由后台生产者（Flask 入口为线程，ASGI 入口为协程任务）生成，
+逐帧写入按流 id 保存的 FrameBuffer，HTTP 响应只是缓冲的一个订阅者。
+客户端断开连接后生产者继续运行，已生成的帧保留在缓冲中：
+    - 每帧带 id: <流 id>:<序号>，响应头 X-Stream-Id 给出流 id
+    - 客户端带 Last-Event-ID 重新请求同一接口时，先重放该序号之后的帧，再继续实时输出，不再调用上游
+缓冲的帧数有上限，超出后淘汰最早的帧；流的数量有上限，按 TTL 过期，过期或已淘汰所需帧的流无法续传。
+一个缓冲可以同时有多个订阅者，后加入的订阅者先收到已生成的帧。
+
+同一问题的并发请求可以合并（single-flight）：StreamRegistry.lead 按键查找正在生成的流，
+第一个请求成为 leader 负责调用上游，之后的请求只订阅 leader 的缓冲，流结束后键随之释放。
+"""
+import asyncio
+import logging
+import re
+import threading
+import time
+import uuid
+from collections import deque
+
+from cache_utils import TTLCache
+
+logger = logging.getLogger(__name__)
+
+_EVENT_ID = re.compile(r'([0-9a-f]{32}):(\d+)')
+
+
+class FramesEvicted(Exception):
+    """续传所需的帧已被淘汰"""
+
+
+def parse_event_id(value):
+    """解析 Last-Event-ID，返回 (流 id, 序号)，格式不符时返回 None"""
+    match = _EVENT_ID.fullmatch((value or '').strip())
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+def format_event(stream_id, seq, frame):
+    """在 data: ... 帧前加上 SSE 的 id 字段"""
+    return f"id: {stream_id}:{seq}\n{frame}"
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class FrameBuffer:
+    def __init__(self, stream_id, max_frames=4096, **info):
+        self.stream_id = stream_id
+        self.max_frames = max_frames
+        # 创建流时的附加信息，如接口和模型
+        self.info = info
+        self._frames = deque()
+        self._next_seq = 1
+        self.done = False
+        self.created = time.monotonic()
+        self.finished = None
+        self._cond = threading.Condition()
+        # 等待新帧的异步订阅者：(事件循环, future)
+        self._async_waiters = []
+        self.subscribers = 0
+        # 合并请求的键，以及生产者写入的完整回答，供合并的请求在流结束后使用
+        self.key = None
+        self.result = None
+        self._callbacks = []
+
+    def append(self, frame):
+        with self._cond:
+            self._frames.append((self._next_seq, frame))
+            self._next_seq += 1
+            if len(self._frames) > self.max_frames:
+                self._frames.popleft()
+            self._notify()
+
+    def close(self):
+        with self._cond:
+            if self.done:
+                return
+            self.done = True
+            self.finished = time.monotonic()
+            self._notify()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def add_done_callback(self, callback):
+        """流结束后在生产者中调用 callback(buffer)，已结束时立即调用"""
+        with self._cond:
+            if not self.done:
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception as e:
+            logger.error("Error in callback of stream %s: %s", self.stream_id, e)
+
+    def _notify(self):
+        self._cond.notify_all()
+        for loop, future in self._async_waiters:
+            loop.call_soon_threadsafe(_wake, future)
+        self._async_waiters = []
+
+    def can_resume(self, after):
+        """序号 after 之后的帧是否都还在缓冲中"""
+        with self._cond:
+            return not self._frames or after + 1 >= self._frames[0][0]
+
+    def _read(self, after):
+        """返回 (序号 after 之后的帧, 是否已结束)，调用方持有 _cond"""
+        if self._frames and after + 1 < self._frames[0][0]:
+            raise FramesEvicted(self.stream_id)
+        start = max(0, after + 1 - self._frames[0][0]) if self._frames else 0
+        return [self._frames[i] for i in range(start, len(self._frames))], self.done
+
+    def subscribe(self, after=0):
+        """依次产出序号 after 之后的 (序号, 帧)，没有新帧时阻塞等待，流结束后返回"""
+        with self._cond:
+            self.subscribers += 1
+        try:
+            while True:
+                with self._cond:
+                    frames, done = self._read(after)
+                    if not frames and not done:
+                        self._cond.wait()
+                        continue
+                for seq, frame in frames:
+                    yield seq, frame
+                    after = seq
+                if done and not frames:
+                    return
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+    async def asubscribe(self, after=0):
+        """subscribe 的异步版本，等待新帧时不占用线程"""
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            self.subscribers += 1
+        try:
+            while True:
+                future = None
+                with self._cond:
+                    frames, done = self._read(after)
+                    if not frames and not done:
+                        future = loop.create_future()
+                        self._async_waiters.append((loop, future))
+                if future is not None:
+                    await future
+                    continue
+                for seq, frame in frames:
+                    yield seq, frame
+                    after = seq
+                if done and not frames:
+                    return
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+    def events(self, after=0):
+        """带 id 的 SSE 帧"""
+        for seq, frame in self.subscribe(after):
+            yield format_event(self.stream_id, seq, frame)
+
+    async def aevents(self, after=0):
+        async for seq, frame in self.asubscribe(after):
+            yield format_event(self.stream_id, seq, frame)
+
+
+def pump(buffer, frames):
+    """在生产者线程中把 frames 全部写入缓冲，与是否还有订阅者无关"""
+    try:
+        for frame in frames:
+            buffer.append(frame)
+    except Exception as e:
+        logger.error("Error producing stream %s: %s", buffer.stream_id, e)
+    finally:
+        buffer.close()
+
+
+async def apump(buffer, frames):
+    """pump 的异步版本，作为独立任务运行，不随响应被取消"""
+    try:
+        async for frame in frames:
+            buffer.append(frame)
+    except Exception as e:
+        logger.error("Error producing stream %s: %s", buffer.stream_id, e)
+    finally:
+        buffer.close()
+
+
+class StreamRegistry:
+    def __init__(self, maxsize=1000, ttl=600, max_frames=4096):
+        """最多保存 maxsize 个流，每个流最多 max_frames 帧，创建 ttl 秒后过期"""
+        self.max_frames = max_frames
+        self._streams = TTLCache(maxsize=maxsize, ttl=ttl)
+        # 异步生产者任务需要被引用，避免在完成前被回收
+        self._tasks = set()
+        # 合并请求的键 -> 正在生成的缓冲
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.resumed = 0
+        self.coalesced = 0
+
+    def create(self, **info):
+        buffer = FrameBuffer(uuid.uuid4().hex, self.max_frames, **info)
+        self._streams.put(buffer.stream_id, buffer)
+        self.created += 1
+        return buffer
+
+    def get(self, stream_id):
+        return self._streams.get(stream_id)
+
+    def lead(self, key, **info):
+        """
+        合并相同的请求：键为 key 的流正在生成且帧都还在缓冲中时返回 (该缓冲, False)，调用方只需订阅；
+        否则创建新缓冲并返回 (缓冲, True)，调用方作为 leader 必须随后调用 produce/aproduce 或 abandon
+        key 为 None 时不合并，总是返回新缓冲
+        """
+        if key is None:
+            return self.create(**info), True
+        with self._lock:
+            buffer = self._flights.get(key)
+            if buffer is not None and not buffer.done and buffer.can_resume(0):
+                self.coalesced += 1
+                return buffer, False
+            buffer = self.create(**info)
+            buffer.key = key
+            self._flights[key] = buffer
+        buffer.add_done_callback(self._land)
+        return buffer, True
+
+    def _land(self, buffer):
+        with self._lock:
+            if self._flights.get(buffer.key) is buffer:
+                del self._flights[buffer.key]
+
+    def abandon(self, buffer, frames=()):
+        """leader 在开始生成前失败时写入 frames 并结束缓冲，已订阅的请求随之结束"""
+        for frame in frames:
+            buffer.append(frame)
+        buffer.close()
+
+    def produce(self, buffer, frames):
+        """在后台线程中生成 frames 写入缓冲"""
+        threading.Thread(target=pump, args=(buffer, frames), name='sse-producer', daemon=True).start()
+        return buffer
+
+    def aproduce(self, buffer, frames):
+        """在当前事件循环中以独立任务生成 frames 写入缓冲"""
+        task = asyncio.get_running_loop().create_task(apump(buffer, frames))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return buffer
+
+    def resume(self, last_event_id):
+        """
+        按 Last-Event-ID 找到要续传的缓冲，返回 (缓冲, 已收到的序号)
+        不是有效的事件 id 时返回 None；流已过期或所需的帧已被淘汰时抛出 FramesEvicted
+        """
+        parsed = parse_event_id(last_event_id)
+        if parsed is None:
+            return None
+        stream_id, after = parsed
+        buffer = self.get(stream_id)
+        if buffer is None or not buffer.can_resume(after):
+            raise FramesEvicted(stream_id)
+        self.resumed += 1
+        return buffer, after
+
+    def stats(self):
+        return {
+            'created': self.created,
+            'resumed': self.resumed,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._flights),
+            'max_frames': self.max_frames,
+            'streams': self._streams.stats(),
+        }
@@ -0,0 +1,573 @@
+"""
+向量索引的增量维护
+
+按文件记录内容哈希清单，只对新增或修改过的文件经入库流水线重新切分、嵌入并写入索引，
+删除已移除或被替换文件对应的向量。更新在索引副本上进行，完成后整体替换，
+查询在更新期间继续使用旧索引。
+faiss 和 LangChain 在第一次用到时才导入，构造 VectorIndex 不会拖慢进程启动。
+
+index_type 不为 flat 且向量数达到 ann_min_vectors 时，刷新后把精确索引转换为近似索引（见 ann_index）。
+近似索引删除向量时先还原为精确索引再删除；量化索引（ivf_sq8、ivf_pq）无法还原原始向量，
+另外保留一份精确向量，刷新时在其上增删后重新量化，只有变化的文件需要重新嵌入。
+
+索引可持久化到 index_dir，目录结构（格式版本见 INDEX_FORMAT_VERSION）：
+    CURRENT            当前快照目录名，写入时原子替换
+    LOCK               多进程共用 index_dir 时的构建锁
+    v<version>/
+        meta.json      格式版本、嵌入模型、切分参数、文件清单
+        index.faiss    FAISS 索引
+        docstore.pkl   文档内容及向量下标到文档 id 的映射
+        vectors.faiss  量化索引对应的精确向量（flat 索引，下标与 index.faiss 一致），只有量化索引才有
+
+多个进程（如 gunicorn 的各个 worker）可以共用同一个 index_dir：
+    - 构建持有 LOCK 文件锁，同一时刻只有一个进程在构建；拿到锁后先切换到其他进程已发布的最新快照，
+      再在其基础上增量更新，版本号在所有进程间单调递增
+    - 快照目录写好后不再修改，只保留最近 keep_snapshots 个，其他进程可能还在读取较早的快照
+    - 其余进程由 start_watcher 的后台线程定期 stat 一次 CURRENT，发现新版本后读取新快照并整体替换，不需要重启
+    - 索引文件尽量内存映射（见 read_index），各进程映射同一个文件时共享操作系统的页缓存；
+      faiss 没有 IO_FLAG_MMAP_IFC 时 flat 和 HNSW 索引无法映射，每个进程各持有一份。
+      docstore.pkl 总是由每个进程各自反序列化，文本块内容在每个 worker 中各有一份
+"""
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import shutil
+import threading
+import time
+import unicodedata
+
+try:
+    import fcntl
+except ImportError:
+    # 非 POSIX 平台只支持单进程使用 index_dir
+    fcntl = None
+
+from cache_utils import TTLCache
+from embedding_service import register_embeddings
+from ingest_pipeline import SUPPORTED_EXTENSIONS, IngestPipeline
+
+logger = logging.getLogger(__name__)
+
+# 磁盘格式变化时递增，旧格式的索引会被忽略并重新嵌入
+INDEX_FORMAT_VERSION = 1
+
+_SNAPSHOT_NAME = re.compile(r'v(\d+)')
+
+
+def file_sha256(path, block_size=1 << 20):
+    """计算文件内容的 sha256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def normalize_question(text):
+    """统一全半角、大小写和空白，作为缓存键"""
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text)).strip().lower()
+
+
+def read_index(path):
+    """
+    读取 FAISS 索引，尽量内存映射，映射失败时退回普通读取，映射的索引只读
+    较新的 faiss 提供 IO_FLAG_MMAP_IFC，可以映射 flat、HNSW 和倒排索引；
+    更早的版本只有 IO_FLAG_MMAP，只能映射倒排索引（OnDiskInvertedLists），flat 和 HNSW 仍读入进程内存
+    """
+    import faiss
+
+    flags = getattr(faiss, 'IO_FLAG_MMAP_IFC', None)
+    if flags is None:
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    try:
+        return faiss.read_index(path, flags)
+    except RuntimeError:
+        return faiss.read_index(path)
+
+
+class VectorIndex:
+    def __init__(self, docs_dir, embeddings, chunk_size=1000, chunk_overlap=200, extensions=SUPPORTED_EXTENSIONS,
+                 index_dir=None, embedding_model=None, batch_size=256, workers=None,
+                 query_cache_size=4096, query_cache_ttl=3600, index_type='flat', ann_min_vectors=10000,
+                 nlist=None, pq_m=64, nprobe=16, ef_search=64, query_embedder=None, keep_snapshots=3):
+        self.docs_dir = docs_dir
+        self.embeddings = embeddings
+        # 计算查询向量的函数，可替换为合并并发请求的批处理器
+        self.query_embedder = query_embedder or embeddings.embed_query
+        self.index_dir = index_dir
+        self.keep_snapshots = keep_snapshots
+        self.embedding_model = embedding_model
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.pipeline = IngestPipeline(embeddings, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                       batch_size=batch_size, workers=workers)
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.index_type = index_type
+        self.ann_min_vectors = ann_min_vectors
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        # 当前对外提供查询的索引，只会被整体替换，不会原地修改
+        self.store = None
+        # 文件名 -> {"sha256", "size", "mtime_ns", "ids"}
+        self.manifest = {}
+        # 每次索引内容变化时递增
+        self.version = 0
+        self._write_lock = threading.Lock()
+        # 上次检查时 CURRENT 文件的 (inode, mtime_ns)，没变时不必读取
+        self._pointer_signature = None
+        self._watcher = None
+        # 当前索引内存映射自的快照文件；映射的索引只读，更新时从该文件完整读取一份再修改
+        self._mapped_index_path = None
+        # 当前索引为量化索引时对应的精确向量及其映射自的快照文件，刷新时从这里重建量化索引
+        self._exact_index = None
+        self._exact_index_path = None
+        # 问题 -> 查询向量，与索引内容无关，索引更新后仍然有效
+        self.query_cache = TTLCache(maxsize=query_cache_size, ttl=query_cache_ttl)
+        # (索引版本, 问题, k) -> 检索结果，索引更新后清空
+        self.result_cache = TTLCache(maxsize=query_cache_size, ttl=query_cache_ttl)
+
+    def scan(self):
+        """
+        扫描文档目录，返回 {文件名: (sha256, size, mtime_ns)}
+        大小和修改时间都没变的文件直接复用清单中的哈希，不再读取内容
+        """
+        if not os.path.exists(self.docs_dir):
+            os.makedirs(self.docs_dir)
+
+        current = {}
+        for filename in os.listdir(self.docs_dir):
+            # 扩展名不区分大小写，与上传接口的 allowed_file 一致
+            if os.path.splitext(filename)[1].lower() not in self.extensions:
+                continue
+            path = os.path.join(self.docs_dir, filename)
+            try:
+                stat = os.stat(path)
+                entry = self.manifest.get(filename)
+                if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                    sha256 = entry['sha256']
+                else:
+                    sha256 = file_sha256(path)
+                current[filename] = (sha256, stat.st_size, stat.st_mtime_ns)
+            except OSError as e:
+                logger.error("Error scanning file %s: %s", filename, e)
+        return current
+
+    def diff(self, current):
+        """对比扫描结果和清单，返回 (新增或修改的文件, 已删除的文件)"""
+        changed = [name for name, (sha256, _, _) in current.items()
+                   if name not in self.manifest or self.manifest[name]['sha256'] != sha256]
+        removed = [name for name in self.manifest if name not in current]
+        return changed, removed
+
+    def refresh(self, progress=None):
+        """
+        把文档目录的变化增量同步到索引，返回本次更新的统计信息
+        progress(files_done, files_total, chunks_embedded) 在每个文件切分完成和每批嵌入完成后调用
+        """
+        FAISS = self._faiss()
+        from ann_index import LOSSLESS_TYPES, build_index, index_type_of, reconstruct_all
+
+        with self._write_lock, self._build_lock():
+            # 其他进程已发布更新的快照时先切换过去，只增量处理之后的变化
+            if self._published_version() > self.version:
+                snapshot = self._read_snapshot()
+                if snapshot is not None:
+                    self._install(*snapshot)
+            current = self.scan()
+            changed, removed = self.diff(current)
+            # errors: 处理失败的文件名 -> 错误信息
+            stats = {'added': 0, 'updated': 0, 'removed': len(removed), 'chunks': 0, 'version': self.version,
+                     'errors': {}}
+            if not changed and not removed:
+                return stats
+
+            manifest = dict(self.manifest)
+            store = self._clone(self.store)
+            if store is not None and index_type_of(store.index) not in LOSSLESS_TYPES:
+                exact = self._editable_exact_index()
+                if exact is not None:
+                    # 量化索引在精确向量上增删，完成后由 _build_ann 重新量化
+                    store.index = exact
+                else:
+                    # 没有保存精确向量的旧快照只能全部重新嵌入
+                    logger.info("Rebuilding %s index from documents", index_type_of(store.index))
+                    changed, manifest, store = list(current), {}, None
+
+            # 先删除已移除文件和被替换文件的旧向量
+            stale_ids = []
+            for name in removed + changed:
+                entry = manifest.pop(name, None)
+                if entry:
+                    stale_ids.extend(entry['ids'])
+            if store is not None and stale_ids:
+                if index_type_of(store.index) != 'flat':
+                    # LangChain 删除后按位置重排下标，只适用于精确索引，先还原再删除
+                    store.index = build_index(reconstruct_all(store.index))
+                store.delete(stale_ids)
+
+            files = [(name, os.path.join(self.docs_dir, name), current[name][0]) for name in changed]
+            done = {'files': 0, 'chunks': 0}
+
+            def report():
+                if progress is not None:
+                    progress(done['files'], len(files), done['chunks'])
+
+            def on_file(name, sha256, chunks, error):
+                done['files'] += 1
+                report()
+                if error:
+                    # 处理失败的文件不写入清单，下次刷新时重试
+                    logger.error("Error processing file %s: %s", name, error)
+                    stats['errors'][name] = str(error)
+                    return []
+                _, size, mtime_ns = current[name]
+                ids = [f"{name}:{sha256[:16]}:{i}" for i in range(len(chunks))]
+                stats['updated' if name in self.manifest else 'added'] += 1
+                manifest[name] = {'sha256': sha256, 'size': size, 'mtime_ns': mtime_ns, 'ids': ids}
+                return ids
+
+            def on_batch(texts, vectors, metadatas, ids):
+                nonlocal store
+                text_embeddings = list(zip(texts, vectors))
+                if store is None:
+                    store = FAISS.from_embeddings(text_embeddings, self.embeddings, metadatas=metadatas, ids=ids)
+                else:
+                    store.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+                done['chunks'] += len(texts)
+                report()
+
+            report()
+            ingest = self.pipeline.run(files, on_file, on_batch)
+            stats['chunks'] = ingest.chunks
+            stats['ingest'] = ingest.as_dict()
+
+            if store is not None and store.index.ntotal == 0:
+                store = None
+            exact = None
+            if store is not None:
+                served = self._build_ann(store.index)
+                if index_type_of(served) not in LOSSLESS_TYPES:
+                    exact = store.index
+                store.index = served
+
+            # 原子替换：查询方只读取 self.store，一次赋值即完成切换
+            # 先换索引再递增版本，search 先读版本再读索引，保证缓存键不会指向旧索引的结果
+            self.manifest = manifest
+            self.store = store
+            self._mapped_index_path = None
+            self._exact_index = exact
+            self._exact_index_path = None
+            # 已发布的快照不兼容而没有切换时，版本号也要排在它之后
+            self.version = max(self.version, self._published_version()) + 1
+            self.result_cache.clear()
+            stats['version'] = self.version
+            if self.index_dir:
+                try:
+                    self.save()
+                except Exception as e:
+                    logger.error("Error saving vector store: %s", e)
+            return stats
+
+    def _meta(self):
+        return {
+            'format_version': INDEX_FORMAT_VERSION,
+            'embedding_model': self.embedding_model,
+            'chunk_size': self.chunk_size,
+            'chunk_overlap': self.chunk_overlap,
+            'extensions': list(self.extensions),
+            'index_type': self.index_type,
+        }
+
+    def _build_ann(self, index):
+        """按配置把精确索引转换为近似索引，并设置查询参数"""
+        from ann_index import build_index, index_type_of, reconstruct_all, set_search_params
+
+        if (self.index_type != 'flat' and index_type_of(index) == 'flat'
+                and index.ntotal >= self.ann_min_vectors):
+            logger.info("Building %s index over %s vectors", self.index_type, index.ntotal)
+            index = build_index(reconstruct_all(index), self.index_type, nlist=self.nlist, pq_m=self.pq_m)
+        set_search_params(index, self.nprobe, self.ef_search)
+        return index
+
+    def save(self):
+        """
+        把当前索引写入新的快照目录，再原子替换 CURRENT 指针，最后清理旧快照
+        写入中途失败不会影响已有快照
+        """
+        import faiss
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        name = f"v{self.version}"
+        snapshot_dir = os.path.join(self.index_dir, name)
+        tmp_dir = snapshot_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        store = self.store
+        if store is not None:
+            faiss.write_index(store.index, os.path.join(tmp_dir, 'index.faiss'))
+            with open(os.path.join(tmp_dir, 'docstore.pkl'), 'wb') as f:
+                pickle.dump((store.docstore._dict, store.index_to_docstore_id), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            exact = self._exact_index
+            if exact is not None:
+                faiss.write_index(exact, os.path.join(tmp_dir, 'vectors.faiss'))
+        meta = dict(self._meta(), version=self.version, manifest=self.manifest)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        os.rename(tmp_dir, snapshot_dir)
+        pointer_tmp = os.path.join(self.index_dir, 'CURRENT.tmp')
+        with open(pointer_tmp, 'w', encoding='utf-8') as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pointer_tmp, os.path.join(self.index_dir, 'CURRENT'))
+
+        # 构建持有文件锁，残留的 .tmp 目录都来自中途退出的构建
+        versions = []
+        for entry in os.listdir(self.index_dir):
+            match = _SNAPSHOT_NAME.fullmatch(entry)
+            if match:
+                versions.append(int(match.group(1)))
+            elif entry.endswith('.tmp') and _SNAPSHOT_NAME.fullmatch(entry[:-len('.tmp')]):
+                shutil.rmtree(os.path.join(self.index_dir, entry), ignore_errors=True)
+        for version in sorted(versions, reverse=True)[self.keep_snapshots:]:
+            shutil.rmtree(os.path.join(self.index_dir, f"v{version}"), ignore_errors=True)
+
+    @contextlib.contextmanager
+    def _build_lock(self):
+        """跨进程的构建锁，index_dir 未设置或平台不支持时只有进程内的 _write_lock"""
+        if not self.index_dir or fcntl is None:
+            yield
+            return
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(os.path.join(self.index_dir, 'LOCK'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _published_version(self):
+        """CURRENT 指向的快照版本，没有已发布的快照时返回 0"""
+        if not self.index_dir:
+            return 0
+        try:
+            with open(os.path.join(self.index_dir, 'CURRENT'), 'r', encoding='utf-8') as f:
+                match = _SNAPSHOT_NAME.fullmatch(f.read().strip())
+        except OSError:
+            return 0
+        return int(match.group(1)) if match else 0
+
+    def _read_snapshot(self):
+        """
+        读取 CURRENT 指向的快照，返回 (meta, store, 内存映射的索引文件, 精确向量, 精确向量映射自的文件)，
+        后三项可能为 None；不存在或不兼容时返回 None
+        格式版本、嵌入模型或切分参数不一致时放弃加载，由 refresh 重新嵌入
+        """
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+        FAISS = self._faiss()
+
+        try:
+            with open(os.path.join(self.index_dir, 'CURRENT'), 'r', encoding='utf-8') as f:
+                snapshot_dir = os.path.join(self.index_dir, f.read().strip())
+            with open(os.path.join(snapshot_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if any(meta.get(key) != value for key, value in self._meta().items()):
+            logger.warning("Persisted vector store is incompatible, ignoring it")
+            return None
+
+        from ann_index import LOSSLESS_TYPES, index_type_of
+
+        store, mapped_path, exact, exact_path = None, None, None, None
+        index_path = os.path.join(snapshot_dir, 'index.faiss')
+        if os.path.exists(index_path):
+            with open(os.path.join(snapshot_dir, 'docstore.pkl'), 'rb') as f:
+                docs, index_to_docstore_id = pickle.load(f)
+            index = read_index(index_path)
+            served = self._build_ann(index)
+            if served is index:
+                # 转换成近似索引时得到的是内存中的新索引，不再是映射
+                mapped_path = index_path
+            if index_type_of(served) not in LOSSLESS_TYPES:
+                if served is not index:
+                    # 加载时才量化，读入的精确索引就是精确向量
+                    exact, exact_path = index, index_path
+                elif os.path.exists(os.path.join(snapshot_dir, 'vectors.faiss')):
+                    exact_path = os.path.join(snapshot_dir, 'vectors.faiss')
+                    exact = read_index(exact_path)
+            store = FAISS(
+                embedding_function=self.embeddings,
+                index=served,
+                docstore=InMemoryDocstore(docs),
+                index_to_docstore_id=index_to_docstore_id,
+            )
+        return meta, store, mapped_path, exact, exact_path
+
+    def _install(self, meta, store, mapped_path=None, exact=None, exact_path=None):
+        """切换到读取的快照，调用方持有 _write_lock"""
+        self.manifest = meta['manifest']
+        self.store = store
+        self._mapped_index_path = mapped_path
+        self._exact_index = exact
+        self._exact_index_path = exact_path
+        self.version = meta['version']
+        self.result_cache.clear()
+
+    def load(self):
+        """从 index_dir 加载快照，返回是否切换到了该快照；不比当前版本新的快照不加载"""
+        if not self.index_dir:
+            return False
+        try:
+            snapshot = self._read_snapshot()
+        except Exception as e:
+            # 快照可能恰好被清理，下次检查时重试
+            logger.error("Error reading persisted vector store: %s", e)
+            return False
+        if snapshot is None:
+            return False
+        with self._write_lock:
+            if snapshot[0]['version'] <= self.version:
+                return False
+            self._install(*snapshot)
+        return True
+
+    def reload(self):
+        """
+        其他进程发布了新快照时切换过去，返回是否切换
+        只有 CURRENT 文件变化后才读取快照，平时每次调用只有一次 stat
+        """
+        if not self.index_dir:
+            return False
+        try:
+            stat = os.stat(os.path.join(self.index_dir, 'CURRENT'))
+        except OSError:
+            return False
+        signature = (stat.st_ino, stat.st_mtime_ns)
+        if signature == self._pointer_signature:
+            return False
+        self._pointer_signature = signature
+        if self._published_version() <= self.version or not self.load():
+            return False
+        logger.info("Switched to published vector store version %s", self.version)
+        return True
+
+    def start_watcher(self, interval=1.0):
+        """启动后台线程，每 interval 秒检查一次其他进程是否发布了新快照"""
+        if not self.index_dir or interval <= 0:
+            return
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload()
+                except Exception as e:
+                    logger.error("Error reloading vector store: %s", e)
+
+        self._watcher = threading.Thread(target=run, name='index-watcher', daemon=True)
+        self._watcher.start()
+
+    def embed_query(self, question):
+        """计算问题的查询向量，相同问题只做一次嵌入"""
+        key = normalize_question(question)
+        vector = self.query_cache.get(key)
+        if vector is None:
+            vector = self.query_embedder(question)
+            self.query_cache.put(key, vector)
+        return vector
+
+    def search(self, question, k=3):
+        """检索与问题最相关的 k 个文本块，结果按索引版本缓存"""
+        version = self.version
+        store = self.store
+        if store is None:
+            return []
+        key = (version, normalize_question(question), k)
+        docs = self.result_cache.get(key)
+        if docs is None:
+            docs = store.similarity_search_by_vector(self.embed_query(question), k=k)
+            self.result_cache.put(key, docs)
+        return docs
+
+    def search_with_scores(self, question, k=8):
+        """检索 k 个候选文本块及其距离（越小越相关），供上下文组装按相关度取舍"""
+        version = self.version
+        store = self.store
+        if store is None:
+            return []
+        key = (version, normalize_question(question), k, 'scored')
+        docs = self.result_cache.get(key)
+        if docs is None:
+            docs = store.similarity_search_with_score_by_vector(self.embed_query(question), k=k)
+            self.result_cache.put(key, docs)
+        return docs
+
+    def stats(self):
+        store = self.store
+        if store is not None:
+            from ann_index import index_type_of
+        return {
+            'version': self.version,
+            'published_version': self._published_version(),
+            'pid': os.getpid(),
+            'files': len(self.manifest),
+            'vectors': store.index.ntotal if store is not None else 0,
+            'index_type': index_type_of(store.index) if store is not None else None,
+            'nprobe': self.nprobe,
+            'ef_search': self.ef_search,
+            'query_cache': self.query_cache.stats(),
+            'result_cache': self.result_cache.stats(),
+        }
+
+    def _faiss(self):
+        """导入 LangChain 的 FAISS 向量库，并让嵌入对象通过它的 Embeddings 类型检查"""
+        from langchain_community.vectorstores import FAISS
+
+        register_embeddings(self.embeddings)
+        return FAISS
+
+    def _editable_exact_index(self):
+        """返回量化索引对应的精确向量的可修改副本，没有保存精确向量时返回 None"""
+        import faiss
+
+        if self._exact_index is None:
+            return None
+        if self._exact_index_path is not None:
+            # 与 _clone 相同，映射的索引只读，从快照文件完整读取一份
+            return faiss.read_index(self._exact_index_path)
+        return faiss.clone_index(self._exact_index)
+
+    def _clone(self, store):
+        """复制一份索引用于更新，避免修改正在被查询的索引"""
+        import faiss
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+        FAISS = self._faiss()
+
+        if store is None:
+            return None
+        if self._mapped_index_path is not None:
+            # 映射读入的倒排索引（OnDiskInvertedLists）不能 clone，映射的 flat 索引 clone 后仍是只读视图，
+            # 修改会让进程直接崩溃，因此从快照文件不带映射标志完整读取一份
+            index = faiss.read_index(self._mapped_index_path)
+        else:
+            index = faiss.clone_index(store.index)
+        return FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore(dict(store.docstore._dict)),
+            index_to_docstore_id=dict(store.index_to_docstore_id),
+        )